@@ -4,13 +4,21 @@ import sys
 import pymongo
 import os
 import time
+import threading
+import json
+import re
+import atexit
+from collections import deque
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from json.decoder import JSONDecodeError
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from typing import Optional, Tuple, List, Dict, Any
+from typing import Optional, Tuple, List, Dict, Any, Callable
 import urllib3
 
+import metrics
+
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -20,10 +28,47 @@ load_dotenv()
 URLLIB3_VERSION = urllib3.__version__.split('.')
 USE_ALLOWED_METHODS = int(URLLIB3_VERSION[0]) >= 2
 
+# Connection pool sizing: one keep-alive connection per concurrent worker thread
+API_POOL_CONNECTIONS = int(os.getenv("API_POOL_CONNECTIONS", "4"))
+API_POOL_MAXSIZE = int(os.getenv("API_POOL_MAXSIZE", "50"))
+SITE_DATA_URL = os.getenv("SITE_DATA_URL", "https://stagging-region.spectreco.com/api")
+
+# Company metadata changes rarely: serve it from a local cache
+COMPANY_CACHE_TTL = float(os.getenv("COMPANY_CACHE_TTL", "3600"))
+COMPANY_CACHE_STALE_TTL = float(os.getenv("COMPANY_CACHE_STALE_TTL", "86400"))
+COMPANY_CACHE_DIR = os.getenv("COMPANY_CACHE_DIR", "")
+SITE_CACHE_TTL = float(os.getenv("SITE_CACHE_TTL", "900"))
+# Persisted caches are written at most once per this many seconds
+COMPANY_CACHE_PERSIST_DELAY = float(os.getenv("COMPANY_CACHE_PERSIST_DELAY", "5"))
+# A company id missing from the cached list reloads the list, at most once per this many seconds
+COMPANY_MISS_RELOAD_SECONDS = float(os.getenv("COMPANY_MISS_RELOAD_SECONDS", "60"))
+
+# Circuit breaker: open after this many consecutive failures, or when the error
+# rate over the sliding window exceeds BREAKER_ERROR_RATE; retry after the timeout
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "60"))
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "60"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_MIN_REQUESTS = int(os.getenv("BREAKER_MIN_REQUESTS", "10"))
+
+# Fail-fast mode: no transport retries and a short timeout, so a degraded
+# upstream costs one quick attempt per call instead of minutes
+API_FAIL_FAST = os.getenv("API_FAIL_FAST", "false").lower() in ("1", "true", "yes")
+API_TIMEOUT = float(os.getenv("API_TIMEOUT", "5" if API_FAIL_FAST else "30"))
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "0" if API_FAIL_FAST else "3"))
+
+class _CountingRetry(Retry):
+    """urllib3 Retry that counts every transport-level retry"""
+
+    def increment(self, *args, **kwargs):
+        metrics.inc("api_retries_total", kind="transport")
+        return super().increment(*args, **kwargs)
+
 class APIClient:
     """Enhanced API client with retry logic and better error handling"""
     
-    def __init__(self, base_url: str, timeout: int = 30, max_retries: int = 3):
+    def __init__(self, base_url: str, timeout: float = API_TIMEOUT, max_retries: int = API_MAX_RETRIES,
+                 pool_connections: int = API_POOL_CONNECTIONS, pool_maxsize: int = API_POOL_MAXSIZE):
         self.base_url = base_url.rstrip('/')
         self.timeout = timeout
         self.session = requests.Session()
@@ -41,9 +86,14 @@ class APIClient:
         else:
             retry_kwargs['method_whitelist'] = ["HEAD", "GET", "OPTIONS"]
         
-        retry_strategy = Retry(**retry_kwargs)
+        retry_strategy = _CountingRetry(**retry_kwargs)
         
-        adapter = HTTPAdapter(max_retries=retry_strategy)
+        adapter = HTTPAdapter(
+            max_retries=retry_strategy,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=False
+        )
         self.session.mount("http://", adapter)
         self.session.mount("https://", adapter)
         
@@ -57,7 +107,16 @@ class APIClient:
     def get(self, endpoint: str, params: Optional[Dict] = None) -> Optional[Dict]:
         """Make GET request with proper error handling"""
         url = f"{self.base_url}{endpoint}"
+        breaker = get_circuit_breaker(endpoint_template(endpoint))
+        
+        # Fail fast while the endpoint is known to be down; callers fall back
+        # to their cached value or default
+        if not breaker.allow_request():
+            logger.warning(f"Circuit '{breaker.name}' is open, skipping request to {url}")
+            metrics.inc("api_requests_total", endpoint=breaker.name, outcome="circuit_open")
+            return None
         
+        outcome = "error"
         try:
             logger.info(f"Making request to: {url}")
             
@@ -72,38 +131,465 @@ class APIClient:
             if response.status_code == 200:
                 try:
                     data = response.json()
+                    breaker.record_success()
+                    outcome = "success"
                     return data
                 except JSONDecodeError as e:
+                    breaker.record_failure()
                     logger.error(f"Failed to parse JSON response from {url}: {str(e)}")
                     logger.error(f"Response content: {response.text[:500]}...")
                     return None
             else:
+                # Client errors other than throttling mean the upstream itself is healthy
+                if response.status_code == 429 or response.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                outcome = f"http_{response.status_code}"
                 logger.error(f"API request failed. Status: {response.status_code}, URL: {url}")
                 logger.error(f"Response: {response.text[:500]}...")
                 return None
                 
         except requests.exceptions.ConnectionError as e:
+            breaker.record_failure()
             logger.error(f"Connection error for {url}: {str(e)}")
             return None
         except requests.exceptions.Timeout as e:
+            breaker.record_failure()
             logger.error(f"Timeout error for {url}: {str(e)}")
             return None
         except requests.exceptions.RequestException as e:
+            breaker.record_failure()
             logger.error(f"Request error for {url}: {str(e)}")
             return None
         except Exception as e:
+            # Still counts against the breaker, so a half-open trial never stays unresolved
+            breaker.record_failure()
             logger.error(f"Unexpected error for {url}: {str(e)}")
             return None
+        finally:
+            metrics.inc("api_requests_total", endpoint=breaker.name, outcome=outcome)
+
+def endpoint_template(endpoint: str) -> str:
+    """Collapse ids in an endpoint path, e.g. /company/data/707 -> /company/data/{id}"""
+    return re.sub(r'/\d+(?=/|$)', '/{id}', endpoint.split('?')[0])
+
+class TTLCache:
+    """
+    Thread-safe TTL cache with stale-while-revalidate and optional JSON persistence.
+
+    Fresh entries (younger than ttl) are returned directly. Stale entries (younger
+    than ttl + stale_ttl) are returned immediately while a background thread
+    refreshes them. Anything older, or missing, is loaded synchronously with one
+    loader call per key. If the loader fails (returns None) the last known value
+    is returned, however old it is.
+
+    Changes are written to disk persist_delay seconds after the first unsaved
+    one (and at exit), not on every set.
+    """
+    
+    def __init__(self, name: str, ttl: float, stale_ttl: float, persist_dir: str = "",
+                 persist_delay: float = COMPANY_CACHE_PERSIST_DELAY):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.persist_path = os.path.join(persist_dir, f"{name}.json") if persist_dir else None
+        self.persist_delay = persist_delay
+        self._entries: Dict[str, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+        # key -> [lock, callers holding or waiting for it]; removed when the last one is done
+        self._key_locks: Dict[str, list] = {}
+        self._refreshing = set()
+        self._save_timer: Optional[threading.Timer] = None
+        self._load_from_disk()
+        if self.persist_path:
+            atexit.register(self.flush)
+    
+    def get(self, key: Any, loader: Callable[[], Optional[Any]], allow_stale: bool = True) -> Optional[Any]:
+        """
+        Get a value, loading it with loader() when missing or expired. With
+        allow_stale=False a stale entry is reloaded synchronously instead of
+        being served.
+        """
+        key = str(key)
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.time() - entry[0]
+            if age < self.ttl:
+                metrics.inc("api_cache_hits_total", cache=self.name)
+                return entry[1]
+            if allow_stale and age < self.ttl + self.stale_ttl:
+                self._refresh_in_background(key, loader)
+                return entry[1]
+        
+        with self._key_lock(key):
+            # Another thread may have loaded it while we waited
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                return entry[1]
+            
+            value = loader()
+            if value is not None:
+                self.set(key, value)
+                return value
+            
+            if entry is not None:
+                logger.warning(f"[{self.name}] Loader failed for {key}, serving cached value")
+                return entry[1]
+            return None
+    
+    def is_fresh(self, key: Any) -> bool:
+        """True if the key is cached and younger than ttl"""
+        entry = self._entries.get(str(key))
+        return entry is not None and time.time() - entry[0] < self.ttl
+    
+    def peek(self, key: Any) -> Optional[Any]:
+        """Return the cached value regardless of its age, without loading"""
+        entry = self._entries.get(str(key))
+        return entry[1] if entry is not None else None
+    
+    def reload(self, key: Any, loader: Callable[[], Optional[Any]], min_age: float = 0.0) -> Optional[Any]:
+        """
+        Load a key again now, unless it was stored less than min_age seconds ago.
+        Concurrent callers share one loader call; the last known value is returned
+        when the loader fails.
+        """
+        key = str(key)
+        with self._key_lock(key):
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] < min_age:
+                return entry[1]
+            value = loader()
+            if value is not None:
+                self.set(key, value)
+                return value
+            return entry[1] if entry is not None else None
+    
+    def set(self, key: Any, value: Any) -> None:
+        """Store a value and schedule persisting the cache if enabled"""
+        with self._lock:
+            self._entries[str(key)] = (time.time(), value)
+            self._schedule_save()
+    
+    def invalidate(self, key: Any = None) -> None:
+        """Drop one key, or everything when key is None"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(key), None)
+            self._schedule_save()
+    
+    def flush(self) -> None:
+        """Write pending changes to disk now"""
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            self._save_to_disk()
+    
+    @contextmanager
+    def _key_lock(self, key: str):
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self._key_locks.pop(key, None)
+    
+    def _refresh_in_background(self, key: str, loader: Callable[[], Optional[Any]]) -> None:
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        
+        def refresh():
+            try:
+                value = loader()
+                if value is not None:
+                    self.set(key, value)
+            except Exception as e:
+                logger.error(f"[{self.name}] Background refresh failed for {key}: {str(e)}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+        
+        threading.Thread(target=refresh, name=f"{self.name}-refresh-{key}", daemon=True).start()
+    
+    def _load_from_disk(self) -> None:
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path) as f:
+                stored = json.load(f)
+            self._entries = {key: (entry[0], entry[1]) for key, entry in stored.items()}
+            logger.info(f"[{self.name}] Loaded {len(self._entries)} cached entries from {self.persist_path}")
+        except Exception as e:
+            logger.error(f"[{self.name}] Failed to load cache from {self.persist_path}: {str(e)}")
+    
+    def _schedule_save(self) -> None:
+        # Caller holds self._lock
+        if not self.persist_path or self._save_timer is not None:
+            return
+        self._save_timer = threading.Timer(self.persist_delay, self._scheduled_save)
+        self._save_timer.daemon = True
+        self._save_timer.start()
+    
+    def _scheduled_save(self) -> None:
+        with self._lock:
+            self._save_timer = None
+            self._save_to_disk()
+    
+    def _save_to_disk(self) -> None:
+        # Caller holds self._lock
+        if not self.persist_path:
+            return
+        try:
+            tmp_path = f"{self.persist_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({key: [ts, value] for key, (ts, value) in self._entries.items()}, f)
+            os.replace(tmp_path, self.persist_path)
+        except Exception as e:
+            logger.error(f"[{self.name}] Failed to persist cache to {self.persist_path}: {str(e)}")
+
+_company_list_cache = TTLCache("company_list", COMPANY_CACHE_TTL, COMPANY_CACHE_STALE_TTL, COMPANY_CACHE_DIR)
+_company_detail_cache = TTLCache("company_detail", COMPANY_CACHE_TTL, COMPANY_CACHE_STALE_TTL, COMPANY_CACHE_DIR)
+_site_cache = TTLCache("company_sites", SITE_CACHE_TTL, COMPANY_CACHE_STALE_TTL, COMPANY_CACHE_DIR)
+
+# id -> company index over the cached company list
+_company_index: Dict[str, Dict] = {}
+_company_index_source: Optional[List[Dict]] = None
+_company_index_lock = threading.Lock()
+
+class CircuitBreaker:
+    """
+    Circuit breaker for an upstream endpoint.
+    
+    closed: requests flow normally while outcomes are tracked over a sliding
+    window. The breaker opens after failure_threshold consecutive failures, or
+    when at least min_requests outcomes in the window have an error rate of
+    error_rate or more. While open, requests are refused until reset_timeout has
+    passed; then one trial request is let through (half_open) and its outcome
+    closes or re-opens the breaker.
+    """
+    
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT, window_seconds: float = BREAKER_WINDOW_SECONDS,
+                 error_rate: float = BREAKER_ERROR_RATE, min_requests: int = BREAKER_MIN_REQUESTS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.window_seconds = window_seconds
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._outcomes = deque()  # (timestamp, succeeded)
+        self._lock = threading.Lock()
+        
+        # Counters exposed through metrics
+        self.total_successes = 0
+        self.total_failures = 0
+        self.total_rejected = 0
+        self.times_opened = 0
+    
+    def allow_request(self) -> bool:
+        """Whether a request may be sent now"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                return True
+            self.total_rejected += 1
+            return False
+    
+    def record_success(self) -> None:
+        with self._lock:
+            self.total_successes += 1
+            self._record_outcome(True)
+            self.state = "closed"
+            self.consecutive_failures = 0
+    
+    def release_trial(self) -> None:
+        """Give back a half-open trial that ended without an outcome (e.g. cancelled), so a later request can retry"""
+        with self._lock:
+            if self.state == "half_open":
+                self.state = "open"
+    
+    def record_failure(self) -> None:
+        with self._lock:
+            self.total_failures += 1
+            self._record_outcome(False)
+            self.consecutive_failures += 1
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold or self._error_rate_exceeded():
+                if self.state != "open":
+                    self.times_opened += 1
+                    logger.warning(f"Circuit breaker '{self.name}' opened "
+                                   f"(consecutive failures: {self.consecutive_failures}, window error rate: {self._window_error_rate():.2f})")
+                self.state = "open"
+                self.opened_at = time.time()
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Current state and counters, for health checks and metrics"""
+        with self._lock:
+            self._trim_window()
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "window_requests": len(self._outcomes),
+                "window_error_rate": self._window_error_rate(),
+                "successes": self.total_successes,
+                "failures": self.total_failures,
+                "rejected": self.total_rejected,
+                "times_opened": self.times_opened,
+            }
+    
+    def _record_outcome(self, succeeded: bool) -> None:
+        self._outcomes.append((time.time(), succeeded))
+        self._trim_window()
+    
+    def _trim_window(self) -> None:
+        cutoff = time.time() - self.window_seconds
+        while self._outcomes and self._outcomes[0][0] < cutoff:
+            self._outcomes.popleft()
+    
+    def _window_error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return len([ok for _, ok in self._outcomes if not ok]) / len(self._outcomes)
+    
+    def _error_rate_exceeded(self) -> bool:
+        return len(self._outcomes) >= self.min_requests and self._window_error_rate() >= self.error_rate
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """Get the shared circuit breaker for an endpoint"""
+    with _circuit_breakers_lock:
+        if name not in _circuit_breakers:
+            _circuit_breakers[name] = CircuitBreaker(name)
+        return _circuit_breakers[name]
+
+def get_circuit_breaker_states() -> Dict[str, Dict[str, Any]]:
+    """Snapshot of every circuit breaker, keyed by endpoint"""
+    with _circuit_breakers_lock:
+        breakers = list(_circuit_breakers.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
+
+def _export_circuit_breaker_gauges() -> None:
+    for name, state in get_circuit_breaker_states().items():
+        metrics.set_gauge("circuit_breaker_open", 1 if state.get("state") == "open" else 0, endpoint=name)
 
-# Initialize API client
-def get_api_client() -> Optional[APIClient]:
-    """Get configured API client"""
-    base_url = os.getenv("COMPANY_DATA_URL")
+metrics.register_gauge_callback(_export_circuit_breaker_gauges)
+
+# Process-wide API clients, one per base URL, so keep-alive connections are reused
+_api_clients: Dict[str, APIClient] = {}
+_api_clients_lock = threading.Lock()
+
+def get_api_client(base_url: Optional[str] = None) -> Optional[APIClient]:
+    """Get the shared API client for base_url (defaults to COMPANY_DATA_URL)"""
+    base_url = base_url or os.getenv("COMPANY_DATA_URL")
     if not base_url:
         logger.error("COMPANY_DATA_URL environment variable not set")
         return None
     
-    return APIClient(base_url)
+    client = _api_clients.get(base_url)
+    if client is None:
+        with _api_clients_lock:
+            client = _api_clients.get(base_url)
+            if client is None:
+                client = APIClient(base_url)
+                _api_clients[base_url] = client
+    return client
+
+def get_site_api_client() -> APIClient:
+    """Get the shared API client for the site hierarchy service"""
+    return get_api_client(SITE_DATA_URL)
+
+def parse_company_details(company_code: int, data: Optional[Dict]) -> Optional[Dict]:
+    """Extract the company record from a /company/data/<id> response"""
+    if not data:
+        logger.warning(f"No data received for company {company_code}")
+        return None
+    
+    # Validate response structure
+    if not isinstance(data, dict) or "data" not in data:
+        logger.error(f"Invalid response structure for company {company_code}: {data}")
+        return None
+    
+    company_data = data.get("data", {}).get("company", {})
+    
+    if not company_data:
+        logger.warning(f"No company data found for company {company_code}")
+        return None
+    
+    return company_data
+
+def _load_company_details(company_code: int) -> Optional[Dict]:
+    """Fetch the company record (start month, reporting frequency, ...) from the API"""
+    api_client = get_api_client()
+    if not api_client:
+        logger.error("Failed to create API client")
+        return None
+    
+    logger.info(f"Fetching company data for company_code: {company_code}")
+    
+    return parse_company_details(company_code, api_client.get(f"/company/data/{company_code}"))
+
+def fetch_company_details(company_code: int) -> Optional[Dict]:
+    """Get the cached company record, including month and reporting_frequency"""
+    return _company_detail_cache.get(company_code, lambda: _load_company_details(company_code))
+
+def prime_company_details(company_code: int, company_data: Dict) -> None:
+    """Store a company record fetched elsewhere (e.g. by the prefetch stage)"""
+    _company_detail_cache.set(company_code, company_data)
+
+def parse_company_sites(company_id: Any, data: Optional[Dict]) -> Optional[List[Dict]]:
+    """Extract the site list from a /companies/<id>/sites response"""
+    if data is None:
+        logger.error(f"Failed to fetch site data for company {company_id}")
+        return None
+    
+    if not data.get('success') or data.get('code') != 200:
+        logger.error(f"API returned error: {data}")
+        return None
+    
+    sites = data.get('data', [])
+    if not sites:
+        logger.warning(f"No sites found for company {company_id}")
+        return None
+    
+    return sites
+
+def fetch_company_sites(company_id: Any, allow_stale: bool = True) -> Optional[List[Dict]]:
+    """
+    Get the cached flat site list for a company. allow_stale=False (the rollup
+    hierarchy) only serves entries younger than SITE_CACHE_TTL, and an older one
+    only when reloading it fails.
+    """
+    return _site_cache.get(
+        company_id,
+        lambda: parse_company_sites(company_id, get_site_api_client().get(f"/companies/{company_id}/sites")),
+        allow_stale=allow_stale
+    )
+
+def prime_company_sites(company_id: Any, sites: List[Dict]) -> None:
+    """Store a site list fetched elsewhere (e.g. by the prefetch stage)"""
+    _site_cache.set(company_id, sites)
+
+def is_company_cached(company_id: Any, include_sites: bool = False) -> bool:
+    """True if the company's metadata (and optionally its sites) is fresh in the cache"""
+    if not _company_detail_cache.is_fresh(company_id):
+        return False
+    return not include_sites or _site_cache.is_fresh(company_id)
 
 def fetch_company_data(company_code: int) -> List:
     """
@@ -116,28 +602,9 @@ def fetch_company_data(company_code: int) -> List:
         List containing start month or ['January'] if error
     """
     try:
-        api_client = get_api_client()
-        if not api_client:
-            logger.error("Failed to create API client")
-            return ['January']
-        
-        logger.info(f"Fetching company data for company_code: {company_code}")
-        
-        data = api_client.get(f"/company/data/{company_code}")
-        
-        if not data:
-            logger.warning(f"No data received for company {company_code}")
-            return ['January']
-        
-        # Validate response structure
-        if not isinstance(data, dict) or "data" not in data:
-            logger.error(f"Invalid response structure for company {company_code}: {data}")
-            return ['January']
-        
-        company_data = data.get("data", {}).get("company", {})
+        company_data = fetch_company_details(company_code)
         
         if not company_data:
-            logger.warning(f"No company data found for company {company_code}")
             return ['January']
         
         # Extract start month
@@ -157,18 +624,18 @@ def fetch_company_data(company_code: int) -> List:
         logger.error(f"Exception occurred while fetching company data for {company_code}: {str(e)}")
         return ['January']
 
-def fetch_all_company() -> List[Dict]:
+def _load_all_company() -> Optional[List[Dict]]:
     """
-    Fetch all company data
+    Fetch all company data from the API
     
     Returns:
-        List of company dictionaries (empty list if error)
+        List of company dictionaries (None if error, so failures are not cached)
     """
     try:
         api_client = get_api_client()
         if not api_client:
             logger.error("Failed to create API client")
-            return []
+            return None
         
         logger.info("Fetching all company data")
         
@@ -176,22 +643,22 @@ def fetch_all_company() -> List[Dict]:
         
         if not data:
             logger.warning("No data received when fetching all companies")
-            return []
+            return None
         
         # Validate response structure
         if not isinstance(data, dict):
             logger.error(f"Invalid response structure when fetching all companies: {type(data)}")
-            return []
+            return None
         
         companies = data.get("companies")
         
         if not companies:
             logger.warning("No companies found in response")
-            return []
+            return None
         
         if not isinstance(companies, list):
             logger.error(f"Companies data is not a list: {type(companies)}")
-            return []
+            return None
         
         logger.info(f"Successfully fetched {len(companies)} companies")
         
@@ -209,12 +676,40 @@ def fetch_all_company() -> List[Dict]:
             valid_companies.append(company)
         
         logger.info(f"Validated {len(valid_companies)} companies out of {len(companies)}")
-        return valid_companies
+        return valid_companies or None
         
     except Exception as e:
         logger.error(f"Exception occurred while fetching all companies: {str(e)}")
-        # Always return an empty list instead of None
-        return []
+        return None
+
+def fetch_all_company() -> List[Dict]:
+    """
+    Fetch all company data (cached)
+    
+    Returns:
+        List of company dictionaries (empty list if error)
+    """
+    return _company_list_cache.get("all", _load_all_company) or []
+
+def _indexed_company(companies: List[Dict], company_id: Any) -> Optional[Dict]:
+    global _company_index, _company_index_source
+    with _company_index_lock:
+        if _company_index_source is not companies:
+            _company_index = {str(company['id']): company for company in companies}
+            _company_index_source = companies
+        return _company_index.get(str(company_id))
+
+def get_company_by_id(company_id: Any) -> Optional[Dict]:
+    """
+    O(1) lookup of a company in the cached company list. A company missing from
+    the list (e.g. created since it was cached) reloads the list once, shared by
+    concurrent lookups and at most every COMPANY_MISS_RELOAD_SECONDS.
+    """
+    company = _indexed_company(fetch_all_company(), company_id)
+    if company is not None:
+        return company
+    companies = _company_list_cache.reload("all", _load_all_company, min_age=COMPANY_MISS_RELOAD_SECONDS) or []
+    return _indexed_company(companies, company_id)
 
 # Fallback data for testing/development
 def get_fallback_companies() -> List[Dict[str, Any]]:
@@ -268,12 +763,19 @@ def fetch_company_with_retry(company_id: int) -> List:
     Returns:
         List containing start month or ['January'] if all attempts fail
     """
-    max_attempts = 3
+    max_attempts = 1 if API_FAIL_FAST else 3
     delay = 1.0
+    breaker = get_circuit_breaker(endpoint_template(f"/company/data/{company_id}"))
     
     for attempt in range(max_attempts):
+        # No point retrying into an open circuit: serve the cached value or default
+        if attempt > 0 and breaker.state == "open":
+            logger.warning(f"Circuit '{breaker.name}' is open, not retrying company {company_id}")
+            break
         try:
             logger.info(f"Attempt {attempt + 1}/{max_attempts} to fetch company {company_id}")
+            if attempt > 0:
+                metrics.inc("api_retries_total", kind="application")
             
             result = fetch_company_data(company_id)
             
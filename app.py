@@ -1,6 +1,5 @@
 import json
-from bson import ObjectId
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, send_file
 from flask_cors import CORS
 import logging
 import sys
@@ -10,6 +9,11 @@ import time
 from dotenv import load_dotenv
 import traceback
 import main
+import metrics
+import profiling
+from forecast_telemetry import model_report
+from jobs import running_threads, thread_lock, run_job, convert_objectids_to_strings  # shared with asgi_app
+from run_ledger import new_run_id
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), './rollup')))
 import rollcontroller
 
@@ -29,90 +33,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Global dictionary to track running threads
-running_threads = {}
-thread_lock = threading.Lock()
-
-def convert_objectids_to_strings(data):
-    """Recursively convert ObjectId instances to strings"""
-    if isinstance(data, dict):
-        return {key: convert_objectids_to_strings(value) for key, value in data.items()}
-    elif isinstance(data, list):
-        return [convert_objectids_to_strings(item) for item in data]
-    elif isinstance(data, ObjectId):
-        return str(data)
-    else:
-        return data
-
-def run_aggregation_script_in_background(company_id, thread_id):
+def run_aggregation_script_in_background(company_id, thread_id, run_id=None, profile=None):
     """Run the aggregation script in a background thread"""
-    try:
-        with thread_lock:
-            running_threads[thread_id] = {
-                'status': 'running',
-                'company_id': company_id,
-                'start_time': time.time(),
-                'type': 'aggregation'
-            }
-        
-        logger.info(f"Starting aggregation script for company_id: {company_id}")
-        result = main.main(company_id=company_id)
-        
-        # Update thread status
-        with thread_lock:
-            if thread_id in running_threads:
-                running_threads[thread_id]['status'] = 'completed'
-                running_threads[thread_id]['result'] = result
-                running_threads[thread_id]['end_time'] = time.time()
-        
-        logger.info("Aggregation script completed successfully")
-        
-    except Exception as e:
-        logger.error(f"Error in background aggregation: {str(e)}")
-        logger.error(traceback.format_exc())
-        
-        # Update thread status with error
-        with thread_lock:
-            if thread_id in running_threads:
-                running_threads[thread_id]['status'] = 'error'
-                running_threads[thread_id]['error'] = str(e)
-                running_threads[thread_id]['traceback'] = traceback.format_exc()
-                running_threads[thread_id]['end_time'] = time.time()
+    run_job('aggregation', company_id, thread_id, main.main, profile=profile, run_id=run_id)
 
-def run_rollup_script_in_background(company_id, thread_id):
+def run_rollup_script_in_background(company_id, thread_id, run_id=None, profile=None):
     """Run the rollup script in a background thread"""
-    try:
-        with thread_lock:
-            running_threads[thread_id] = {
-                'status': 'running',
-                'company_id': company_id,
-                'start_time': time.time(),
-                'type': 'rollup'
-            }
-        
-        logger.info(f"Starting rollup script for company_id: {company_id}")
-        result = rollcontroller.main(company_id=company_id)
-        
-        # Update thread status
-        with thread_lock:
-            if thread_id in running_threads:
-                running_threads[thread_id]['status'] = 'completed'
-                running_threads[thread_id]['result'] = result
-                running_threads[thread_id]['end_time'] = time.time()
-        
-        logger.info("Rollup script completed successfully")
-        
-    except Exception as e:
-        logger.error(f"Error in background rollup: {str(e)}")
-        logger.error(traceback.format_exc())
-        
-        # Update thread status with error
-        with thread_lock:
-            if thread_id in running_threads:
-                running_threads[thread_id]['status'] = 'error'
-                running_threads[thread_id]['error'] = str(e)
-                running_threads[thread_id]['traceback'] = traceback.format_exc()
-                running_threads[thread_id]['end_time'] = time.time()
+    run_job('rollup', company_id, thread_id, rollcontroller.main, profile=profile, run_id=run_id)
 
 # Root route to handle health checks
 @app.route('/', methods=['GET'])
@@ -128,22 +55,60 @@ def root():
             'rollup_api': '/api/rollup',
             'rollup_status': '/api/rollup/status',
             'rollup_data': '/api/rollup/data',
-            'status': '/status/<thread_id>'
+            'status': '/status/<thread_id>',
+            'metrics': '/metrics',
+            'forecast_model_report': '/forecast/model-report',
+            'profiles': '/profiles'
         }
     }), 200
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Stage timings, Mongo/API counters and breaker states in Prometheus text format"""
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/forecast/model-report', methods=['GET'])
+def forecast_model_report():
+    """Per-model fit time, failures and win rate of the forecasting tournament since startup"""
+    return jsonify(model_report()), 200
+
+@app.route('/profiles', methods=['GET'])
+def list_profiles():
+    """Stored job profiles, newest first"""
+    profiles = profiling.list_profiles()
+    return jsonify({'status': 'success', 'profiles': profiles, 'count': len(profiles)}), 200
+
+@app.route('/profiles/<job_id>', methods=['GET'])
+def get_profile(job_id):
+    """Summary of one job's profile, with links to its artifacts"""
+    summary = profiling.load_summary(job_id)
+    if summary is None:
+        return jsonify({'status': 'not_found', 'error': 'No profile for this job'}), 404
+    summary['downloads'] = {name: f"/profiles/{job_id}/{name}" for name in summary.get('artifacts', [])}
+    return jsonify({'status': 'success', 'profile': summary}), 200
+
+@app.route('/profiles/<job_id>/<artifact>', methods=['GET'])
+def download_profile_artifact(job_id, artifact):
+    """Download profile.pstats, stacks.collapsed, allocations.txt, ..."""
+    path = profiling.profile_path(job_id, artifact)
+    if path is None or not os.path.exists(path):
+        return jsonify({'status': 'not_found', 'error': 'Profile artifact not found'}), 404
+    return send_file(os.path.abspath(path), mimetype=profiling.PROFILE_ARTIFACTS[artifact],
+                     as_attachment=True, download_name=f"{job_id}-{artifact}")
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     try:
         # Check if API is accessible
-        from RegionAPI import fetch_all_company_safe
+        from RegionAPI import fetch_all_company_safe, get_circuit_breaker_states
         companies = fetch_all_company_safe()
         
         return jsonify({
             'status': 'healthy',
             'message': 'Service is running',
             'api_status': 'connected' if companies else 'disconnected',
+            'circuit_breakers': get_circuit_breaker_states(),
             'active_threads': len([t for t_id, t in running_threads.items() if t['status'] == 'running'])
         }), 200
     except Exception as e:
@@ -446,14 +411,29 @@ def api_rollup_sites(company_id):
 def run_aggregation():
     """Run aggregation process in background"""
     try:
-        # Get company_id from request
+        # Get company_id (and optional resume_run_id / profile mode) from request
         company_id = None
+        resume_run_id = None
+        profile = None
         if request.json:
             company_id = request.json.get('company_id')
+            resume_run_id = request.json.get('resume_run_id')
+            profile = request.json.get('profile')
         if not company_id and request.args:
             company_id = request.args.get('company_id')
+        if not resume_run_id and request.args:
+            resume_run_id = request.args.get('resume_run_id')
+        if profile is None and request.args:
+            profile = request.args.get('profile')
+        try:
+            profile = profiling.parse_mode(profile)
+        except ValueError as e:
+            return jsonify({
+                'status': 'error',
+                'error': str(e)
+            }), 400
             
-        logger.info(f"Received aggregation request for company_id: {company_id}")
+        logger.info(f"Received aggregation request for company_id: {company_id}, resume_run_id: {resume_run_id}")
         
         # Validate company_id if provided
         if company_id:
@@ -480,10 +460,13 @@ def run_aggregation():
         # Generate unique thread ID
         thread_id = f"agg_{company_id or 'all'}_{int(time.time())}"
         
+        # Ledger run id; reusing an earlier one skips the units it already completed
+        run_id = resume_run_id or new_run_id('aggregation')
+        
         # Run script in background thread
         thread = threading.Thread(
             target=run_aggregation_script_in_background, 
-            args=(company_id, thread_id),
+            args=(company_id, thread_id, run_id, profile),
             name=f"AggregationThread-{thread_id}"
         )
         thread.daemon = True
@@ -493,7 +476,9 @@ def run_aggregation():
             'status': 'started',
             'message': 'Aggregation process has been started in the background.',
             'company_id': company_id,
-            'thread_id': thread_id
+            'thread_id': thread_id,
+            'run_id': run_id,
+            'profile': f"/profiles/{thread_id}" if profile else None
         }), 202
         
     except Exception as e:
@@ -508,14 +493,29 @@ def run_aggregation():
 def run_rollup():
     """Run rollup process in background"""
     try:
-        # Get company_id from request
+        # Get company_id (and optional resume_run_id / profile mode) from request
         company_id = None
+        resume_run_id = None
+        profile = None
         if request.json:
             company_id = request.json.get('company_id')
+            resume_run_id = request.json.get('resume_run_id')
+            profile = request.json.get('profile')
         if not company_id and request.args:
             company_id = request.args.get('company_id')
+        if not resume_run_id and request.args:
+            resume_run_id = request.args.get('resume_run_id')
+        if profile is None and request.args:
+            profile = request.args.get('profile')
+        try:
+            profile = profiling.parse_mode(profile)
+        except ValueError as e:
+            return jsonify({
+                'status': 'error',
+                'error': str(e)
+            }), 400
             
-        logger.info(f"Received rollup request for company_id: {company_id}")
+        logger.info(f"Received rollup request for company_id: {company_id}, resume_run_id: {resume_run_id}")
         
         # Validate company_id if provided
         if company_id:
@@ -542,10 +542,13 @@ def run_rollup():
         # Generate unique thread ID
         thread_id = f"rollup_{company_id or 'all'}_{int(time.time())}"
         
+        # Ledger run id; reusing an earlier one skips the units it already completed
+        run_id = resume_run_id or new_run_id('rollup')
+        
         # Run script in background thread
         thread = threading.Thread(
             target=run_rollup_script_in_background, 
-            args=(company_id, thread_id),
+            args=(company_id, thread_id, run_id, profile),
             name=f"RollupThread-{thread_id}"
         )
         thread.daemon = True
@@ -555,7 +558,9 @@ def run_rollup():
             'status': 'started',
             'message': 'Rollup process has been started in the background.',
             'company_id': company_id,
-            'thread_id': thread_id
+            'thread_id': thread_id,
+            'run_id': run_id,
+            'profile': f"/profiles/{thread_id}" if profile else None
         }), 202
         
     except Exception as e:
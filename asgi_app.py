@@ -0,0 +1,387 @@
+"""
+Async (ASGI) serving mode for the aggregation/rollup service.
+
+Read endpoints run on the event loop and use the async Mongo driver (motor);
+long-running aggregation and rollup endpoints hand the work off to the shared
+job pool (jobs.py) and return 202 immediately, so status polls never wait on a
+worker thread. Run with run_asgi.sh (uvicorn).
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+import traceback
+
+from dotenv import load_dotenv
+from quart import Quart, jsonify, request, send_file
+from quart_cors import cors
+
+import db_connection
+import jobs
+from jobs import convert_objectids_to_strings
+import main
+import metrics
+import profiling
+from forecast_telemetry import model_report
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), './rollup')))
+import rollcontroller
+from run_ledger import new_run_id
+
+load_dotenv()
+app = cors(Quart(__name__))  # Enable CORS for all routes
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_COLLECTIONS = {
+    'monthly': 'rollup_monthly',
+    'quarterly': 'rollup_quarterly',
+    'bi_annual': 'rollup_bi_annual',
+    'yearly': 'rollup_yearly',
+}
+
+
+def _parse_company_id(company_id):
+    """Return (company_id, error_response)"""
+    if company_id:
+        try:
+            return int(company_id), None
+        except (TypeError, ValueError):
+            return None, (jsonify({
+                'status': 'error',
+                'error': 'Invalid company_id. Must be an integer.'
+            }), 400)
+    return None, None
+
+
+async def _requested_params():
+    """Return (company_id, resume_run_id, profile) from the JSON body or the query string"""
+    data = await request.get_json(silent=True) or {}
+    company_id = data.get('company_id') or request.args.get('company_id')
+    resume_run_id = data.get('resume_run_id') or request.args.get('resume_run_id')
+    profile = data.get('profile') if data.get('profile') is not None else request.args.get('profile')
+    return company_id, resume_run_id, profile
+
+
+def _start_job(job_type, company_id, target, resume_run_id=None, profile=None):
+    """Hand a job off to the job pool, refusing duplicates for the same company"""
+    running_id = jobs.find_running_job(job_type, company_id)
+    if running_id:
+        return jsonify({
+            'status': 'already_running',
+            'message': f'{job_type.capitalize()} for company_id {company_id} is already running.',
+            'thread_id': running_id
+        }), 409
+
+    prefix = 'agg' if job_type == 'aggregation' else job_type
+    thread_id = f"{prefix}_{company_id or 'all'}_{int(time.time())}"
+    # Ledger run id; reusing an earlier one skips the units it already completed
+    run_id = resume_run_id or new_run_id(job_type)
+    jobs.submit_job(job_type, company_id, thread_id, target, profile=profile, run_id=run_id)
+
+    return jsonify({
+        'status': 'started',
+        'message': f'{job_type.capitalize()} process has been queued on the job pool.',
+        'company_id': company_id,
+        'thread_id': thread_id,
+        'run_id': run_id,
+        'profile': f"/profiles/{thread_id}" if profile else None
+    }), 202
+
+
+@app.route('/', methods=['GET'])
+async def root():
+    """Root endpoint"""
+    return jsonify({
+        'service': 'aggregation-rollup-service',
+        'status': 'running',
+        'mode': 'asgi',
+        'endpoints': {
+            'health': '/health',
+            'aggregation': '/run-aggregation',
+            'rollup': '/start-rollup',
+            'rollup_status': '/api/rollup/status',
+            'rollup_data': '/api/rollup/data',
+            'status': '/status/<thread_id>',
+            'metrics': '/metrics',
+            'forecast_model_report': '/forecast/model-report',
+            'profiles': '/profiles'
+        }
+    }), 200
+
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    """Stage timings, Mongo/API counters and breaker states in Prometheus text format"""
+    return metrics.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@app.route('/forecast/model-report', methods=['GET'])
+async def forecast_model_report():
+    """Per-model fit time, failures and win rate of the forecasting tournament since startup"""
+    return jsonify(model_report()), 200
+
+
+@app.route('/profiles', methods=['GET'])
+async def list_profiles():
+    """Stored job profiles, newest first"""
+    profiles = await asyncio.to_thread(profiling.list_profiles)
+    return jsonify({'status': 'success', 'profiles': profiles, 'count': len(profiles)}), 200
+
+
+@app.route('/profiles/<job_id>', methods=['GET'])
+async def get_profile(job_id):
+    """Summary of one job's profile, with links to its artifacts"""
+    summary = await asyncio.to_thread(profiling.load_summary, job_id)
+    if summary is None:
+        return jsonify({'status': 'not_found', 'error': 'No profile for this job'}), 404
+    summary['downloads'] = {name: f"/profiles/{job_id}/{name}" for name in summary.get('artifacts', [])}
+    return jsonify({'status': 'success', 'profile': summary}), 200
+
+
+@app.route('/profiles/<job_id>/<artifact>', methods=['GET'])
+async def download_profile_artifact(job_id, artifact):
+    """Download profile.pstats, stacks.collapsed, allocations.txt, ..."""
+    path = profiling.profile_path(job_id, artifact)
+    if path is None or not os.path.exists(path):
+        return jsonify({'status': 'not_found', 'error': 'Profile artifact not found'}), 404
+    return await send_file(os.path.abspath(path), mimetype=profiling.PROFILE_ARTIFACTS[artifact],
+                           as_attachment=True, attachment_filename=f"{job_id}-{artifact}")
+
+
+@app.route('/health', methods=['GET'])
+async def health_check():
+    """Health check endpoint"""
+    try:
+        from RegionAPI import fetch_all_company_safe, get_circuit_breaker_states
+        companies = await asyncio.to_thread(fetch_all_company_safe)
+
+        return jsonify({
+            'status': 'healthy',
+            'message': 'Service is running',
+            'api_status': 'connected' if companies else 'disconnected',
+            'circuit_breakers': get_circuit_breaker_states(),
+            'active_threads': jobs.count_active_jobs()
+        }), 200
+    except Exception as e:
+        logger.error(f"Health check failed: {str(e)}")
+        return jsonify({
+            'status': 'degraded',
+            'message': f'Service is running but encountered an error: {str(e)}',
+            'active_threads': jobs.count_active_jobs()
+        }), 200
+
+
+@app.route('/api/rollup/status', methods=['GET'])
+async def api_rollup_status():
+    """Get rollup processing status and statistics"""
+    try:
+        company_id = request.args.get('company_id')
+        frequency = request.args.get('frequency', 'all')
+        db = db_connection.connect_to_database_async()
+
+        selected = [f for f in ROLLUP_COLLECTIONS if frequency in ('all', f)]
+        counts = await asyncio.gather(*[db[ROLLUP_COLLECTIONS[f]].count_documents({}) for f in selected])
+        status_data = dict(zip(selected, counts))
+
+        if company_id:
+            company_filter = {"company_id": str(company_id)}
+            company_counts = await asyncio.gather(
+                *[db[ROLLUP_COLLECTIONS[f]].count_documents(company_filter) for f in selected]
+            )
+            status_data['company_specific'] = dict(zip(selected, company_counts))
+
+        return jsonify({
+            'status': 'success',
+            'data': status_data,
+            'timestamp': time.time()
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error getting rollup status: {str(e)}")
+        return jsonify({
+            'status': 'error',
+            'error': str(e)
+        }), 500
+
+
+@app.route('/api/rollup/data', methods=['GET'])
+async def api_rollup_data():
+    """Get rollup data with filtering options"""
+    try:
+        company_id = request.args.get('company_id')
+        frequency = request.args.get('frequency', 'yearly')
+        year = request.args.get('year')
+        internal_code_id = request.args.get('internal_code_id')
+        limit = request.args.get('limit', 100, type=int)
+        skip = request.args.get('skip', 0, type=int)
+
+        filter_query = {}
+        if company_id:
+            filter_query['company_id'] = str(company_id)
+        if year:
+            filter_query['type_year'] = int(year)
+        if internal_code_id:
+            filter_query['internal_code_id'] = internal_code_id
+
+        db = db_connection.connect_to_database_async()
+        collection = db[ROLLUP_COLLECTIONS.get(frequency, 'rollup_yearly')]
+
+        data, total_count = await asyncio.gather(
+            collection.find(filter_query).skip(skip).limit(limit).to_list(length=limit),
+            collection.count_documents(filter_query)
+        )
+        data = convert_objectids_to_strings(data)
+
+        return jsonify({
+            'status': 'success',
+            'data': {
+                'records': data,
+                'pagination': {
+                    'total': total_count,
+                    'limit': limit,
+                    'skip': skip,
+                    'has_more': (skip + limit) < total_count
+                },
+                'filters': {
+                    'company_id': company_id,
+                    'frequency': frequency,
+                    'year': year,
+                    'internal_code_id': internal_code_id
+                }
+            }
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error getting rollup data: {str(e)}")
+        return jsonify({
+            'status': 'error',
+            'error': str(e)
+        }), 500
+
+
+@app.route('/api/rollup/sites/<company_id>', methods=['GET'])
+async def api_rollup_sites(company_id):
+    """Get site hierarchy for a specific company"""
+    try:
+        site_data = await asyncio.to_thread(lambda: rollcontroller.SiteDataRollup().fetch_site_data(company_id))
+
+        if not site_data:
+            return jsonify({
+                'status': 'error',
+                'error': f'Could not fetch site data for company {company_id}'
+            }), 404
+
+        return jsonify({
+            'status': 'success',
+            'data': {
+                'company_id': company_id,
+                'site_hierarchy': convert_objectids_to_strings(site_data)
+            }
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error fetching site data: {str(e)}")
+        return jsonify({
+            'status': 'error',
+            'error': str(e)
+        }), 500
+
+
+@app.route('/run-aggregation', methods=['POST'])
+async def run_aggregation():
+    """Queue the aggregation process on the job pool"""
+    try:
+        company_id, resume_run_id, profile = await _requested_params()
+        company_id, error = _parse_company_id(company_id)
+        if error:
+            return error
+        try:
+            profile = profiling.parse_mode(profile)
+        except ValueError as e:
+            return jsonify({
+                'status': 'error',
+                'error': str(e)
+            }), 400
+        logger.info(f"Received aggregation request for company_id: {company_id}, resume_run_id: {resume_run_id}")
+        return _start_job('aggregation', company_id, main.main, resume_run_id, profile)
+
+    except Exception as e:
+        logger.error(f"Error triggering background aggregation: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({
+            'status': 'error',
+            'error': str(e)
+        }), 500
+
+
+@app.route('/start-rollup', methods=['POST'])
+async def run_rollup():
+    """Queue the rollup process on the job pool"""
+    try:
+        company_id, resume_run_id, profile = await _requested_params()
+        company_id, error = _parse_company_id(company_id)
+        if error:
+            return error
+        try:
+            profile = profiling.parse_mode(profile)
+        except ValueError as e:
+            return jsonify({
+                'status': 'error',
+                'error': str(e)
+            }), 400
+        logger.info(f"Received rollup request for company_id: {company_id}, resume_run_id: {resume_run_id}")
+        return _start_job('rollup', company_id, rollcontroller.main, resume_run_id, profile)
+
+    except Exception as e:
+        logger.error(f"Error triggering background rollup: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({
+            'status': 'error',
+            'error': str(e)
+        }), 500
+
+
+@app.route('/run-aggregation/<int:company_id>', methods=['POST'])
+async def run_aggregation_for_company(company_id):
+    """In async mode the per-company aggregation is handed off to the job pool"""
+    return _start_job('aggregation', company_id, main.main)
+
+
+@app.route('/run-rollup/<int:company_id>', methods=['POST'])
+async def run_rollup_for_company(company_id):
+    """In async mode the per-company rollup is handed off to the job pool"""
+    return _start_job('rollup', company_id, rollcontroller.main)
+
+
+@app.route('/status/<thread_id>', methods=['GET'])
+async def get_status(thread_id):
+    """Get the status of a specific process (aggregation or rollup)"""
+    with jobs.thread_lock:
+        if thread_id not in jobs.running_threads:
+            return jsonify({
+                'status': 'not_found',
+                'error': 'Thread ID not found'
+            }), 404
+        thread_info = convert_objectids_to_strings(jobs.running_threads[thread_id].copy())
+
+    return jsonify({
+        'status': 'success',
+        'thread_info': jobs.with_duration(thread_info)
+    }), 200
+
+
+@app.route('/list-threads', methods=['GET'])
+async def list_threads():
+    """List all active and recent jobs"""
+    with jobs.thread_lock:
+        threads = convert_objectids_to_strings(jobs.running_threads.copy())
+
+    for thread_info in threads.values():
+        jobs.with_duration(thread_info)
+
+    return jsonify({
+        'status': 'success',
+        'threads': threads,
+        'count': len(threads)
+    }), 200
@@ -0,0 +1,230 @@
+"""
+End-to-end aggregation and rollup benchmark against a local MongoDB.
+
+For each dataset size a fresh database is filled by synthetic_data, the
+company and site APIs are served by stub_api, and
+CompanyDataController.process_company_data followed by
+SiteDataRollup.process_company_data run over all companies. Each stage runs
+in its own interpreter so peak RSS, caches and metrics start clean.
+
+Recorded per stage: wall time, Mongo commands issued (by command), documents
+read and written, the stage timers from metrics.py, the peak RSS of the
+stage process and the peak RSS of its largest child (the CPU process pool).
+The result is one JSON document; pass an earlier one as --baseline to fail
+on regressions.
+
+    python benchmarks/aggregation_benchmark.py --sizes small,medium --output bench.json
+    python benchmarks/aggregation_benchmark.py --sizes small --baseline bench.json --tolerance 0.25
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'rollup'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# companies, codes per company, sites per company, years of history
+SIZES = {
+    "small": {"companies": 2, "codes": 3, "sites": 3, "years": 2},
+    "medium": {"companies": 4, "codes": 6, "sites": 6, "years": 3},
+    "large": {"companies": 8, "codes": 10, "sites": 12, "years": 4},
+}
+
+# Metrics compared against a baseline (lower is better)
+COMPARED_METRICS = ("wall_seconds", "mongo_commands_total", "documents_read", "documents_written",
+                    "peak_rss_mb", "peak_children_rss_mb")
+STAGES = ("aggregation", "rollup")
+
+
+def parse_size(size: str) -> Dict[str, int]:
+    """A preset name or companies:codes:sites:years"""
+    if size in SIZES:
+        return dict(SIZES[size])
+    companies, codes, sites, years = (int(part) for part in size.split(':'))
+    return {"companies": companies, "codes": codes, "sites": sites, "years": years}
+
+
+def _peak_rss_mb(who: int) -> float:
+    # ru_maxrss is in KiB on Linux; for RUSAGE_CHILDREN it is the largest single child that has exited
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+
+def _stage_stats(metrics, before: Dict[str, Any], wall_seconds: float) -> Dict[str, Any]:
+    delta = metrics.delta(before, metrics.snapshot())
+    commands = {}
+    for labels, (count, _, _) in delta["summaries"].get("mongo_command_duration_seconds", {}).items():
+        commands[dict(labels)["command"]] = commands.get(dict(labels)["command"], 0) + count
+    stages = {}
+    for labels, (count, total, _) in delta["summaries"].get("aggregation_stage_duration_seconds", {}).items():
+        stage = dict(labels)["stage"]
+        entry = stages.setdefault(stage, {"count": 0, "seconds": 0.0})
+        entry["count"] += count
+        entry["seconds"] = round(entry["seconds"] + total, 4)
+    return {
+        "wall_seconds": round(wall_seconds, 3),
+        "mongo_commands_total": sum(commands.values()),
+        "mongo_commands": dict(sorted(commands.items())),
+        "documents_read": int(sum(delta["counters"].get("mongo_documents_read_total", {}).values())),
+        "documents_written": int(sum(delta["counters"].get("mongo_documents_written_total", {}).values())),
+        "stages": stages,
+    }
+
+
+def run_stage(stage: str) -> Dict[str, Any]:
+    """Run one stage over all companies in this process (database and APIs come from the environment)"""
+    import concurrency
+    import metrics
+    import main as aggregation
+    import rollcontroller
+
+    before, started = metrics.snapshot(), time.perf_counter()
+    if stage == "aggregation":
+        outcome = aggregation.CompanyDataController(workers=1).process_company_data()
+    else:
+        outcome = rollcontroller.SiteDataRollup().process_company_data()
+    result = _stage_stats(metrics, before, time.perf_counter() - started)
+    result["success"] = bool(outcome.get("success"))
+    # Reap the CPU process pool so its workers count towards RUSAGE_CHILDREN
+    concurrency.get_concurrency_controller().shutdown()
+    result["peak_rss_mb"] = _peak_rss_mb(resource.RUSAGE_SELF)
+    result["peak_children_rss_mb"] = _peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return result
+
+
+def _run_stage_subprocess(stage: str, env: Dict[str, str]) -> Dict[str, Any]:
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as handle:
+        result_path = handle.name
+    command = [sys.executable, os.path.abspath(__file__), "--run-stage", stage, "--stage-output", result_path]
+    # The controllers log and print heavily; keep that out of the JSON output
+    proc = subprocess.run(command, env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    try:
+        if proc.returncode != 0:
+            raise RuntimeError(f"Stage {stage} failed:\n{proc.stderr[-3000:]}")
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        os.unlink(result_path)
+
+
+def run_case(name: str, params: Dict[str, Any], args) -> Dict[str, Any]:
+    """Generate the dataset, then run aggregation and rollup over it, each in its own interpreter"""
+    from pymongo import MongoClient
+    from synthetic_data import generate_dataset
+    from stub_api import StubCompanyAPI
+
+    db_name = f"{args.db}_{name}"
+    client = MongoClient(args.mongodb_url)
+    client.drop_database(db_name)
+    # SiteDataRollup.process_company_data rolls up current_year - 6; start the history there
+    params = dict(params, start_year=params.get("start_year") or datetime.now().year - 6)
+    logger.info(f"Running case {name}: {params}")
+    manifest = generate_dataset(client[db_name], seed=args.seed, **params)
+    result = {"name": name, "params": params, "seed": args.seed, "counts": manifest["counts"]}
+
+    with StubCompanyAPI(manifest) as base_url:
+        # Read by RegionAPI and db_connection at import / first use
+        env = dict(os.environ, MONGODB_URL=args.mongodb_url, MONGODB_DB_NAME=db_name, COMPANY_DATA_URL=base_url,
+                   SITE_DATA_URL=base_url, COMPANY_CACHE_DIR="", WORK_LEASES_ENABLED="false")
+        if args.cpu_executor:
+            env["AGG_CPU_EXECUTOR"] = args.cpu_executor
+        for stage in STAGES:
+            result[stage] = _run_stage_subprocess(stage, env)
+
+    client.drop_database(db_name)
+    return result
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Regressions of more than tolerance (relative) against the baseline, per case and stage"""
+    regressions = []
+    baseline_cases = {case["name"]: case for case in baseline.get("cases", [])}
+    for case in results["cases"]:
+        previous = baseline_cases.get(case["name"])
+        if not previous or previous.get("params") != case["params"]:
+            continue
+        for stage in STAGES:
+            for metric in COMPARED_METRICS:
+                old, new = previous[stage].get(metric), case[stage].get(metric)
+                if old and new is not None and new > old * (1 + tolerance):
+                    regressions.append(f"{case['name']}.{stage}.{metric}: {old} -> {new} (+{(new / old - 1):.0%})")
+    return regressions
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark aggregation and rollup on synthetic data')
+    parser.add_argument('--sizes', default='small,medium', help='Presets (small, medium, large) or companies:codes:sites:years')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--mongodb-url', default=os.getenv("BENCHMARK_MONGODB_URL", "mongodb://localhost:27017"))
+    parser.add_argument('--db', default=os.getenv("BENCHMARK_DB_NAME", "aggregation_benchmark"))
+    parser.add_argument('--cpu-executor', choices=['process', 'thread', 'inline'], help='Override AGG_CPU_EXECUTOR')
+    parser.add_argument('--output', help='Write the JSON result to this file')
+    parser.add_argument('--baseline', help='Earlier result to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative regression')
+    # Internal: run one stage in this process
+    parser.add_argument('--run-stage', choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument('--stage-output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        result = run_stage(args.run_stage)
+        with open(args.stage_output, 'w') as f:
+            json.dump(result, f)
+        return 0
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    results = {
+        "benchmark": "aggregation",
+        "commit": _git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "cpu_executor": args.cpu_executor or os.getenv("AGG_CPU_EXECUTOR", "process"),
+        "cases": [],
+    }
+    for size in args.sizes.split(','):
+        results["cases"].append(run_case(size, parse_size(size), args))
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results["regressions"] = regressions
+        if regressions:
+            logger.error("Regressions against baseline:\n  " + "\n  ".join(regressions))
+            exit_code = 1
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
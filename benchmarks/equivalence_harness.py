@@ -0,0 +1,277 @@
+"""
+Output-equivalence harness for aggregation engines.
+
+Generates one synthetic dataset (synthetic_data) into two databases, runs
+the legacy processors over the first and a candidate engine over the second,
+and diffs cdata_month, cdata_quarter, cdata_bi_annual and cdata_yearly on
+their natural keys. Each side runs in its own interpreter against the stub
+company/site API, so module-level caches and settings cannot leak between
+them.
+
+A candidate is:
+- a module (--candidate) defining any of process_monthly_data,
+  process_quarterly_data, process_BiAnnual_data and process_yearly_data with
+  the processors' signature; the ones it defines replace the legacy functions
+  in main, the rest stay legacy
+- and/or settings (--candidate-env KEY=VALUE) that switch on an optimized
+  path, e.g. AGG_CPU_EXECUTOR=thread
+
+Documents are matched on the natural key of each collection (company, site,
+code, type_year, reporting_year, period, is_forecast). Numbers compare with
+--rel-tol / --abs-tol, also when stored as strings (qty); _id and timestamps
+are ignored. Exits 1 when the outputs differ.
+
+    python benchmarks/equivalence_harness.py --candidate fast_engine --companies 3 --years 3
+    python benchmarks/equivalence_harness.py --candidate-env AGGREGATION_INCREMENTAL=true --output diff.json
+"""
+import argparse
+import importlib
+import json
+import logging
+import math
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+PROCESSOR_FUNCTIONS = ('process_monthly_data', 'process_quarterly_data', 'process_BiAnnual_data', 'process_yearly_data')
+
+# Natural key of each aggregate collection
+NATURAL_KEYS = {
+    "cdata_month": ("company_code", "site_code", "internal_code_id", "type_year", "reporting_year", "month", "is_forecast"),
+    "cdata_quarter": ("company_code", "site_code", "internal_code_id", "type_year", "reporting_year", "quarter", "is_forecast"),
+    "cdata_bi_annual": ("company_code", "site_code", "internal_code_id", "type_year", "reporting_year", "semi_annual", "is_forecast"),
+    "cdata_yearly": ("company_code", "site_code", "internal_code_id", "type_year", "reporting_year", "is_forecast"),
+}
+IGNORED_FIELDS = {"_id", "created_at", "updated_at", "createdAt", "updatedAt"}
+
+
+def _number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.strip())
+        except ValueError:
+            return None
+    return None
+
+
+def values_equal(a: Any, b: Any, rel_tol: float, abs_tol: float, strict_types: bool) -> bool:
+    """Deep comparison with numeric tolerance (numbers stored as strings count as numbers)"""
+    if isinstance(a, dict) and isinstance(b, dict):
+        keys = (set(a) | set(b)) - IGNORED_FIELDS
+        return all(values_equal(a.get(k), b.get(k), rel_tol, abs_tol, strict_types) for k in keys)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(values_equal(x, y, rel_tol, abs_tol, strict_types) for x, y in zip(a, b))
+    if strict_types and type(a) is not type(b):
+        return False
+    x, y = _number(a), _number(b)
+    if x is not None and y is not None:
+        return math.isclose(x, y, rel_tol=rel_tol, abs_tol=abs_tol)
+    return str(a) == str(b) if not strict_types else a == b
+
+
+def _natural_key(doc: Dict[str, Any], fields: Tuple[str, ...]) -> Tuple:
+    # ids and years are stored as ObjectId or str and int or str depending on the writer
+    return tuple("" if doc.get(field) is None else str(doc.get(field)) for field in fields)
+
+
+def _sort_token(doc: Dict[str, Any]) -> str:
+    return json.dumps({k: v for k, v in doc.items() if k not in IGNORED_FIELDS}, sort_keys=True, default=str)
+
+
+def diff_collection(legacy: List[Dict], candidate: List[Dict], fields: Tuple[str, ...], rel_tol: float,
+                    abs_tol: float, strict_types: bool, max_examples: int) -> Dict[str, Any]:
+    """Compare two document lists as multisets grouped by natural key"""
+    def group(docs):
+        grouped: Dict[Tuple, List[Dict]] = {}
+        for doc in docs:
+            grouped.setdefault(_natural_key(doc, fields), []).append(doc)
+        for docs_for_key in grouped.values():
+            docs_for_key.sort(key=_sort_token)
+        return grouped
+
+    left, right = group(legacy), group(candidate)
+    result = {"legacy": len(legacy), "candidate": len(candidate), "missing": 0, "extra": 0, "mismatched": 0,
+              "examples": []}
+
+    def example(kind: str, key: Tuple, **details):
+        if len(result["examples"]) < max_examples:
+            result["examples"].append({"kind": kind, "key": dict(zip(fields, key)), **details})
+
+    for key in sorted(set(left) | set(right)):
+        ours, theirs = left.get(key, []), right.get(key, [])
+        for doc_a, doc_b in zip(ours, theirs):
+            differing = sorted(
+                field for field in (set(doc_a) | set(doc_b)) - IGNORED_FIELDS
+                if not values_equal(doc_a.get(field), doc_b.get(field), rel_tol, abs_tol, strict_types)
+            )
+            if differing:
+                result["mismatched"] += 1
+                example("mismatch", key, fields={f: [doc_a.get(f), doc_b.get(f)] for f in differing})
+        if len(ours) > len(theirs):
+            result["missing"] += len(ours) - len(theirs)
+            example("missing_in_candidate", key, count=len(ours) - len(theirs))
+        elif len(theirs) > len(ours):
+            result["extra"] += len(theirs) - len(ours)
+            example("extra_in_candidate", key, count=len(theirs) - len(ours))
+    result["equal"] = not (result["missing"] or result["extra"] or result["mismatched"])
+    return result
+
+
+def run_side(params: Dict[str, Any], mongodb_url: str, db_name: str, candidate: Optional[str]) -> Dict[str, Any]:
+    """Generate the dataset into db_name and aggregate it with the legacy or candidate processors"""
+    from pymongo import MongoClient
+    from synthetic_data import generate_dataset
+    from stub_api import StubCompanyAPI
+
+    client = MongoClient(mongodb_url)
+    client.drop_database(db_name)
+    manifest = generate_dataset(client[db_name], **params)
+
+    with StubCompanyAPI(manifest) as base_url:
+        os.environ.update({
+            "MONGODB_URL": mongodb_url,
+            "MONGODB_DB_NAME": db_name,
+            "COMPANY_DATA_URL": base_url,
+            "SITE_DATA_URL": base_url,
+            "COMPANY_CACHE_DIR": "",
+            "WORK_LEASES_ENABLED": "false",
+        })
+        import main as aggregation
+
+        replaced = []
+        if candidate:
+            engine = importlib.import_module(candidate)
+            for name in PROCESSOR_FUNCTIONS:
+                if hasattr(engine, name):
+                    setattr(aggregation, name, getattr(engine, name))
+                    replaced.append(name)
+        # One process: the scheduler's workers would re-import main without the replacements
+        outcome = aggregation.CompanyDataController(workers=1).process_company_data()
+    return {"success": bool(outcome.get("success")), "replaced": replaced, "counts": manifest["counts"]}
+
+
+def _run_side_subprocess(side: str, args, env_overrides: Dict[str, str]) -> Dict[str, Any]:
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as handle:
+        result_path = handle.name
+    params = {"companies": args.companies, "codes": args.codes, "sites": args.sites, "years": args.years,
+              "seed": args.seed, "hierarchy": args.hierarchy, "start_year": args.start_year}
+    command = [
+        sys.executable, os.path.abspath(__file__), "--run-side", side, "--side-params", json.dumps(params),
+        "--side-output", result_path, "--mongodb-url", args.mongodb_url, "--db", f"{args.db}_{side}",
+    ]
+    if side == "candidate" and args.candidate:
+        command += ["--candidate", args.candidate]
+    env = dict(os.environ, **env_overrides)
+    logger.info(f"Running {side} side in {args.db}_{side}")
+    proc = subprocess.run(command, env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    try:
+        if proc.returncode != 0:
+            raise RuntimeError(f"{side} run failed:\n{proc.stderr[-3000:]}")
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        os.unlink(result_path)
+
+
+def compare_databases(mongodb_url: str, legacy_db: str, candidate_db: str, rel_tol: float, abs_tol: float,
+                      strict_types: bool, skip_forecasts: bool, max_examples: int) -> Dict[str, Any]:
+    from pymongo import MongoClient
+
+    client = MongoClient(mongodb_url)
+    query = {"is_forecast": {"$ne": True}} if skip_forecasts else {}
+    collections = {}
+    for name, fields in NATURAL_KEYS.items():
+        collections[name] = diff_collection(
+            list(client[legacy_db][name].find(query)), list(client[candidate_db][name].find(query)),
+            fields, rel_tol, abs_tol, strict_types, max_examples
+        )
+    return collections
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Check that a candidate aggregation engine matches the legacy processors')
+    parser.add_argument('--candidate', help='Module defining replacement processor functions')
+    parser.add_argument('--candidate-env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Setting applied to the candidate run only (repeatable)')
+    parser.add_argument('--companies', type=int, default=3)
+    parser.add_argument('--codes', type=int, default=5)
+    parser.add_argument('--sites', type=int, default=3)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--start-year', type=int, default=datetime.now().year - 6)
+    parser.add_argument('--hierarchy', choices=['deep', 'flat', 'mixed'], default='mixed')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--rel-tol', type=float, default=1e-9)
+    parser.add_argument('--abs-tol', type=float, default=1e-6)
+    parser.add_argument('--strict-types', action='store_true', help='Also flag int vs str vs float differences')
+    parser.add_argument('--skip-forecasts', action='store_true', help='Compare actual rows only')
+    parser.add_argument('--max-examples', type=int, default=20, help='Differences listed per collection')
+    parser.add_argument('--keep', action='store_true', help='Keep both databases for inspection')
+    parser.add_argument('--mongodb-url', default=os.getenv("BENCHMARK_MONGODB_URL", "mongodb://localhost:27017"))
+    parser.add_argument('--db', default=os.getenv("BENCHMARK_DB_NAME", "aggregation_equivalence"))
+    parser.add_argument('--output', help='Write the JSON report to this file')
+    # Internal: run one side in this process
+    parser.add_argument('--run-side', help=argparse.SUPPRESS)
+    parser.add_argument('--side-params', help=argparse.SUPPRESS)
+    parser.add_argument('--side-output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_side:
+        result = run_side(json.loads(args.side_params), args.mongodb_url, args.db, args.candidate)
+        with open(args.side_output, 'w') as f:
+            json.dump(result, f)
+        return 0
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    if not args.candidate and not args.candidate_env:
+        parser.error("give --candidate and/or --candidate-env")
+    candidate_env = dict(item.split('=', 1) for item in args.candidate_env)
+
+    legacy = _run_side_subprocess("legacy", args, {})
+    candidate = _run_side_subprocess("candidate", args, candidate_env)
+    collections = compare_databases(
+        args.mongodb_url, f"{args.db}_legacy", f"{args.db}_candidate", args.rel_tol, args.abs_tol,
+        args.strict_types, args.skip_forecasts, args.max_examples
+    )
+    report = {
+        "equivalent": all(c["equal"] for c in collections.values()) and legacy["success"] == candidate["success"],
+        "candidate": {"module": args.candidate, "replaced": candidate["replaced"], "env": candidate_env},
+        "dataset": {"counts": legacy["counts"], "seed": args.seed, "start_year": args.start_year},
+        "runs": {"legacy": legacy["success"], "candidate": candidate["success"]},
+        "collections": collections,
+    }
+
+    if not args.keep:
+        from pymongo import MongoClient
+        client = MongoClient(args.mongodb_url)
+        for side in ("legacy", "candidate"):
+            client.drop_database(f"{args.db}_{side}")
+
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+    if not report["equivalent"]:
+        logger.error("Candidate output differs from the legacy processors")
+    return 0 if report["equivalent"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""
+Forecasting micro-benchmark for sarima.run_sarima.
+
+Sweeps series length, noise level and series shape for each processor
+profile (the m / predictedValue pairs the processors pass: monthly 12/35,
+quarterly 4/11, bi_annual 2/11, yearly 0/5). For every case it runs the full
+tournament --repeats times and records:
+
+- tournament wall time (min / median / max)
+- per-candidate fit time and outcome, from the ForecastRunReport
+- the selected model and method
+- stability: whether reruns give the same model and forecast, and how far
+  the forecast moves when the series is perturbed by --perturbation
+- the cost of a warm-started refit of the winner (sarima.refit_sarima)
+
+The summary adds forecast_telemetry.model_report for the whole sweep (time
+share and win rate per model). Pass an earlier report as --baseline to fail
+on tournament-time regressions.
+
+    python benchmarks/forecast_benchmark.py --profiles monthly,quarterly --lengths 12,24,48 --output forecast.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import metrics
+from forecast_telemetry import collect_report, model_report
+from sarima import _load_forecasting_stack, refit_sarima, run_sarima
+from warm_start import WARM_START_MODELS
+
+logger = logging.getLogger(__name__)
+
+# m and predictedValue as passed by the processors
+PROFILES = {
+    "monthly": {"m": 12, "horizon": 35, "period": 12},
+    "quarterly": {"m": 4, "horizon": 11, "period": 4},
+    "bi_annual": {"m": 2, "horizon": 11, "period": 2},
+    "yearly": {"m": 0, "horizon": 5, "period": 1},
+}
+
+
+def _seasonal(i: int, period: int) -> float:
+    return math.sin(2 * math.pi * i / period) if period > 1 else 0.0
+
+
+# Series shapes: f(index, period, rng, noise) -> value before the positivity floor
+PATTERNS: Dict[str, Callable[[int, int, random.Random, float], float]] = {
+    "seasonal": lambda i, p, rng, noise: 100 + 30 * _seasonal(i, p) + rng.gauss(0, noise * 100),
+    "trend": lambda i, p, rng, noise: 50 + 4 * i + rng.gauss(0, noise * 100),
+    "seasonal_trend": lambda i, p, rng, noise: 50 + 3 * i + 25 * _seasonal(i, p) + rng.gauss(0, noise * 100),
+    "flat": lambda i, p, rng, noise: 100 + rng.gauss(0, noise * 100),
+    "intermittent": lambda i, p, rng, noise: (rng.uniform(20, 200) if rng.random() < 0.4 else 0) * (1 + rng.gauss(0, noise)),
+    "repeating": lambda i, p, rng, noise: [40, 70, 55][i % 3],
+}
+
+
+def make_series(pattern: str, length: int, period: int, noise: float, seed: int) -> List[float]:
+    """Deterministic series of the given shape, rounded like cdata quantities"""
+    rng = random.Random(f"{seed}:{pattern}:{length}:{period}:{noise}")
+    return [round(max(0.0, PATTERNS[pattern](i, period, rng, noise)), 2) for i in range(length)]
+
+
+def _quiet(fn: Callable[..., Any], *args, **kwargs):
+    """run_sarima prints per model; keep it out of the report"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+
+def _relative_change(a: List[float], b: List[float]) -> Optional[float]:
+    if not a or not b or len(a) != len(b):
+        return None
+    scale = max(statistics.fmean(abs(x) for x in a), 1e-9)
+    return round(max(abs(x - y) for x, y in zip(a, b)) / scale, 6)
+
+
+def run_case(profile: str, pattern: str, length: int, noise: float, repeats: int, seed: int,
+             perturbation: float) -> Dict[str, Any]:
+    settings = PROFILES[profile]
+    series = make_series(pattern, length, settings["period"], noise, seed)
+    horizon, m = settings["horizon"], settings["m"]
+
+    runs = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        forecast, report = _quiet(collect_report, run_sarima, list(series), horizon, m=m)
+        runs.append({"seconds": time.perf_counter() - started, "forecast": list(forecast or []), "report": report or {}})
+
+    first = runs[0]
+    candidates: Dict[str, Dict[str, Any]] = {}
+    for run in runs:
+        for candidate in run["report"].get("candidates", []):
+            entry = candidates.setdefault(candidate["model"], {"seconds": [], "outcome": candidate["outcome"]})
+            entry["seconds"].append(candidate["duration_seconds"])
+            if candidate["outcome"] != entry["outcome"]:
+                entry["outcome"] = "inconsistent"
+    for entry in candidates.values():
+        entry["median_seconds"] = round(statistics.median(entry.pop("seconds")), 6)
+
+    # Stability: reruns on the same input, then a small relative perturbation of the input
+    selected = {run["report"].get("selected_model") for run in runs}
+    rerun_change = max((_relative_change(first["forecast"], run["forecast"]) or 0.0) for run in runs)
+    rng = random.Random(seed)
+    perturbed_series = [round(x * (1 + rng.uniform(-perturbation, perturbation)), 2) for x in series]
+    perturbed, perturbed_report = _quiet(collect_report, run_sarima, perturbed_series, horizon, m=m)
+
+    # Cost of refitting only the winner, as forecast_series does between tournaments
+    warm = None
+    winner = first["report"].get("selected_model")
+    if winner in WARM_START_MODELS:
+        model = {"name": winner, "params": first["report"].get("params"),
+                 "seasonality_period": first["report"].get("seasonality_period")}
+        started = time.perf_counter()
+        refit, refit_report = _quiet(collect_report, refit_sarima, list(series), model, horizon, m=m)
+        warm = {
+            "seconds": round(time.perf_counter() - started, 6),
+            "method": (refit_report or {}).get("method"),
+            "forecast_change": _relative_change(first["forecast"], list(refit or [])),
+        }
+
+    seconds = [run["seconds"] for run in runs]
+    return {
+        "profile": profile,
+        "pattern": pattern,
+        "length": length,
+        "noise": noise,
+        "m": m,
+        "horizon": horizon,
+        "tournament_seconds": {
+            "min": round(min(seconds), 6),
+            "median": round(statistics.median(seconds), 6),
+            "max": round(max(seconds), 6),
+        },
+        "selected_model": winner,
+        "method": first["report"].get("method"),
+        "seasonality_period": first["report"].get("seasonality_period"),
+        "candidates": dict(sorted(candidates.items(), key=lambda item: -item[1]["median_seconds"])),
+        "stability": {
+            "same_model_on_rerun": len(selected) == 1,
+            "rerun_forecast_change": rerun_change,
+            "perturbed_model": (perturbed_report or {}).get("selected_model"),
+            "perturbed_forecast_change": _relative_change(first["forecast"], list(perturbed or [])),
+        },
+        "warm_start": warm,
+    }
+
+
+def case_key(case: Dict[str, Any]) -> str:
+    return f"{case['profile']}/{case['pattern']}/{case['length']}/{case['noise']}"
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Cases whose median tournament time regressed by more than tolerance"""
+    previous = {case_key(case): case for case in baseline.get("cases", [])}
+    regressions = []
+    for case in results["cases"]:
+        old_case = previous.get(case_key(case))
+        if not old_case:
+            continue
+        old, new = old_case["tournament_seconds"]["median"], case["tournament_seconds"]["median"]
+        if old and new > old * (1 + tolerance):
+            regressions.append(f"{case_key(case)}: {old:.3f}s -> {new:.3f}s (+{(new / old - 1):.0%})")
+    return regressions
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark run_sarima across series shapes')
+    parser.add_argument('--profiles', default=','.join(PROFILES), help=f"Any of {', '.join(PROFILES)}")
+    parser.add_argument('--patterns', default=','.join(PATTERNS), help=f"Any of {', '.join(PATTERNS)}")
+    parser.add_argument('--lengths', default='6,12,24,48')
+    parser.add_argument('--noise', default='0.0,0.1,0.3', help='Noise levels (relative standard deviation)')
+    parser.add_argument('--repeats', type=int, default=3, help='Tournament runs per case')
+    parser.add_argument('--perturbation', type=float, default=0.01, help='Relative input perturbation for stability')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write the JSON report to this file')
+    parser.add_argument('--baseline', help='Earlier report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative regression')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    logger.setLevel(logging.INFO)
+    # Every run's report is in the output already
+    logging.getLogger("forecast_telemetry").setLevel(logging.WARNING)
+    # Keep the one-off import of the forecasting stack out of the first case's timings
+    _load_forecasting_stack()
+
+    since = metrics.snapshot()
+    started = time.perf_counter()
+    cases = []
+    for profile in args.profiles.split(','):
+        for pattern in args.patterns.split(','):
+            for length in (int(n) for n in args.lengths.split(',')):
+                for noise in (float(n) for n in args.noise.split(',')):
+                    case = run_case(profile, pattern, length, noise, args.repeats, args.seed, args.perturbation)
+                    logger.info(f"{case_key(case)}: {case['tournament_seconds']['median']:.3f}s, "
+                                f"{case['selected_model']} ({case['method']})")
+                    cases.append(case)
+
+    results = {
+        "benchmark": "forecast",
+        "commit": _git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "total_seconds": round(time.perf_counter() - started, 3),
+        "params": {"repeats": args.repeats, "perturbation": args.perturbation, "seed": args.seed},
+        "summary": {
+            "models": model_report(since=since),
+            "unstable_cases": [case_key(c) for c in cases if not c["stability"]["same_model_on_rerun"]],
+        },
+        "cases": cases,
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results["regressions"] = regressions
+        if regressions:
+            logger.error("Regressions against baseline:\n  " + "\n  ".join(regressions))
+            exit_code = 1
+
+    output = json.dumps(results, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
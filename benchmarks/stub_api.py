@@ -0,0 +1,84 @@
+"""
+Local stand-in for the upstream company and site APIs, serving a synthetic
+dataset manifest (see synthetic_data.generate_dataset):
+
+    GET /company/data              {"companies": [...]}
+    GET /company/data/<id>         {"data": {"company": {...}}}
+    GET /companies/<id>/sites      {"success": true, "code": 200, "data": [...]}
+
+    with StubCompanyAPI(manifest) as base_url:
+        os.environ["COMPANY_DATA_URL"] = base_url
+        os.environ["SITE_DATA_URL"] = base_url
+"""
+import json
+import logging
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class StubCompanyAPI:
+    def __init__(self, manifest: Dict[str, Any], host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        self.companies = {str(company['id']): company for company in manifest['companies']}
+        self.sites = manifest.get('sites', {})
+        self.latency = latency
+        self.requests = 0
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _response(self, path: str):
+        if path == "/company/data":
+            return 200, {"companies": list(self.companies.values())}
+        match = re.fullmatch(r"/company/data/(\w+)", path)
+        if match:
+            company = self.companies.get(match.group(1))
+            return (200, {"data": {"company": company}}) if company else (404, {"message": "not found"})
+        match = re.fullmatch(r"/companies/(\w+)/sites", path)
+        if match:
+            return 200, {"success": True, "code": 200, "data": self.sites.get(match.group(1), [])}
+        return 404, {"message": "not found"}
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                if stub.latency:
+                    threading.Event().wait(stub.latency)
+                status, body = stub._response(self.path.split('?')[0].rstrip('/'))
+                payload = json.dumps(body, default=str).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> str:
+        self._thread = threading.Thread(target=self._server.serve_forever, name="StubCompanyAPI", daemon=True)
+        self._thread.start()
+        logger.info(f"Stub company/site API listening on {self.base_url}")
+        return self.base_url
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> str:
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
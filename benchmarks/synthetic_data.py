@@ -0,0 +1,280 @@
+"""
+Deterministic synthetic dataset generator for benchmarks and load tests.
+
+Writes multi-tenant data into a (local) Mongo database in the shapes the
+processors and the rollup read:
+
+- codes: {_id, code, name, function} with sum / average / list functions
+- company_codes: {company_id, internal_code_id, category_id, site_code: [...]}
+- cdata: actuals with string type_year, is_aggregated flags, dimension arrays,
+  at monthly, quarterly, semi-annual or annual cadence per code, for the
+  company level (site_code "") and for every site
+
+and returns the company and site records the upstream APIs would serve
+(/company/data and /companies/<id>/sites), so benchmarks can stub them. Site
+lists come in the two shapes SiteDataRollup.fetch_site_data tells apart:
+"deep" trees (parentSiteCode pointing at listed sites) and "flat" lists
+(parents missing from the response). The same seed always produces the same
+documents, ids included.
+
+    python benchmarks/synthetic_data.py --companies 3 --codes 5 --sites 4 --years 3 --drop
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+          'November', 'December']
+QUARTERS = ['Q1', 'Q2', 'Q3', 'Q4']
+SEMESTERS = ['Semester1', 'Semester2']
+FUNCTIONS = ['sum', 'average', 'list']
+CADENCES = ['month', 'quarter', 'semi_annual', 'annual']
+FREQUENCY_SETS = ['month,quater,semi_annual,annual', 'month,quater', 'quater,annual', 'annual', 'month']
+UNITS = [('kWh', 'USD'), ('t', 'EUR'), ('m3', 'USD'), ('count', '')]
+DIMENSION_KEYS = {'fuel': ['diesel', 'petrol', 'gas'], 'scope': ['1', '2', '3'], 'region': ['north', 'south']}
+
+SYNTHETIC_COLLECTIONS = ['codes', 'company_codes', 'cdata']
+
+
+def _object_id(seed: int, *parts: Any) -> ObjectId:
+    """Stable ObjectId derived from the seed and a name"""
+    digest = hashlib.md5(":".join(str(p) for p in (seed,) + parts).encode("utf-8")).hexdigest()
+    return ObjectId(digest[:24])
+
+
+def build_site_list(rng: random.Random, company_id: int, sites: int, hierarchy: str) -> List[Dict]:
+    """
+    Flat site list as /companies/<id>/sites returns it.
+
+    deep: a tree under one root (each site's parent is an earlier site), up to 4 levels
+    flat: every site points at a parent that is not in the list
+    """
+    site_list = []
+    for index in range(sites):
+        code = f"S{company_id}-{index + 1:03d}"
+        if hierarchy == "flat":
+            parent = f"P{company_id}-EXT"
+        elif index == 0:
+            parent = None
+        else:
+            # Attach to one of the last few sites so the tree gets both depth and breadth
+            parent = site_list[rng.randrange(max(0, index - 3), index)]['internal_site_code']
+        ownership = rng.choice([100, 100, 80, 51, "60", "100"])
+        site_list.append({
+            'id': company_id * 1000 + index + 1,
+            'internal_site_code': code,
+            'name': f"Site {code}",
+            'parentSiteCode': parent,
+            'ownership': ownership,
+        })
+
+    if hierarchy == "deep":
+        # Keep the depth bounded: re-parent anything deeper than 4 levels to the root
+        depth = {}
+        for site in site_list:
+            parent = site['parentSiteCode']
+            depth[site['internal_site_code']] = 0 if parent is None else depth[parent] + 1
+            if depth[site['internal_site_code']] > 4:
+                site['parentSiteCode'] = site_list[0]['internal_site_code']
+                depth[site['internal_site_code']] = 1
+    return site_list
+
+
+def _dimension(rng: random.Random, unit: str, currency: str, qty: int, value: int) -> List[Dict]:
+    dimension = []
+    for _ in range(rng.randint(0, 2)):
+        key = rng.choice(list(DIMENSION_KEYS))
+        dimension.append({
+            'details': [{'key': key, 'value': rng.choice(DIMENSION_KEYS[key])}],
+            'unit': unit,
+            'currency': currency,
+            'key': key,
+            'value1': '',
+            'qty': qty // 2,
+            'value': value // 2,
+        })
+    return dimension
+
+
+def _series_value(rng: random.Random, base: float, period_index: int, periods_per_year: int, noise: float) -> int:
+    """Trend + seasonality + noise, always positive"""
+    seasonal = 0.2 * base * ((period_index % periods_per_year) / max(periods_per_year - 1, 1) - 0.5)
+    trend = 0.01 * base * period_index
+    return max(1, int(base + seasonal + trend + rng.gauss(0, noise * base)))
+
+
+def _cdata_rows(rng: random.Random, company_id: str, internal_code_id: ObjectId, site_code: str, cadence: str,
+                start_year: int, years: int, base: float, noise: float, aggregated_fraction: float,
+                unit: str, currency: str) -> List[Dict]:
+    if cadence == 'month':
+        periods = [('month', m) for m in MONTHS]
+    elif cadence == 'quarter':
+        periods = [('quarter', q) for q in QUARTERS]
+    elif cadence == 'semi_annual':
+        periods = [('semi_annual', s) for s in SEMESTERS]
+    else:
+        periods = [(None, None)]
+
+    rows = []
+    index = 0
+    for year in range(start_year, start_year + years):
+        for field, period in periods:
+            qty = _series_value(rng, base, index, len(periods), noise)
+            value = qty * rng.randint(2, 9)
+            row = {
+                'company_code': company_id,
+                'internal_code_id': internal_code_id,
+                'site_code': site_code,
+                'type': 'actual',
+                'type_year': str(year),
+                'month': '',
+                'quarter': '',
+                'semi_annual': '',
+                # The API stores qty as entered: sometimes a string
+                'qty': str(qty) if rng.random() < 0.3 else qty,
+                'value': value,
+                'unit': unit,
+                'currency': currency,
+                'dimension': _dimension(rng, unit, currency, qty, value),
+                'narration': rng.choice(['', 'meter reading', 'invoice']),
+                'url': '',
+                'is_aggregated': rng.random() < aggregated_fraction,
+                'createdAt': datetime(year, 1, 1),
+            }
+            if field:
+                row[field] = period
+            rows.append(row)
+            index += 1
+    return rows
+
+
+def generate_dataset(db, companies: int = 3, codes: int = 5, sites: int = 4, years: int = 3,
+                     start_year: Optional[int] = None, seed: int = 42, hierarchy: str = "mixed",
+                     noise: float = 0.1, aggregated_fraction: float = 0.0, first_company_id: int = 9001,
+                     drop: bool = False) -> Dict[str, Any]:
+    """
+    Write a synthetic dataset into db and return its manifest:
+    {"companies": [...], "sites": {company_id: [...]}, "counts": {...}, "params": {...}}
+
+    hierarchy: "deep", "flat" or "mixed" (alternating per company)
+    aggregated_fraction: share of cdata rows already marked is_aggregated
+    """
+    rng = random.Random(seed)
+    start_year = start_year or datetime.now().year - years
+    params = {
+        "companies": companies, "codes": codes, "sites": sites, "years": years, "start_year": start_year,
+        "seed": seed, "hierarchy": hierarchy, "noise": noise, "aggregated_fraction": aggregated_fraction,
+    }
+
+    if drop:
+        for name in SYNTHETIC_COLLECTIONS:
+            db[name].drop()
+
+    code_docs = []
+    for index in range(codes):
+        code_docs.append({
+            '_id': _object_id(seed, 'code', index),
+            'code': f"C{index + 1:04d}",
+            'name': f"Synthetic code {index + 1}",
+            'function': FUNCTIONS[index % len(FUNCTIONS)],
+            # Which cadence this code's actuals are entered at
+            'cadence': CADENCES[index % len(CADENCES)],
+        })
+    db['codes'].insert_many([{k: v for k, v in doc.items() if k != 'cadence'} for doc in code_docs])
+
+    company_records, site_lists = [], {}
+    company_code_docs, cdata_docs = [], []
+    for company_index in range(companies):
+        company_id = first_company_id + company_index
+        shape = hierarchy if hierarchy != "mixed" else ("deep" if company_index % 2 == 0 else "flat")
+        site_list = build_site_list(rng, company_id, sites, shape)
+        site_lists[str(company_id)] = site_list
+        company_records.append({
+            'id': company_id,
+            'company_name': f"Synthetic Company {company_id}",
+            'reporting_frequency': FREQUENCY_SETS[company_index % len(FREQUENCY_SETS)],
+            # Alternate calendar and fiscal years so the reporting_year arithmetic is exercised
+            'month': 'January' if company_index % 2 == 0 else rng.choice(['April', 'July', 'October']),
+            'company_sites': [{'internal_site_code': site['internal_site_code']} for site in site_list],
+        })
+
+        for code in code_docs:
+            unit, currency = rng.choice(UNITS)
+            company_code_docs.append({
+                'company_id': str(company_id),
+                'internal_code_id': code['_id'],
+                'category_id': _object_id(seed, 'category', code['_id']),
+                'isChecked': True,
+                'site_code': [site['internal_site_code'] for site in site_list],
+                'createdAt': datetime(start_year, 1, 1),
+                'updatedAt': datetime(start_year, 1, 1),
+            })
+            base = rng.uniform(50, 5000)
+            for site_code in [""] + [site['internal_site_code'] for site in site_list]:
+                cdata_docs.extend(_cdata_rows(
+                    rng, str(company_id), code['_id'], site_code, code['cadence'], start_year, years,
+                    base * rng.uniform(0.2, 1.0), noise, aggregated_fraction, unit, currency
+                ))
+
+    # Stable _ids too, so runs on the same seed can be compared document by document
+    for number, doc in enumerate(company_code_docs):
+        doc['_id'] = _object_id(seed, 'company_code', number)
+    for number, doc in enumerate(cdata_docs):
+        doc['_id'] = _object_id(seed, 'cdata', number)
+
+    if company_code_docs:
+        db['company_codes'].insert_many(company_code_docs)
+    for start in range(0, len(cdata_docs), 5000):
+        db['cdata'].insert_many(cdata_docs[start:start + 5000])
+
+    counts = {"codes": len(code_docs), "company_codes": len(company_code_docs), "cdata": len(cdata_docs),
+              "sites": sum(len(s) for s in site_lists.values())}
+    logger.info(f"Generated synthetic dataset (seed {seed}): {counts}")
+    return {"companies": company_records, "sites": site_lists, "counts": counts, "params": params}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Write a deterministic synthetic dataset into MongoDB')
+    parser.add_argument('--companies', type=int, default=3)
+    parser.add_argument('--codes', type=int, default=5)
+    parser.add_argument('--sites', type=int, default=4)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--start-year', type=int)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--hierarchy', choices=['deep', 'flat', 'mixed'], default='mixed')
+    parser.add_argument('--aggregated-fraction', type=float, default=0.0)
+    parser.add_argument('--mongodb-url', default=os.getenv("MONGODB_URL", "mongodb://localhost:27017"))
+    parser.add_argument('--db', default=os.getenv("BENCHMARK_DB_NAME", "aggregation_benchmark"))
+    parser.add_argument('--drop', action='store_true', help='Drop the synthetic collections first')
+    parser.add_argument('--manifest', help='Write the company/site manifest to this JSON file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db = MongoClient(args.mongodb_url)[args.db]
+    manifest = generate_dataset(
+        db, companies=args.companies, codes=args.codes, sites=args.sites, years=args.years,
+        start_year=args.start_year, seed=args.seed, hierarchy=args.hierarchy,
+        aggregated_fraction=args.aggregated_fraction, drop=args.drop
+    )
+    if args.manifest:
+        with open(args.manifest, 'w') as f:
+            json.dump(manifest, f, indent=2, default=str)
+    print(json.dumps(manifest["counts"]))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
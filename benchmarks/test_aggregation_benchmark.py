@@ -0,0 +1,30 @@
+from aggregation_benchmark import compare
+
+
+def _results(aggregation_rss, rollup_rss, children_rss=0.0):
+    return {"cases": [{
+        "name": "small", "params": {"companies": 2},
+        "aggregation": {"wall_seconds": 1.0, "peak_rss_mb": aggregation_rss, "peak_children_rss_mb": children_rss},
+        "rollup": {"wall_seconds": 1.0, "peak_rss_mb": rollup_rss, "peak_children_rss_mb": 0.0},
+    }]}
+
+
+def test_peak_rss_is_compared_per_stage():
+    baseline = _results(aggregation_rss=500.0, rollup_rss=100.0)
+    assert compare(_results(aggregation_rss=500.0, rollup_rss=110.0), baseline, 0.25) == []
+    assert compare(_results(aggregation_rss=500.0, rollup_rss=200.0), baseline, 0.25) == [
+        "small.rollup.peak_rss_mb: 100.0 -> 200.0 (+100%)"
+    ]
+
+
+def test_children_peak_is_compared_separately():
+    baseline = _results(aggregation_rss=500.0, rollup_rss=100.0, children_rss=300.0)
+    regressions = compare(_results(aggregation_rss=500.0, rollup_rss=100.0, children_rss=600.0), baseline, 0.25)
+    assert regressions == ["small.aggregation.peak_children_rss_mb: 300.0 -> 600.0 (+100%)"]
+
+
+def test_cases_with_other_params_are_not_compared():
+    baseline = _results(aggregation_rss=100.0, rollup_rss=100.0)
+    baseline["cases"][0]["params"] = {"companies": 4}
+    assert compare(_results(aggregation_rss=900.0, rollup_rss=900.0), baseline, 0.25) == []
+
@@ -0,0 +1,54 @@
+from bson import ObjectId
+
+from equivalence_harness import NATURAL_KEYS, diff_collection, values_equal
+
+FIELDS = NATURAL_KEYS["cdata_yearly"]
+CODE = ObjectId("64b000000000000000000001")
+
+
+def _row(qty, site="S1", type_year="2023", **extra):
+    return {"company_code": "9001", "site_code": site, "internal_code_id": CODE, "type_year": type_year,
+            "reporting_year": "2023", "is_forecast": False, "qty": qty, **extra}
+
+
+def test_numbers_match_across_representations_within_tolerance():
+    assert values_equal("10", 10.0, 1e-9, 1e-6, strict_types=False)
+    assert values_equal(1.0, 1.0 + 1e-12, 1e-9, 1e-6, strict_types=False)
+    assert not values_equal(1.0, 1.1, 1e-9, 1e-6, strict_types=False)
+    assert not values_equal("10", 10.0, 1e-9, 1e-6, strict_types=True)
+
+
+def test_nested_values_ignore_ids_and_timestamps():
+    a = {"_id": 1, "updated_at": "yesterday", "dimensions": [{"qty": "2"}]}
+    b = {"_id": 2, "updated_at": "today", "dimensions": [{"qty": 2}]}
+    assert values_equal(a, b, 1e-9, 1e-6, strict_types=False)
+    assert not values_equal({"dimensions": [1, 2]}, {"dimensions": [1]}, 1e-9, 1e-6, strict_types=False)
+
+
+def test_diff_matches_documents_by_natural_key():
+    legacy = [_row("5", _id=1), _row("7", site="S2", _id=2)]
+    candidate = [_row(7.0, site="S2", _id=10), _row(5.0, type_year=2023, _id=11)]
+    result = diff_collection(legacy, candidate, FIELDS, 1e-9, 1e-6, strict_types=False, max_examples=5)
+    assert result["equal"]
+    assert (result["missing"], result["extra"], result["mismatched"]) == (0, 0, 0)
+
+
+def test_diff_reports_missing_extra_and_mismatched_rows():
+    legacy = [_row("5"), _row("7", site="S2"), _row("1", site="S3")]
+    candidate = [_row("6"), _row("7", site="S2"), _row("7", site="S2"), _row("1", site="S4")]
+    result = diff_collection(legacy, candidate, FIELDS, 1e-9, 1e-6, strict_types=False, max_examples=10)
+    assert not result["equal"]
+    assert result["mismatched"] == 1
+    assert result["missing"] == 1
+    assert result["extra"] == 2
+    kinds = sorted(example["kind"] for example in result["examples"])
+    assert kinds == ["extra_in_candidate", "extra_in_candidate", "mismatch", "missing_in_candidate"]
+    mismatch = next(e for e in result["examples"] if e["kind"] == "mismatch")
+    assert mismatch["fields"] == {"qty": ["5", "6"]}
+
+
+def test_diff_caps_examples():
+    legacy = [_row(str(i), site=f"S{i}") for i in range(5)]
+    result = diff_collection(legacy, [], FIELDS, 1e-9, 1e-6, strict_types=False, max_examples=2)
+    assert result["missing"] == 5
+    assert len(result["examples"]) == 2
@@ -0,0 +1,271 @@
+"""
+Near-real-time aggregation worker driven by a MongoDB change stream on cdata.
+
+The worker tails inserts/updates of cdata rows that are still dirty
+(is_aggregated = False), debounces and coalesces them per
+(company, code, site) and then runs an incremental re-aggregation of that
+code (CompanyDataController.process_company_code) followed by the rollup of
+the code. The resume token is checkpointed in Mongo after each batch, so a
+restarted worker continues where it stopped.
+
+A key that fails (a processor error, or a company or site the API cannot
+resolve) is retried after CHANGE_STREAM_RETRY_SECONDS, and the checkpoint
+stays behind its first change until it succeeds. After CHANGE_STREAM_MAX_ATTEMPTS attempts it is
+written to the change_stream_failures collection and dropped; its rows stay
+dirty, so the next batch run aggregates them.
+
+Change streams need a replica set. For local testing a single-node replica
+set is enough:
+
+    mongod --replSet rs0 --dbpath /tmp/rs0 --port 27017
+    mongosh --eval 'rs.initiate()'
+    MONGODB_URL=mongodb://localhost:27017/?replicaSet=rs0 python change_stream_worker.py
+
+Run with run_change_stream_worker.sh.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from collections import deque
+from datetime import date, datetime
+from typing import Any, Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+import db_connection
+import main
+from RegionAPI import get_company_by_id
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), './rollup')))
+import rollcontroller
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+CHANGE_STREAM_NAME = os.getenv("CHANGE_STREAM_NAME", "cdata-aggregation")
+CHANGE_STREAM_CHECKPOINTS = os.getenv("CHANGE_STREAM_CHECKPOINTS", "change_stream_checkpoints")
+# Quiet period after the last change of a key before it is processed
+CHANGE_STREAM_DEBOUNCE_SECONDS = float(os.getenv("CHANGE_STREAM_DEBOUNCE_SECONDS", "2"))
+# Upper bound on how long a continuously changing key may be held back
+CHANGE_STREAM_MAX_WAIT_SECONDS = float(os.getenv("CHANGE_STREAM_MAX_WAIT_SECONDS", "30"))
+CHANGE_STREAM_ROLLUP = os.getenv("CHANGE_STREAM_ROLLUP", "true").lower() in ("1", "true", "yes")
+# Failed keys: delay before the next attempt (times the attempt number), attempts before giving up
+CHANGE_STREAM_RETRY_SECONDS = float(os.getenv("CHANGE_STREAM_RETRY_SECONDS", "10"))
+CHANGE_STREAM_MAX_ATTEMPTS = int(os.getenv("CHANGE_STREAM_MAX_ATTEMPTS", "5"))
+CHANGE_STREAM_FAILURES = os.getenv("CHANGE_STREAM_FAILURES", "change_stream_failures")
+
+# Only rows that still need aggregating; the processors' own is_aggregated=True updates are ignored
+CDATA_PIPELINE = [
+    {"$match": {
+        "operationType": {"$in": ["insert", "update", "replace"]},
+        "fullDocument.is_aggregated": False,
+    }}
+]
+
+ChangeKey = Tuple[str, str, str]
+
+
+class KeyNotProcessed(Exception):
+    """A key whose changes were not (fully) aggregated; it is retried"""
+
+
+class ChangeCoalescer:
+    """Debounce changes per (company, code, site) and track the safe resume token"""
+
+    def __init__(self, debounce: float = CHANGE_STREAM_DEBOUNCE_SECONDS, max_wait: float = CHANGE_STREAM_MAX_WAIT_SECONDS,
+                 retry_delay: float = CHANGE_STREAM_RETRY_SECONDS):
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.retry_delay = retry_delay
+        self.pending: Dict[ChangeKey, Dict[str, Any]] = {}
+        self._tokens = deque()
+        self._seq = 0
+
+    def add(self, key: ChangeKey, resume_token: Any, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        self._seq += 1
+        self._tokens.append((self._seq, resume_token))
+        entry = self.pending.get(key)
+        if entry is None:
+            self.pending[key] = {"first_seen": now, "last_seen": now, "first_seq": self._seq, "changes": 1, "attempts": 0}
+        else:
+            entry["last_seen"] = now
+            entry["changes"] += 1
+
+    def due(self, now: Optional[float] = None) -> Dict[ChangeKey, Dict[str, Any]]:
+        """Remove and return the keys that are quiet (or waited long enough)"""
+        now = time.monotonic() if now is None else now
+        ready = {
+            key: entry for key, entry in self.pending.items()
+            if now >= entry.get("retry_at", now) and
+            (now - entry["last_seen"] >= self.debounce or now - entry["first_seen"] >= self.max_wait)
+        }
+        for key in ready:
+            del self.pending[key]
+        return ready
+
+    def retry(self, key: ChangeKey, entry: Dict[str, Any], now: Optional[float] = None) -> None:
+        """Put a failed key back; it keeps its first change, so the checkpoint cannot pass it"""
+        now = time.monotonic() if now is None else now
+        entry = dict(entry, attempts=entry.get("attempts", 0) + 1)
+        entry["retry_at"] = now + self.retry_delay * entry["attempts"]
+        newer = self.pending.get(key)
+        if newer is not None:
+            # Changed again while it was being processed
+            entry["last_seen"] = newer["last_seen"]
+            entry["changes"] += newer["changes"]
+        self.pending[key] = entry
+
+    def checkpoint_token(self) -> Any:
+        """Newest resume token whose events are all processed (None if it did not move)"""
+        safe_seq = min((e["first_seq"] for e in self.pending.values()), default=self._seq + 1) - 1
+        token = None
+        while self._tokens and self._tokens[0][0] <= safe_seq:
+            token = self._tokens.popleft()[1]
+        return token
+
+
+class ChangeStreamWorker:
+    def __init__(self, coalescer: Optional[ChangeCoalescer] = None, rollup: bool = CHANGE_STREAM_ROLLUP):
+        self.connection = db_connection.connect_to_database()
+        self.cdata_collection = self.connection["cdata"]
+        self.checkpoints = self.connection[CHANGE_STREAM_CHECKPOINTS]
+        self.failures = self.connection[CHANGE_STREAM_FAILURES]
+        self.coalescer = coalescer or ChangeCoalescer()
+        self.rollup = rollup
+        self.controller = main.CompanyDataController(workers=1, incremental=True)
+        self.rollup_controller = rollcontroller.SiteDataRollup() if rollup else None
+
+    def load_resume_token(self) -> Optional[Any]:
+        checkpoint = self.checkpoints.find_one({"_id": CHANGE_STREAM_NAME})
+        return checkpoint.get("resume_token") if checkpoint else None
+
+    def save_resume_token(self, resume_token: Any) -> None:
+        self.checkpoints.update_one(
+            {"_id": CHANGE_STREAM_NAME},
+            {"$set": {"resume_token": resume_token, "updated_at": datetime.now()}},
+            upsert=True
+        )
+
+    @staticmethod
+    def change_key(change: Dict) -> Optional[ChangeKey]:
+        document = change.get("fullDocument") or {}
+        if not document.get("company_code") or not document.get("internal_code_id"):
+            return None
+        return str(document["company_code"]), str(document["internal_code_id"]), str(document.get("site_code", ""))
+
+    def process_key(self, key: ChangeKey, entry: Dict[str, Any]) -> None:
+        """Re-aggregate one key; raises KeyNotProcessed unless every frequency was aggregated"""
+        company_id, internal_code_id, site_code = key
+        company = get_company_by_id(company_id)
+        if not company:
+            raise KeyNotProcessed(f"company {company_id} not found")
+        if site_code and site_code not in {s.get('internal_site_code') for s in company.get('company_sites', [])}:
+            raise KeyNotProcessed(f"site {site_code} is not a site of company {company_id}")
+
+        started = time.monotonic()
+        site_codes = [site_code] if site_code else []
+        result = self.controller.process_company_code(company, internal_code_id, site_codes=site_codes)
+        statuses = [r.get('status') for r in result['frequency_results']]
+        logger.info(f"Re-aggregated company {company_id}, code {internal_code_id}, site '{site_code}' "
+                    f"({entry['changes']} change(s)) in {time.monotonic() - started:.2f}s: {statuses}")
+        if not statuses:
+            raise KeyNotProcessed(f"company {company_id} has no valid reporting frequency")
+        errors = [r.get('error', '') for r in result['frequency_results'] if r.get('status') == 'error']
+        if errors:
+            raise KeyNotProcessed(f"aggregation failed: {'; '.join(errors)}")
+
+        if self.rollup_controller is not None:
+            self._rollup_code(company, company_id, internal_code_id)
+
+    def _rollup_code(self, company: Dict, company_id: str, internal_code_id: str) -> None:
+        year = date.today().year - 6
+        frequencies = self.rollup_controller._get_reporting_frequencies(company)
+        is_reporting_next = False if len(frequencies) == 4 else True
+        errors = []
+        for freq in frequencies:
+            # start_month is not used by the rollup frequencies
+            result = self.rollup_controller._process_frequency(
+                company, company_id, internal_code_id, freq, year, 'January', is_reporting_next
+            )
+            if result.get('status') == 'error':
+                errors.append(result.get('error', ''))
+        if errors:
+            raise KeyNotProcessed(f"rollup failed: {'; '.join(errors)}")
+
+    def flush(self, now: Optional[float] = None) -> int:
+        """Process the due keys and checkpoint; returns the number of keys processed"""
+        ready = self.coalescer.due(now)
+        for key, entry in ready.items():
+            try:
+                self.process_key(key, entry)
+                continue
+            except Exception as e:
+                logger.error(f"Error re-aggregating {key}: {str(e)}")
+                error = str(e)
+            self._retry_or_give_up(key, entry, error, now)
+
+        token = self.coalescer.checkpoint_token()
+        if token is not None:
+            self.save_resume_token(token)
+        return len(ready)
+
+    def _retry_or_give_up(self, key: ChangeKey, entry: Dict[str, Any], error: str, now: Optional[float]) -> None:
+        attempts = entry.get("attempts", 0) + 1
+        if attempts < CHANGE_STREAM_MAX_ATTEMPTS:
+            self.coalescer.retry(key, entry, now)
+            return
+        # The rows stay dirty, so the next batch run picks them up again
+        logger.error(f"Giving up on {key} after {attempts} attempt(s): {error}")
+        company_id, internal_code_id, site_code = key
+        self.failures.update_one(
+            {"_id": ":".join(key)},
+            {"$set": {"company_code": company_id, "internal_code_id": internal_code_id, "site_code": site_code,
+                      "error": error, "attempts": attempts, "failed_at": datetime.now()},
+             "$inc": {"changes": entry["changes"]}},
+            upsert=True
+        )
+
+    def run(self, idle_exit: Optional[float] = None) -> None:
+        """Tail the change stream until interrupted (or idle for idle_exit seconds)"""
+        resume_token = self.load_resume_token()
+        logger.info(f"Watching cdata (resume token: {'yes' if resume_token else 'none'})")
+        last_activity = time.monotonic()
+
+        with self.cdata_collection.watch(CDATA_PIPELINE, full_document="updateLookup",
+                                         resume_after=resume_token) as stream:
+            while stream.alive:
+                change = stream.try_next()
+                if change is not None:
+                    key = self.change_key(change)
+                    if key:
+                        self.coalescer.add(key, stream.resume_token)
+                    last_activity = time.monotonic()
+
+                if self.flush():
+                    last_activity = time.monotonic()
+                elif change is None:
+                    if (idle_exit is not None and not self.coalescer.pending and
+                            time.monotonic() - last_activity >= idle_exit):
+                        logger.info("Idle, exiting")
+                        return
+                    time.sleep(0.2)
+
+
+def main_worker() -> None:
+    parser = argparse.ArgumentParser(description='Tail cdata changes and re-aggregate them incrementally.')
+    parser.add_argument('--no-rollup', action='store_true', help='Only aggregate, do not trigger the rollup')
+    parser.add_argument('--idle-exit', type=float, help='Exit after this many idle seconds (for tests)')
+    args = parser.parse_args()
+
+    worker = ChangeStreamWorker(rollup=CHANGE_STREAM_ROLLUP and not args.no_rollup)
+    try:
+        worker.run(idle_exit=args.idle_exit)
+    except KeyboardInterrupt:
+        logger.info("Stopped")
+
+
+if __name__ == "__main__":
+    main_worker()
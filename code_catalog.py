@@ -0,0 +1,181 @@
+"""
+Process-wide cache of the codes collection.
+
+The processors resolve code / name / function for every row they write.
+Instead of querying codes per processor call and scanning the result per row,
+the catalog loads the whole collection once into an _id -> document dict and
+serves lookups from memory:
+
+- entries are reloaded in bulk once CODE_CATALOG_TTL seconds have passed
+- an id that is not in the catalog (a code created since the last load) is
+  fetched individually, and remembered as missing until the next reload
+- with CODE_CATALOG_WATCH=true a change stream on codes (replica set only)
+  applies inserts, updates and deletes as they happen; the TTL reload resumes
+  if the stream stops
+
+There is one catalog per database, shared by all threads. Returned documents
+are shared as well and must not be modified.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from dotenv import load_dotenv
+from pymongo.errors import PyMongoError
+
+import db_connection
+import metrics
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+CODE_CATALOG_TTL = float(os.getenv("CODE_CATALOG_TTL", "300"))
+CODE_CATALOG_WATCH = os.getenv("CODE_CATALOG_WATCH", "false").lower() in ("1", "true", "yes")
+CODES_COLLECTION = "codes"
+# Fields the processors read from a code
+CODE_FIELDS = {"code": 1, "name": 1, "function": 1}
+
+_catalogs: Dict[str, "CodeCatalog"] = {}
+_catalogs_lock = threading.Lock()
+
+
+def _as_object_id(code_id: Any) -> Optional[ObjectId]:
+    if isinstance(code_id, ObjectId):
+        return code_id
+    try:
+        return ObjectId(code_id)
+    except (InvalidId, TypeError):
+        return None
+
+
+class CodeCatalog:
+    """_id -> {code, name, function} for one codes collection"""
+
+    def __init__(self, collection, ttl: float = CODE_CATALOG_TTL):
+        self.collection = collection
+        self.ttl = ttl
+        self._codes: Dict[ObjectId, Dict[str, Any]] = {}
+        self._missing: set = set()
+        self._loaded_at: Optional[float] = None
+        self._watching = False
+        self._watcher: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def _fresh(self) -> bool:
+        if self._loaded_at is None:
+            return False
+        return self._watching or time.monotonic() - self._loaded_at < self.ttl
+
+    def refresh(self) -> int:
+        """Reload all codes; returns how many were loaded"""
+        codes = {doc["_id"]: doc for doc in self.collection.find({}, CODE_FIELDS)}
+        with self._lock:
+            # Swap the whole dict so readers never see a partly loaded catalog
+            self._codes = codes
+            self._missing = set()
+            self._loaded_at = time.monotonic()
+        metrics.inc("code_catalog_refreshes_total")
+        logger.debug(f"Loaded {len(codes)} codes into the code catalog")
+        return len(codes)
+
+    def _ensure_loaded(self) -> None:
+        if self._fresh():
+            return
+        with self._refresh_lock:
+            # Another thread may have reloaded while this one waited
+            if not self._fresh():
+                self.refresh()
+
+    def get(self, code_id: Any) -> Optional[Dict[str, Any]]:
+        """The code document for an _id (ObjectId or its string form), None if there is none"""
+        object_id = _as_object_id(code_id)
+        if object_id is None:
+            return None
+        self._ensure_loaded()
+        code = self._codes.get(object_id)
+        if code is None and object_id not in self._missing:
+            metrics.inc("code_catalog_misses_total")
+            code = self.collection.find_one({"_id": object_id}, CODE_FIELDS)
+            with self._lock:
+                if code is not None:
+                    self._codes[object_id] = code
+                else:
+                    self._missing.add(object_id)
+        return code
+
+    def get_many(self, code_ids: Iterable[Any]) -> List[Dict[str, Any]]:
+        """Documents of the given ids that exist, without duplicates"""
+        codes, seen = [], set()
+        for code_id in code_ids:
+            code = self.get(code_id)
+            if code is not None and code["_id"] not in seen:
+                seen.add(code["_id"])
+                codes.append(code)
+        return codes
+
+    def invalidate(self) -> None:
+        """Reload on the next lookup"""
+        with self._lock:
+            self._loaded_at = None
+
+    def watch(self) -> None:
+        """Apply changes to codes from a change stream in a background thread"""
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+        self._watcher = threading.Thread(target=self._watch, name="CodeCatalogWatcher", daemon=True)
+        self._watcher.start()
+
+    def _watch(self) -> None:
+        try:
+            with self.collection.watch(full_document="updateLookup") as stream:
+                # Everything up to the stream's start is covered by a fresh load
+                self.refresh()
+                self._watching = True
+                for change in stream:
+                    self._apply(change)
+        except PyMongoError as e:
+            logger.warning(f"Code catalog change stream stopped, using TTL refresh: {str(e)}")
+        finally:
+            self._watching = False
+
+    def _apply(self, change: Dict[str, Any]) -> None:
+        operation = change.get("operationType")
+        code_id = change.get("documentKey", {}).get("_id")
+        with self._lock:
+            if operation in ("insert", "update", "replace") and change.get("fullDocument"):
+                document = change["fullDocument"]
+                self._codes[code_id] = {key: value for key, value in document.items() if key == "_id" or key in CODE_FIELDS}
+                self._missing.discard(code_id)
+            elif operation == "delete":
+                self._codes.pop(code_id, None)
+            else:
+                # drop / rename / invalidate: start over from a full load
+                self._loaded_at = None
+
+
+def get_code_catalog(connection=None) -> CodeCatalog:
+    """The shared catalog for a database (db_connection's database by default)"""
+    if connection is None:
+        connection = db_connection.connect_to_database()
+    with _catalogs_lock:
+        catalog = _catalogs.get(connection.name)
+        if catalog is None:
+            catalog = CodeCatalog(connection[CODES_COLLECTION])
+            _catalogs[connection.name] = catalog
+            if CODE_CATALOG_WATCH:
+                catalog.watch()
+        return catalog
+
+
+def invalidate_code_catalogs() -> None:
+    """Force a reload of every catalog, e.g. after a bulk import into codes"""
+    with _catalogs_lock:
+        catalogs = list(_catalogs.values())
+    for catalog in catalogs:
+        catalog.invalidate()
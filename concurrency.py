@@ -0,0 +1,309 @@
+"""
+Concurrency controller for per-company code processing.
+
+I/O-bound work (the per-code Mongo reads and writes) and CPU-bound work
+(forecasting) run on separate executors with separate limits:
+
+- the I/O executor is sized from AGG_IO_WORKERS, the Mongo connection pool
+  (maxPoolSize) and the number of codes; an AIMD limiter inside it backs off
+  when Mongo command latency rises above its observed baseline and grows back
+  by one slot at a time while latency stays healthy;
+- the CPU executor (process or thread pool, AGG_CPU_EXECUTOR) is sized from
+  AGG_CPU_WORKERS / the CPU count and runs run_sarima through run_forecast.
+  A code waiting on a forecast gives its I/O slot back for that time, and a
+  process pool that broke (a worker died) is recreated for the next call.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+from dotenv import load_dotenv
+from pymongo import monitoring
+
+import metrics
+import profiling
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+AGG_IO_WORKERS = int(os.getenv("AGG_IO_WORKERS", "32"))
+AGG_IO_MIN_WORKERS = int(os.getenv("AGG_IO_MIN_WORKERS", "2"))
+# Fraction of the Mongo connection pool code processing may use (the rest is left to the API, jobs, rollups)
+AGG_MONGO_POOL_SHARE = float(os.getenv("AGG_MONGO_POOL_SHARE", "0.5"))
+AGG_CPU_EXECUTOR = os.getenv("AGG_CPU_EXECUTOR", "process")  # "process", "thread" or "inline"
+AGG_CPU_WORKERS = int(os.getenv("AGG_CPU_WORKERS", str(os.cpu_count() or 1)))
+# Back off when the recent average command latency exceeds baseline x tolerance
+AGG_LATENCY_TOLERANCE = float(os.getenv("AGG_LATENCY_TOLERANCE", "2.0"))
+AGG_LATENCY_WINDOW = int(os.getenv("AGG_LATENCY_WINDOW", "200"))
+
+
+class _CommandLatencyListener(monitoring.CommandListener):
+    """Feeds Mongo command durations to the active limiters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limiters = []
+
+    def attach(self, limiter: "AdaptiveLimiter") -> None:
+        with self._lock:
+            self._limiters.append(limiter)
+
+    def detach(self, limiter: "AdaptiveLimiter") -> None:
+        with self._lock:
+            if limiter in self._limiters:
+                self._limiters.remove(limiter)
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event.duration_micros / 1000.0)
+
+    def failed(self, event):
+        self._record(event.duration_micros / 1000.0)
+
+    def _record(self, latency_ms: float) -> None:
+        with self._lock:
+            limiters = list(self._limiters)
+        for limiter in limiters:
+            limiter.record_latency(latency_ms)
+
+
+# Registered globally so every MongoClient created afterwards reports to it
+_latency_listener = _CommandLatencyListener()
+monitoring.register(_latency_listener)
+
+# The limiter whose slot the current thread holds, see released_io_slot
+_held_slot = threading.local()
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit driven by observed Mongo command latency"""
+
+    def __init__(self, name: str, initial: int, minimum: int, maximum: int,
+                 tolerance: float = AGG_LATENCY_TOLERANCE, window: int = AGG_LATENCY_WINDOW):
+        self.name = name
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(self.maximum, max(self.minimum, initial))
+        self.tolerance = tolerance
+        self.window = window
+        self.in_flight = 0
+        self.baseline_ms: Optional[float] = None
+        self._samples = []
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        """Hold one concurrency slot for the duration of the block"""
+        self._acquire()
+        previous = getattr(_held_slot, "limiter", None)
+        _held_slot.limiter = self
+        try:
+            yield
+        finally:
+            _held_slot.limiter = previous
+            self._release()
+
+    def _acquire(self) -> None:
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    def _release(self) -> None:
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def record_latency(self, latency_ms: float) -> None:
+        with self._condition:
+            self._samples.append(latency_ms)
+            if len(self._samples) < self.window:
+                return
+            average = sum(self._samples) / len(self._samples)
+            self._samples = []
+
+            if self.baseline_ms is None or average < self.baseline_ms:
+                self.baseline_ms = average
+            else:
+                # Let the baseline drift up slowly so one quiet window does not pin it forever
+                self.baseline_ms = self.baseline_ms * 0.95 + average * 0.05
+
+            previous = self.limit
+            if average > self.baseline_ms * self.tolerance:
+                self.limit = max(self.minimum, int(self.limit * 0.75))
+            elif self.in_flight >= self.limit:
+                self.limit = min(self.maximum, self.limit + 1)
+            if self.limit != previous:
+                logger.info(f"Limiter '{self.name}': {previous} -> {self.limit} "
+                            f"(avg {average:.1f}ms, baseline {self.baseline_ms:.1f}ms)")
+            self._condition.notify_all()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "minimum": self.minimum,
+                "maximum": self.maximum,
+                "baseline_ms": self.baseline_ms,
+            }
+
+
+@contextmanager
+def released_io_slot():
+    """Give the calling thread's I/O slot (if it holds one) back for the duration of the block"""
+    limiter = getattr(_held_slot, "limiter", None)
+    if limiter is None:
+        yield
+        return
+    limiter._release()
+    _held_slot.limiter = None
+    try:
+        yield
+    finally:
+        limiter._acquire()
+        _held_slot.limiter = limiter
+
+
+def get_mongo_pool_size(connection=None) -> int:
+    """maxPoolSize of the shared Mongo client (pymongo default 100)"""
+    try:
+        client = connection.client if connection is not None else None
+        if client is not None:
+            return client.options.pool_options.max_pool_size
+    except Exception as e:
+        logger.debug(f"Could not read Mongo pool size: {str(e)}")
+    return 100
+
+
+class ConcurrencyController:
+    """Owns the CPU executor and hands out right-sized I/O executors"""
+
+    def __init__(self, cpu_executor: str = AGG_CPU_EXECUTOR, cpu_workers: int = AGG_CPU_WORKERS,
+                 io_workers: int = AGG_IO_WORKERS):
+        self.cpu_executor_type = cpu_executor
+        self.cpu_workers = max(1, cpu_workers)
+        self.io_workers = max(1, io_workers)
+        self._cpu_executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+
+    def io_limits(self, task_count: int, connection=None) -> Dict[str, int]:
+        """Upper bound and starting point for the I/O stage of one company"""
+        mongo_share = max(1, int(get_mongo_pool_size(connection) * AGG_MONGO_POOL_SHARE))
+        maximum = max(1, min(self.io_workers, mongo_share, task_count))
+        minimum = min(AGG_IO_MIN_WORKERS, maximum)
+        return {"maximum": maximum, "minimum": minimum, "initial": max(minimum, maximum // 2)}
+
+    @contextmanager
+    def io_stage(self, name: str, task_count: int, connection=None):
+        """
+        Yield (executor, limiter) for one company's I/O-bound tasks. Tasks should
+        run inside limiter.slot(); the limiter adapts to Mongo latency while the
+        stage is open.
+        """
+        limits = self.io_limits(task_count, connection)
+        limiter = AdaptiveLimiter(name, limits["initial"], limits["minimum"], limits["maximum"])
+        logger.info(f"I/O stage '{name}': {task_count} tasks, limit {limiter.limit} "
+                    f"(min {limiter.minimum}, max {limiter.maximum})")
+        _latency_listener.attach(limiter)
+        try:
+            # Pool threads are attributed to the calling thread's job in sample profiles
+            with ThreadPoolExecutor(max_workers=limiter.maximum, thread_name_prefix=f"io-{name}",
+                                    initializer=profiling.adopt_pool_thread,
+                                    initargs=(threading.get_ident(),)) as executor:
+                yield executor, limiter
+        finally:
+            _latency_listener.detach(limiter)
+
+    def get_cpu_executor(self) -> Optional[Executor]:
+        """Executor for CPU-bound stages (None when running inline)"""
+        if self.cpu_executor_type == "inline":
+            return None
+        if self._cpu_executor is None:
+            with self._lock:
+                if self._cpu_executor is None:
+                    if self.cpu_executor_type == "process":
+                        # spawn: the parent holds Mongo monitor and HTTP pool threads
+                        self._cpu_executor = ProcessPoolExecutor(max_workers=self.cpu_workers,
+                                                                 mp_context=multiprocessing.get_context("spawn"))
+                    else:
+                        self._cpu_executor = ThreadPoolExecutor(max_workers=self.cpu_workers,
+                                                                thread_name_prefix="cpu")
+                    logger.info(f"CPU executor: {self.cpu_executor_type} x {self.cpu_workers}")
+        return self._cpu_executor
+
+    def run_cpu(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Run a CPU-bound function on the CPU executor and wait for the result,
+        without holding an I/O slot meanwhile. A broken process pool is replaced
+        and the call retried once.
+        """
+        with released_io_slot():
+            executor = self.get_cpu_executor()
+            try:
+                return self._submit_cpu(executor, fn, *args, **kwargs)
+            except BrokenProcessPool:
+                logger.warning("CPU process pool broke, recreating it and retrying once")
+                self._reset_cpu_executor(executor)
+                return self._submit_cpu(self.get_cpu_executor(), fn, *args, **kwargs)
+
+    def _submit_cpu(self, executor: Optional[Executor], fn: Callable[..., Any], *args, **kwargs) -> Any:
+        if executor is None:
+            return fn(*args, **kwargs)
+        if isinstance(executor, ProcessPoolExecutor):
+            # Bring the child's metrics (per-model timings etc.) back into this process
+            result, delta = executor.submit(metrics.call_and_collect, fn, *args, **kwargs).result()
+            metrics.merge(delta)
+            return result
+        return executor.submit(fn, *args, **kwargs).result()
+
+    def _reset_cpu_executor(self, broken: Executor) -> None:
+        # A broken pool raises BrokenProcessPool on every submit; another thread may already have replaced it
+        with self._lock:
+            if self._cpu_executor is broken:
+                self._cpu_executor = None
+                metrics.inc("cpu_executor_restarts_total")
+        broken.shutdown(wait=False)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._cpu_executor is not None:
+                self._cpu_executor.shutdown(wait=True)
+                self._cpu_executor = None
+
+
+_controller: Optional[ConcurrencyController] = None
+_controller_lock = threading.Lock()
+
+
+def get_concurrency_controller() -> ConcurrencyController:
+    """Process-wide concurrency controller"""
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = ConcurrencyController()
+    return _controller
+
+
+def configure(**kwargs) -> ConcurrencyController:
+    """Replace the process-wide controller (e.g. inside scheduler worker processes)"""
+    global _controller
+    with _controller_lock:
+        if _controller is not None:
+            _controller.shutdown()
+        _controller = ConcurrencyController(**kwargs)
+    return _controller
+
+
+def run_forecast(forecast_fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Run a forecast (run_sarima) on the CPU executor"""
+    return get_concurrency_controller().run_cpu(forecast_fn, *args, **kwargs)
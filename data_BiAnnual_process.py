@@ -2,7 +2,10 @@ from pymongo import MongoClient
 from RegionAPI import fetch_company_data
 from bson.objectid import ObjectId
 from dotenv import load_dotenv
-from sarima import run_sarima
+from sarima import refit_sarima, run_sarima
+from incremental import forecast_series, forecast_state_key, history_series, reporting_year_filter
+from code_catalog import get_code_catalog
+from schema_migration import read_number, stored_qty, type_year_match, type_year_since
 from datetime import datetime, timedelta
 from helper import get_min_year, get_next_month_name, get_function_type
 import os
@@ -10,10 +13,11 @@ import json
 import re
 from collections import defaultdict
 import db_connection
+import metrics
 
 load_dotenv()
 
-def process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_code):
+def process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_code, incremental=False):
     print("Detail :: ", company_id, internal_code_id, year, start_month, site_code)
     
 
@@ -25,7 +29,7 @@ def process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_
         cdata_BiAnnual_collection = connection["cdata_bi_annual"]
         cdata_yearly_collection = connection["cdata_yearly"]
         cdata_collection = connection["cdata"]
-        code_collection = connection["codes"]
+        code_catalog = get_code_catalog(connection)
     else:
         print("Database connection is not available.")
 
@@ -46,29 +50,6 @@ def process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_
         "December": 12
     }
 
-    def get_min_year(company_code):
-        min_year_query = [
-        {"$match": {"company_code": company_code}},
-        {"$group": {"_id": None, "min_year": {"$min": "$type_year"}}}
-        ]
-        min_year_result = list(cdata_collection.aggregate(min_year_query))
-
-        if min_year_result:
-            return min_year_result[0]["min_year"]
-        else:
-            return None
-
-    def get_internal_code_ids(company_code, internal_code_ids):
-        query = {
-            "_id": {"$in": internal_code_ids}
-        }
-        projection = {
-            "code": 1, 
-            "name": 1,  
-        }
-        matching_documents = list(code_collection.find(query, projection))
-        return matching_documents
-
     def all_values_same_length(lst):
         str_lst = [str(x) for x in lst]
         
@@ -148,7 +129,7 @@ def process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_
     # Yearly Start 
     def process_yearly_data(result, company_code):
         count = 1
-        data_type = get_function_type(allCodes)
+        data_type = get_function_type([internal_code_id])
         for i in range(0, len(result), 2):
             group = result[i:i+2]
             last_record = result[-1]
@@ -178,7 +159,7 @@ def process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_
                             final_dimension = merge_objects(merged_objects)
                     c_name = " "
                     c_code = " "
-                    code = next((doc for doc in allCodes if doc['_id'] == ObjectId(result[i]['internal_code_id'])), None)
+                    code = code_catalog.get(ObjectId(result[i]['internal_code_id']))
                     if code is not None:
                         c_code = code['code']
                         c_name = code['name']
@@ -189,39 +170,40 @@ def process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_
                     if next_data is not None and next_data['type_year'] != result[i]['type_year']:
                         count = 0
                         
-                    cdata_yearly_collection.delete_many({
-                        "company_code": result[i]['company_code'],
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": result[i]['internal_code_id'],
-                        "code_name": c_name,                                       
-                        "code": c_code,
-                        "is_forecast": False,
-                    })
-                    cdata_yearly_collection.insert_one({
-                        "company_code": result[i]['company_code'],
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "qty": str(total_qty),
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": result[i]['internal_code_id'],
-                        "code_name": c_name,                                       
-                        "code": c_code,
-                        "value": total_value,
-                        "currency": result[i]['currency'],
-                        "dimension": final_dimension,
-                        "unit": result[i]['unit'],
-                        "description": result[i]['description'],
-                        "is_forecast": False,
-                        "created_at": datetime.now()
-                                    })
+                    with metrics.timed("mongo_write"):
+                        cdata_yearly_collection.delete_many({
+                            "company_code": result[i]['company_code'],
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": result[i]['internal_code_id'],
+                            "code_name": c_name,                                       
+                            "code": c_code,
+                            "is_forecast": False,
+                        })
+                        cdata_yearly_collection.insert_one({
+                            "company_code": result[i]['company_code'],
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "qty": stored_qty(total_qty),
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": result[i]['internal_code_id'],
+                            "code_name": c_name,                                       
+                            "code": c_code,
+                            "value": total_value,
+                            "currency": result[i]['currency'],
+                            "dimension": final_dimension,
+                            "unit": result[i]['unit'],
+                            "description": result[i]['description'],
+                            "is_forecast": False,
+                            "created_at": datetime.now()
+                                        })
                     
                     sarima_array.append(total_qty)
                     count += 1 
                 else:
                     total_qty = sum(safe_int(obj['qty']) for obj in group)
-                    code = next((doc for doc in allCodes if doc['_id'] == ObjectId(result[i]['internal_code_id'])), None)
+                    code = code_catalog.get(ObjectId(result[i]['internal_code_id']))
                     c_name = " "
                     c_code = " "
                     if code is not None:
@@ -234,35 +216,36 @@ def process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_
                     next_data = result[i+2] if i+2 < len(result) else None
                     if next_data is not None and next_data['type_year'] != result[i]['type_year']:
                         count = 0
-                    cdata_yearly_collection.delete_many({
-                        "company_code": result[i]['company_code'],
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": result[i]['internal_code_id'],
-                        "code_name": c_name,                                       
-                        "code": c_code,
-                        "is_forecast": True,
-                    })
-                    cdata_yearly_collection.insert_one({
-                        "company_code": result[i]['company_code'],
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "qty": str(total_qty),
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": (result[i]['internal_code_id']),
-                        "code_name": c_name,
-                        "code": c_code,
-                        "description": result[i]['description'],
-                        "is_forecast": True,
-                        "created_at": datetime.now()
-                    })
+                    with metrics.timed("mongo_write"):
+                        cdata_yearly_collection.delete_many({
+                            "company_code": result[i]['company_code'],
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": result[i]['internal_code_id'],
+                            "code_name": c_name,                                       
+                            "code": c_code,
+                            "is_forecast": True,
+                        })
+                        cdata_yearly_collection.insert_one({
+                            "company_code": result[i]['company_code'],
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "qty": stored_qty(total_qty),
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": (result[i]['internal_code_id']),
+                            "code_name": c_name,
+                            "code": c_code,
+                            "description": result[i]['description'],
+                            "is_forecast": True,
+                            "created_at": datetime.now()
+                        })
                     
                     sarima_array.append(total_qty)
                     count += 1 
             else:
                     total_qty = sum(safe_int(obj['qty']) for obj in group)
-                    code = next((doc for doc in allCodes if doc['_id'] == ObjectId(result[i]['internal_code_id'])), None)
+                    code = code_catalog.get(ObjectId(result[i]['internal_code_id']))
                     c_name = " "
                     c_code = " "
                     if code is not None:
@@ -275,32 +258,33 @@ def process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_
                     next_data = result[i+2] if i+2 < len(result) else None
                     if next_data is not None and next_data['type_year'] != result[i]['type_year']:
                         count = 0
-                    cdata_yearly_collection.delete_many({
-                        "company_code": result[i]['company_code'],
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": result[i]['internal_code_id'],
-                        "code_name": c_name,                                       
-                        "code": c_code,
-                        "is_forecast": True,
-                    })
-                    cdata_yearly_collection.insert_one({
-                        "company_code": result[i]['company_code'],
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "qty": str(total_qty),
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": (result[i]['internal_code_id']),
-                        "code_name": c_name,
-                        "code": c_code,
-                        "is_forecast": True,
-                        "created_at": datetime.now()
-                    })
+                    with metrics.timed("mongo_write"):
+                        cdata_yearly_collection.delete_many({
+                            "company_code": result[i]['company_code'],
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": result[i]['internal_code_id'],
+                            "code_name": c_name,                                       
+                            "code": c_code,
+                            "is_forecast": True,
+                        })
+                        cdata_yearly_collection.insert_one({
+                            "company_code": result[i]['company_code'],
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "qty": stored_qty(total_qty),
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": (result[i]['internal_code_id']),
+                            "code_name": c_name,
+                            "code": c_code,
+                            "is_forecast": True,
+                            "created_at": datetime.now()
+                        })
                     sarima_array.append(total_qty)
                     count += 1 
 
-    get_company_year = get_min_year(company_id)
+    get_company_year = get_min_year(company_id, cdata_collection)
     if get_company_year is not None:
         get_company_year = int(get_company_year)
         if get_company_year >= int(year):
@@ -318,27 +302,29 @@ def process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_
             "type": "actual",
             "site_code": str(site_code),
             "is_aggregated": False,
-            "$or": [
-                {
-                    "$and": [
-                        {"type_year": str(min_year)},
-                        {"semi_annual": {"$exists": True, "$nin": [None, ""]}}
-                    ]
-                },
-                {
-                    "type_year": {"$gt": str(min_year)},
-                    "semi_annual": {"$exists": True, "$nin": [None, ""]}
-                }
-            ]
+            "semi_annual": {"$exists": True, "$nin": [None, ""]},
+            **type_year_since(min_year)
         }
 
-        documents = list(cdata_collection.find(query))
-        documents_filtered = [doc for doc in documents if int(doc["type_year"]) > min_year]
-        cdata = sorted(documents_filtered, key=lambda x: int(x["type_year"]))
-        ids = get_unique_code_ids(cdata)
-        allCodes = get_internal_code_ids(company_id, ids)
+        def in_reporting_range(doc):
+            return int(doc["type_year"]) > min_year
+
+        def period_order(doc):
+            return int(doc["type_year"])
+
+        def series_value(doc):
+            qty = doc.get("qty")
+            if qty is None or qty == "":
+                return None
+            return read_number(qty, extract_number_from_string)
+
+        with metrics.timed("cdata_read"):
+            documents = list(cdata_collection.find(query))
+        documents_filtered = [doc for doc in documents if in_reporting_range(doc)]
+        cdata = sorted(documents_filtered, key=period_order)
 
         sarima_array = []
+        affected_years = set()
         count =  1
         sarima_group = []
         last_report_year = ''
@@ -347,7 +333,7 @@ def process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_
             last_record = cdata[-1]
             c_name = " "
             c_code = " "
-            code = next((doc for doc in allCodes if doc['_id'] == entry["internal_code_id"]), None)
+            code = code_catalog.get(entry["internal_code_id"])
             if code is not None:
                 c_code = code['code']
                 c_name = code['name']
@@ -384,69 +370,78 @@ def process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_
             narration = entry.get("narration", "")
             url = entry.get("url", "")
             description = f"{narration} {url}"
-            cdata_collection.update_many({
-                "company_code": company_id,
-                "month": entry.get("month", ""),
-                "semi_annual": entry.get("semi_annual", ""),
-                "site_code" : str(site_code),
-                "type": "actual",
-                "type_year": str(entry.get("type_year", "")),
-                "internal_code_id": entry.get("internal_code_id", ""),
-                },
-                {"$set": {"is_aggregated": True}}
-            ) 
-            cdata_BiAnnual_collection.delete_many({
-                "company_code": company_id,
-                "semi_annual": entry.get("semi_annual", ""),
-                "month": entry.get("month", ""),
-                "type_year": int(entry.get("type_year", "")),
-                "reporting_year": reporting_year,
-                "site_code" : str(site_code),
-                "internal_code_id": entry.get("internal_code_id", ""),
-                "code_name": c_name,
-                "code": c_code,
-                "ref_table": "cdata",
-                "is_forecast": False,
-            })
-            cdata_BiAnnual_collection.insert_one({
-                "company_code": company_id,
-                "semi_annual": entry.get("semi_annual", ""),
-                "month": entry.get("month", ""),
-                "type_year": int(entry.get("type_year", "")),
-                "reporting_year": reporting_year,
-                "qty": str(final_qty),
-                "site_code" : str(site_code),
-                "internal_code_id": entry.get("internal_code_id", ""),
-                "code_name": c_name,
-                "code": c_code,
-                "value": int(final_value),
-                "currency": entry.get("currency", ""),
-                "dimension": entry.get("dimension", ""),
-                "unit": entry.get("unit", ""),
-                "description": entry.get("description", ""),
-                "ref_table": "cdata",
-                "is_forecast": False,
-                "created_at": datetime.now()
-                        })
+            with metrics.timed("mongo_write"):
+                cdata_collection.update_many({
+                    "company_code": company_id,
+                    "month": entry.get("month", ""),
+                    "semi_annual": entry.get("semi_annual", ""),
+                    "site_code" : str(site_code),
+                    "type": "actual",
+                    "type_year": type_year_match(entry.get("type_year", "")),
+                    "internal_code_id": entry.get("internal_code_id", ""),
+                    },
+                    {"$set": {"is_aggregated": True}}
+                ) 
+                cdata_BiAnnual_collection.delete_many({
+                    "company_code": company_id,
+                    "semi_annual": entry.get("semi_annual", ""),
+                    "month": entry.get("month", ""),
+                    "type_year": int(entry.get("type_year", "")),
+                    "reporting_year": reporting_year,
+                    "site_code" : str(site_code),
+                    "internal_code_id": entry.get("internal_code_id", ""),
+                    "code_name": c_name,
+                    "code": c_code,
+                    "ref_table": "cdata",
+                    "is_forecast": False,
+                })
+                cdata_BiAnnual_collection.insert_one({
+                    "company_code": company_id,
+                    "semi_annual": entry.get("semi_annual", ""),
+                    "month": entry.get("month", ""),
+                    "type_year": int(entry.get("type_year", "")),
+                    "reporting_year": reporting_year,
+                    "qty": stored_qty(final_qty),
+                    "site_code" : str(site_code),
+                    "internal_code_id": entry.get("internal_code_id", ""),
+                    "code_name": c_name,
+                    "code": c_code,
+                    "value": int(final_value),
+                    "currency": entry.get("currency", ""),
+                    "dimension": entry.get("dimension", ""),
+                    "unit": entry.get("unit", ""),
+                    "description": entry.get("description", ""),
+                    "ref_table": "cdata",
+                    "is_forecast": False,
+                    "created_at": datetime.now()
+                            })
             count += 1
             last_report_year = reporting_year
-            qty = entry.get("qty")
-            if qty is not None and qty != "":
-                number = extract_number_from_string(qty)
-                if number is not None and number != "":
-                    sarima_array.append(int(number))
+            affected_years.add(reporting_year)
+
+        # Forecast from the whole actual history, not just the rows aggregated in this run
+        if cdata:
+            sarima_array, history_last = history_series(cdata_collection, query, period_order, series_value,
+                                                        row_filter=in_reporting_range)
+            if period_order(history_last) != period_order(last_record):
+                # Backfill behind the latest actual year: the stored forecast still follows that year
+                print("History backfilled, keeping stored forecast :: ", internal_code_id, site_code)
+                sarima_array = []
 
         sarima_predictions = []
         if len(sarima_array) != 0:
             if len(sarima_array) > 5:
-                sarima_predictions = run_sarima(sarima_array, predictedValue=11, m=2)
+                sarima_predictions = forecast_series(
+                    connection, forecast_state_key(company_id, internal_code_id, site_code, "semi_annual"),
+                    sarima_array, incremental, run_sarima, refit_fn=refit_sarima, predictedValue=11, m=2
+                )
 
         if len(sarima_predictions) > 0:
             next_year = int(last_record['type_year'])
             last_reporting_year = int(last_report_year)
             c_code = " "
             c_name = " "
-            code = next((doc for doc in allCodes if doc['_id'] == entry["internal_code_id"]), None)
+            code = code_catalog.get(entry["internal_code_id"])
             if code is not None:
                 c_code = code['code']
                 c_name = code['name']
@@ -468,32 +463,34 @@ def process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_
 
                 if count == 2:
                     count = 1
-                cdata_BiAnnual_collection.delete_many({
-                    "company_code": company_id,
-                    "semi_annual": semi_annual,
-                    "type_year": next_year,
-                    "reporting_year": last_reporting_year,
-                    "site_code" : str(site_code),
-                    "internal_code_id": ObjectId(internal_code_id),
-                    "code_name": c_name,
-                    "code": c_code,
-                    "is_forecast": True,
-                })
-                cdata_BiAnnual_collection.insert_one({
-                    "company_code": company_id,
-                    "semi_annual": semi_annual,
-                    "type_year": next_year,
-                    "reporting_year": last_reporting_year,
-                    "qty": str(pred_value),
-                    "site_code" : str(site_code),
-                    "internal_code_id": ObjectId(internal_code_id),
-                    "code_name": c_name,
-                    "code": c_code,
-                    "value": 0,
-                    "description": "",
-                    "is_forecast": True,
-                    "created_at": datetime.now()
-                })
+                with metrics.timed("mongo_write"):
+                    cdata_BiAnnual_collection.delete_many({
+                        "company_code": company_id,
+                        "semi_annual": semi_annual,
+                        "type_year": next_year,
+                        "reporting_year": last_reporting_year,
+                        "site_code" : str(site_code),
+                        "internal_code_id": ObjectId(internal_code_id),
+                        "code_name": c_name,
+                        "code": c_code,
+                        "is_forecast": True,
+                    })
+                    cdata_BiAnnual_collection.insert_one({
+                        "company_code": company_id,
+                        "semi_annual": semi_annual,
+                        "type_year": next_year,
+                        "reporting_year": last_reporting_year,
+                        "qty": stored_qty(pred_value),
+                        "site_code" : str(site_code),
+                        "internal_code_id": ObjectId(internal_code_id),
+                        "code_name": c_name,
+                        "code": c_code,
+                        "value": 0,
+                        "description": "",
+                        "is_forecast": True,
+                        "created_at": datetime.now()
+                    })
+                affected_years.add(last_reporting_year)
                 last_reporting_count += 1
                 count += 1
         
@@ -503,6 +500,9 @@ def process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_
                 "internal_code_id": ObjectId(internal_code_id)
             }
 
+        if incremental:
+            # Only rebuild the derived levels of the reporting years written above
+            query = reporting_year_filter(query, affected_years)
         result = list(cdata_BiAnnual_collection.find(query))
 
         process_yearly_data(result, company_id)
@@ -2,7 +2,10 @@ from pymongo import MongoClient
 from RegionAPI import fetch_company_data
 from bson.objectid import ObjectId
 from dotenv import load_dotenv
-from sarima import run_sarima
+from sarima import refit_sarima, run_sarima
+from incremental import forecast_series, forecast_state_key, history_series, reporting_year_filter
+from code_catalog import get_code_catalog
+from schema_migration import stored_qty, stored_value, type_year_match, type_year_since
 from datetime import datetime, timedelta
 from helper import get_min_year, get_next_month_name, get_function_type
 from collections import defaultdict
@@ -10,10 +13,11 @@ import os
 import json
 import re
 import db_connection
+import metrics
 
 load_dotenv()
 
-def process_monthly_data(company_id, internal_code_id, year, start_month, site_code):
+def process_monthly_data(company_id, internal_code_id, year, start_month, site_code, incremental=False):
     print("Company Details :: ", company_id, internal_code_id, year, start_month, site_code)
 
     connection = db_connection.connect_to_database()
@@ -24,7 +28,7 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
         cdata_BiAnnual_collection = connection["cdata_bi_annual"]
         cdata_yearly_collection = connection["cdata_yearly"]
         cdata_collection = connection["cdata"]
-        code_collection = connection["codes"]
+        code_catalog = get_code_catalog(connection)
     else:
         print("Database connection is not available.")
 
@@ -47,18 +51,6 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
     }
 
 
-    def get_internal_code_ids(company_code, internal_code_ids):
-        query = {
-            "_id": {"$in": internal_code_ids}
-        }
-        projection = {
-            "code": 1, 
-            "name": 1,
-            "function": 1,  
-        }
-        matching_documents = list(code_collection.find(query, projection))
-        return matching_documents
-
     def all_values_same_length(lst):
         str_lst = [str(x) for x in lst]
         
@@ -180,7 +172,7 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
     # Quarterly Start 
     def process_quarterly_data(result, company_code):
 
-        data_type = get_function_type(allCodes)
+        data_type = get_function_type([internal_code_id])
 
         count = 1
         reporting_year_counter = 1
@@ -229,7 +221,7 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
                     months = '-'.join(obj['month'] for obj in group)
                     c_name = " "
                     c_code = " "
-                    code = next((doc for doc in allCodes if doc['_id'] == ObjectId(result[i]['internal_code_id'])), None)
+                    code = code_catalog.get(ObjectId(result[i]['internal_code_id']))
                     if code is not None:
                         c_code = code['code']
                         c_name = code['name']
@@ -237,38 +229,39 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
                         c_code = " "
                         c_name = " "
 
-                    cdata_quarter_collection.delete_many({
-                        "company_code": result[i]['company_code'],
-                        "quarter": quarter,
-                        "month": months,
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": result[i]['internal_code_id'],
-                        "code_name": c_name,
-                        "code": c_code,
-                        "is_forecast": False,
-                    })
-                    cdata_quarter_collection.insert_one({
-                        "company_code": result[i]['company_code'],
-                        "quarter": quarter,
-                        "month": months,
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "qty": str(total_qty),
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": result[i]['internal_code_id'],
-                        "code_name": c_name,
-                        "code": c_code,
-                        "value": total_value,
-                        "currency": result[i]['currency'],
-                        "dimension": final_dimension,
-                        "unit": result[i]['unit'],
-                        "description": result[i]['description'],
-                        "ref_table": "cdata_month",
-                        "is_forecast": False,
-                        "created_at": datetime.now()
-                    })
+                    with metrics.timed("mongo_write"):
+                        cdata_quarter_collection.delete_many({
+                            "company_code": result[i]['company_code'],
+                            "quarter": quarter,
+                            "month": months,
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": result[i]['internal_code_id'],
+                            "code_name": c_name,
+                            "code": c_code,
+                            "is_forecast": False,
+                        })
+                        cdata_quarter_collection.insert_one({
+                            "company_code": result[i]['company_code'],
+                            "quarter": quarter,
+                            "month": months,
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "qty": stored_qty(total_qty),
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": result[i]['internal_code_id'],
+                            "code_name": c_name,
+                            "code": c_code,
+                            "value": total_value,
+                            "currency": result[i]['currency'],
+                            "dimension": final_dimension,
+                            "unit": result[i]['unit'],
+                            "description": result[i]['description'],
+                            "ref_table": "cdata_month",
+                            "is_forecast": False,
+                            "created_at": datetime.now()
+                        })
                     
                     sarima_array.append(total_qty)
                     count += 1 
@@ -276,7 +269,7 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
                 else:
                     c_name = " "
                     c_code = " "
-                    code = next((doc for doc in allCodes if doc['_id'] == ObjectId(result[i]['internal_code_id'])), None)
+                    code = code_catalog.get(ObjectId(result[i]['internal_code_id']))
                     if code is not None:
                         c_code = code['code']
                         c_name = code['name']
@@ -295,33 +288,34 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
                     narration = entry.get("narration", "")
                     url = entry.get("url", "")
                     description = f"{narration} {url}"
-                    cdata_quarter_collection.delete_many({
-                        "company_code": result[i]['company_code'],
-                        "quarter": quarter,
-                        "month": months,
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": result[i]['internal_code_id'],
-                        "code_name": c_name,
-                        "code": c_code,
-                        "is_forecast": True,
-                    })
-                    cdata_quarter_collection.insert_one({
-                        "company_code": result[i]['company_code'],
-                        "quarter": quarter,
-                        "month": months,
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "qty": str(total_qty),
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": result[i]['internal_code_id'],
-                        "value": total_value,
-                        "description": result[i]['description'],
-                        "ref_table": "cdata_month",
-                        "is_forecast": True,
-                        "created_at": datetime.now()
-                    })
+                    with metrics.timed("mongo_write"):
+                        cdata_quarter_collection.delete_many({
+                            "company_code": result[i]['company_code'],
+                            "quarter": quarter,
+                            "month": months,
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": result[i]['internal_code_id'],
+                            "code_name": c_name,
+                            "code": c_code,
+                            "is_forecast": True,
+                        })
+                        cdata_quarter_collection.insert_one({
+                            "company_code": result[i]['company_code'],
+                            "quarter": quarter,
+                            "month": months,
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "qty": stored_qty(total_qty),
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": result[i]['internal_code_id'],
+                            "value": total_value,
+                            "description": result[i]['description'],
+                            "ref_table": "cdata_month",
+                            "is_forecast": True,
+                            "created_at": datetime.now()
+                        })
                     
                     sarima_array.append(total_qty)
                     count += 1 
@@ -330,7 +324,7 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
 
     # Bi Annual Start 
     def process_BiAnnual_data(result, company_code):
-        data_type = get_function_type(allCodes)
+        data_type = get_function_type([internal_code_id])
         count = 1
         reporting_year_count = 1
         c_code = ''
@@ -381,7 +375,7 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
                     c_name = " "
                     # quarter = f"Semester{count}"
                     months = '-'.join(obj['month'] for obj in group)
-                    code = next((doc for doc in allCodes if doc['_id'] == ObjectId(result[i]['internal_code_id'])), None)
+                    code = code_catalog.get(ObjectId(result[i]['internal_code_id']))
                     
                     if code is not None:
                         c_code = code['code']
@@ -394,38 +388,39 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
                     narration = entry.get("narration", "")
                     url = entry.get("url", "")
                     description = f"{narration} {url}"
-                    cdata_BiAnnual_collection.delete_many({
-                        "company_code": result[i]['company_code'],
-                        "semi_annual": half_period,
-                        "month": months,
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": ObjectId(result[i]['internal_code_id']),
-                        "code_name": c_name,
-                        "code": c_code,
-                        "is_forecast": False,
-                    })
-                    cdata_BiAnnual_collection.insert_one({
-                        "company_code": result[i]['company_code'],
-                        "semi_annual": half_period,
-                        "month": months,
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "qty": str(total_qty),
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": ObjectId(result[i]['internal_code_id']),
-                        "code_name": c_name,
-                        "code": c_code,
-                        "value": total_value,
-                        "currency": result[i]['currency'],
-                        "dimension": final_dimension,
-                        "unit": result[i]['unit'],
-                        "description": result[i]['description'],
-                        "ref_table": "cdata_month",
-                        "is_forecast": False,
-                        "created_at": datetime.now()
-                    })
+                    with metrics.timed("mongo_write"):
+                        cdata_BiAnnual_collection.delete_many({
+                            "company_code": result[i]['company_code'],
+                            "semi_annual": half_period,
+                            "month": months,
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": ObjectId(result[i]['internal_code_id']),
+                            "code_name": c_name,
+                            "code": c_code,
+                            "is_forecast": False,
+                        })
+                        cdata_BiAnnual_collection.insert_one({
+                            "company_code": result[i]['company_code'],
+                            "semi_annual": half_period,
+                            "month": months,
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "qty": stored_qty(total_qty),
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": ObjectId(result[i]['internal_code_id']),
+                            "code_name": c_name,
+                            "code": c_code,
+                            "value": total_value,
+                            "currency": result[i]['currency'],
+                            "dimension": final_dimension,
+                            "unit": result[i]['unit'],
+                            "description": result[i]['description'],
+                            "ref_table": "cdata_month",
+                            "is_forecast": False,
+                            "created_at": datetime.now()
+                        })
                     
                     sarima_array.append(total_qty)
                     count += 1 
@@ -437,32 +432,33 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
                     months = '-'.join(obj['month'] for obj in group)
                     
                     next_data = result[i+6] if i+6 < len(result) else None 
-                    cdata_BiAnnual_collection.delete_many({
-                        "company_code": result[i]['company_code'],
-                        "semi_annual": half_period,
-                        "month": months,
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": ObjectId(result[i]['internal_code_id']),
-                        "code_name": c_name,
-                        "code": c_code,
-                        "is_forecast": True,
-                    })
-                    cdata_BiAnnual_collection.insert_one({
-                        "company_code": result[i]['company_code'],
-                        "semi_annual": half_period,
-                        "month": months,
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "qty": str(total_qty),
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": ObjectId(result[i]['internal_code_id']),
-                        "value": total_value,
-                        "description": result[i]['description'],
-                        "is_forecast": True,
-                        "created_at": datetime.now()
-                    })
+                    with metrics.timed("mongo_write"):
+                        cdata_BiAnnual_collection.delete_many({
+                            "company_code": result[i]['company_code'],
+                            "semi_annual": half_period,
+                            "month": months,
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": ObjectId(result[i]['internal_code_id']),
+                            "code_name": c_name,
+                            "code": c_code,
+                            "is_forecast": True,
+                        })
+                        cdata_BiAnnual_collection.insert_one({
+                            "company_code": result[i]['company_code'],
+                            "semi_annual": half_period,
+                            "month": months,
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "qty": stored_qty(total_qty),
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": ObjectId(result[i]['internal_code_id']),
+                            "value": total_value,
+                            "description": result[i]['description'],
+                            "is_forecast": True,
+                            "created_at": datetime.now()
+                        })
                     
                     sarima_array.append(total_qty)
                     count += 1 
@@ -470,7 +466,7 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
 
     # Yearly Start 
     def process_yearly_data(result, company_code):
-        data_type = get_function_type(allCodes)
+        data_type = get_function_type([internal_code_id])
         count = 1
         loop_range = 12
         first = False
@@ -512,7 +508,7 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
                         final_dimension = merge_objects(merged_objects)
 
                 months = '-'.join(obj['month'] for obj in group)
-                code = next((doc for doc in allCodes if doc['_id'] == ObjectId(result[i]['internal_code_id'])), None)
+                code = code_catalog.get(ObjectId(result[i]['internal_code_id']))
                 c_code = " "
                 c_name = " "
                 if code is not None:
@@ -525,35 +521,36 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
                 narration = entry.get("narration", "")
                 url = entry.get("url", "")
                 description = f"{narration} {url}"  
-                cdata_yearly_collection.delete_many({
-                    "company_code": result[i]['company_code'],
-                    "month": months,
-                    "type_year": result[i]['type_year'],
-                    "reporting_year": reporting_year,
-                    "site_code": result[i]['site_code'],
-                    "internal_code_id": result[i]['internal_code_id'],
-                    "code_name": c_name,                                       
-                    "code": c_code,
-                    "is_forecast": False,
-                })
-                cdata_yearly_collection.insert_one({
-                    "company_code": result[i]['company_code'],
-                    "month": months,
-                    "type_year": result[i]['type_year'],
-                    "reporting_year": reporting_year,
-                    "qty": str(total_qty),
-                    "site_code": result[i]['site_code'],
-                    "internal_code_id": result[i]['internal_code_id'],
-                    "code_name": c_name,
-                    "code": c_code,
-                    "value": total_value,
-                    "currency": result[i]['currency'],
-                    "dimension": final_dimension,
-                    "unit": result[i]['unit'],
-                    "description": result[i]['description'],
-                    "is_forecast": False,
-                    "created_at": datetime.now()
-                })
+                with metrics.timed("mongo_write"):
+                    cdata_yearly_collection.delete_many({
+                        "company_code": result[i]['company_code'],
+                        "month": months,
+                        "type_year": result[i]['type_year'],
+                        "reporting_year": reporting_year,
+                        "site_code": result[i]['site_code'],
+                        "internal_code_id": result[i]['internal_code_id'],
+                        "code_name": c_name,                                       
+                        "code": c_code,
+                        "is_forecast": False,
+                    })
+                    cdata_yearly_collection.insert_one({
+                        "company_code": result[i]['company_code'],
+                        "month": months,
+                        "type_year": result[i]['type_year'],
+                        "reporting_year": reporting_year,
+                        "qty": stored_qty(total_qty),
+                        "site_code": result[i]['site_code'],
+                        "internal_code_id": result[i]['internal_code_id'],
+                        "code_name": c_name,
+                        "code": c_code,
+                        "value": total_value,
+                        "currency": result[i]['currency'],
+                        "dimension": final_dimension,
+                        "unit": result[i]['unit'],
+                        "description": result[i]['description'],
+                        "is_forecast": False,
+                        "created_at": datetime.now()
+                    })
 
                 sarima_array.append(total_qty)
                 count += 1 
@@ -562,7 +559,7 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
                 total_value = sum(safe_int(obj['value']) for obj in group)
 
                 months = '-'.join(obj['month'] for obj in group)
-                code = next((doc for doc in allCodes if doc['_id'] == ObjectId(result[i]['internal_code_id'])), None)
+                code = code_catalog.get(ObjectId(result[i]['internal_code_id']))
                 c_code = " "
                 c_name = " "
                 if code is not None:
@@ -575,32 +572,33 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
                 next_data = result[i+loop_range] if i+loop_range < len(result) else None
                 if next_data is not None and next_data['type_year'] != result[i]['type_year']:
                     count = 0
-                cdata_yearly_collection.delete_many({
-                    "company_code": result[i]['company_code'],
-                    "month": months,
-                    "type_year": result[i]['type_year'],
-                    "reporting_year": reporting_year,
-                    "site_code": result[i]['site_code'],
-                    "internal_code_id": result[i]['internal_code_id'],
-                    "code_name": c_name,                                       
-                    "code": c_code,
-                    "is_forecast": True,
-                })
-                cdata_yearly_collection.insert_one({
-                    "company_code": result[i]['company_code'],
-                    "month": months,
-                    "type_year": result[i]['type_year'],
-                    "reporting_year": reporting_year,
-                    "qty": str(total_qty),
-                    "site_code": result[i]['site_code'],
-                    "internal_code_id": (result[i]['internal_code_id']),
-                    "code_name": c_name,
-                    "code": c_code,
-                    "description": result[i]['description'],
-                    "value": total_value,
-                    "is_forecast": True,
-                    "created_at": datetime.now()
-                })
+                with metrics.timed("mongo_write"):
+                    cdata_yearly_collection.delete_many({
+                        "company_code": result[i]['company_code'],
+                        "month": months,
+                        "type_year": result[i]['type_year'],
+                        "reporting_year": reporting_year,
+                        "site_code": result[i]['site_code'],
+                        "internal_code_id": result[i]['internal_code_id'],
+                        "code_name": c_name,                                       
+                        "code": c_code,
+                        "is_forecast": True,
+                    })
+                    cdata_yearly_collection.insert_one({
+                        "company_code": result[i]['company_code'],
+                        "month": months,
+                        "type_year": result[i]['type_year'],
+                        "reporting_year": reporting_year,
+                        "qty": stored_qty(total_qty),
+                        "site_code": result[i]['site_code'],
+                        "internal_code_id": (result[i]['internal_code_id']),
+                        "code_name": c_name,
+                        "code": c_code,
+                        "description": result[i]['description'],
+                        "value": total_value,
+                        "is_forecast": True,
+                        "created_at": datetime.now()
+                    })
 
                 sarima_array.append(total_qty)
                 count += 1 
@@ -627,31 +625,33 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
             "type": "actual",
             "is_aggregated": False,
             "site_code": str(site_code),
-            "$or": [
-                {
-                    "$and": [
-                        {"type_year": str(min_year)},
-                        {"month": {"$exists": True, "$nin": [None, ""]}}
-                    ]
-                },
-                {
-                    "type_year": {"$gt": str(min_year)},
-                    "month": {"$exists": True, "$nin": [None, ""]}
-                }
-            ]
+            "month": {"$exists": True, "$nin": [None, ""]},
+            **type_year_since(min_year)
         }
 
-        documents = list(cdata_collection.find(query))
-        documents_filtered = [doc for doc in documents if int(doc["type_year"]) > min_year or (int(doc["type_year"]) == min_year and month_order[doc["month"]] >= given_month_numeric)]
-        cdata = sorted(documents_filtered, key=lambda x: (x['type_year'], month_order[x['month']]))
+        def in_reporting_range(doc):
+            return int(doc["type_year"]) > min_year or (int(doc["type_year"]) == min_year and month_order[doc["month"]] >= given_month_numeric)
+
+        def period_order(doc):
+            return (int(doc['type_year']), month_order[doc['month']])
+
+        def series_value(doc):
+            qty_value = doc.get("qty", "")
+            if qty_value is None or qty_value == "":
+                return 0
+            return int(float(qty_value)) if isinstance(qty_value, str) else int(qty_value)
+
+        with metrics.timed("cdata_read"):
+            documents = list(cdata_collection.find(query))
+        documents_filtered = [doc for doc in documents if in_reporting_range(doc)]
+        cdata = sorted(documents_filtered, key=period_order)
 
         # Perform the update
         # updatedResult = cdata_collection.update_many(update_query, update_action)
 
-        ids = get_unique_code_ids(cdata)
-        allCodes = get_internal_code_ids(company_id, ids)
 
         sarima_array = []
+        affected_years = set()
         count =  1
         sarima_group = []
 
@@ -660,7 +660,7 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
             last_record = cdata[-1]
             c_code = " "
             c_name = " "
-            code = next((doc for doc in allCodes if doc['_id'] == entry["internal_code_id"]), None)
+            code = code_catalog.get(entry["internal_code_id"])
             if code is not None:
                 c_code = code['code']
                 c_name = code['name']
@@ -698,64 +698,72 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
             narration = entry.get("narration", "")
             url = entry.get("url", "")
             description = f"{narration} {url}" 
-            cdata_collection.update_many({
-                "company_code": company_id,
-                "month": entry.get("month", ""),
-                "site_code" : str(site_code),
-                "type": "actual",
-                "type_year": str(entry.get("type_year", "")),
-                "internal_code_id": entry.get("internal_code_id", ""),
-                },
-                {"$set": {"is_aggregated": True}}
-            ) 
-            cdata_month_collection.delete_many({
-                "company_code": company_id,
-                "month": entry.get("month", ""),
-                "type_year": int(entry.get("type_year", "")),
-                "reporting_year": reporting_year,
-                "site_code" : str(site_code),
-                "internal_code_id": entry.get("internal_code_id", ""),
-                "code_name": c_name,
-                "code": c_code,
-            })  
-            cdata_month_collection.insert_one({
-                "company_code": company_id,
-                "month": entry.get("month", ""),
-                "type_year": int(entry.get("type_year", "")),
-                "reporting_year": reporting_year,
-                "qty": str(final_qty),
-                "site_code" : str(site_code),
-                "internal_code_id": entry.get("internal_code_id", ""),
-                "code_name": c_name,
-                "code": c_code,
-                "value": entry.get("value", ""),
-                "currency": entry.get("currency", ""),
-                "dimension": entry.get("dimension", ""),
-                "unit": entry.get("unit", ""),
-                "description": description,
-                "ref_table": "cdata",
-                "is_forecast": False,
-                "created_at": datetime.now()
-            })
+            with metrics.timed("mongo_write"):
+                cdata_collection.update_many({
+                    "company_code": company_id,
+                    "month": entry.get("month", ""),
+                    "site_code" : str(site_code),
+                    "type": "actual",
+                    "type_year": type_year_match(entry.get("type_year", "")),
+                    "internal_code_id": entry.get("internal_code_id", ""),
+                    },
+                    {"$set": {"is_aggregated": True}}
+                ) 
+                cdata_month_collection.delete_many({
+                    "company_code": company_id,
+                    "month": entry.get("month", ""),
+                    "type_year": int(entry.get("type_year", "")),
+                    "reporting_year": reporting_year,
+                    "site_code" : str(site_code),
+                    "internal_code_id": entry.get("internal_code_id", ""),
+                    "code_name": c_name,
+                    "code": c_code,
+                })  
+                cdata_month_collection.insert_one({
+                    "company_code": company_id,
+                    "month": entry.get("month", ""),
+                    "type_year": int(entry.get("type_year", "")),
+                    "reporting_year": reporting_year,
+                    "qty": stored_qty(final_qty),
+                    "site_code" : str(site_code),
+                    "internal_code_id": entry.get("internal_code_id", ""),
+                    "code_name": c_name,
+                    "code": c_code,
+                    "value": stored_value(entry.get("value", "")),
+                    "currency": entry.get("currency", ""),
+                    "dimension": entry.get("dimension", ""),
+                    "unit": entry.get("unit", ""),
+                    "description": description,
+                    "ref_table": "cdata",
+                    "is_forecast": False,
+                    "created_at": datetime.now()
+                })
+            affected_years.add(reporting_year)
             count += 1
-            
-            qty = final_qty
-            if qty is not None and qty != "":
-                number = extract_number_from_string(qty)
-                if number is not None and number != "":
-                    sarima_array.append(int(number))
+
+        # Forecast from the whole actual history, not just the rows aggregated in this run
+        if cdata:
+            sarima_array, history_last = history_series(cdata_collection, query, period_order, series_value,
+                                                        row_filter=in_reporting_range)
+            if period_order(history_last) != period_order(last_record):
+                # Backfill behind the latest actual month: the stored forecast still follows that month
+                print("History backfilled, keeping stored forecast :: ", internal_code_id, site_code)
+                sarima_array = []
 
         sarima_predictions = []
         if len(sarima_array) != 0:
             if len(sarima_array) >= 2:
-                sarima_predictions = run_sarima(sarima_array, predictedValue=35, m=12)
+                sarima_predictions = forecast_series(
+                    connection, forecast_state_key(company_id, internal_code_id, site_code, "month"),
+                    sarima_array, incremental, run_sarima, refit_fn=refit_sarima, predictedValue=35, m=12
+                )
 
         if sarima_predictions is not None and len(sarima_predictions) > 0:
             next_month = last_record['month']
             current_month = last_record['month']
             c_code = " "
             c_name = " "
-            code = next((doc for doc in allCodes if doc['_id'] == entry["internal_code_id"]), None)
+            code = code_catalog.get(entry["internal_code_id"])
             if code is not None:
                 c_code = code['code']
                 c_name = code['name']
@@ -791,32 +799,34 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
                         previous_reporting_year += 1
                     count = 1
                 
-                cdata_month_collection.delete_many({
-                    "company_code": company_id,
-                    "month": current_month,
-                    "type_year": previous_type_year,
-                    "reporting_year": previous_reporting_year,
-                    "site_code" : str(site_code),
-                    "internal_code_id": ObjectId(internal_code_id),
-                    "code_name": c_name,
-                    "code": c_code,
-                })
-                cdata_month_collection.insert_one({
-                    "company_code": company_id,
-                    "month": current_month,
-                    "type_year": previous_type_year,
-                    "reporting_year": previous_reporting_year,
-                    "qty": str(pred_value),
-                    "site_code" : str(site_code),
-                    "internal_code_id": ObjectId(internal_code_id),
-                    "code_name": c_name,
-                    "code": c_code,
-                    "value": 0,
-                    "description": "",
-                    "ref_table": "prediction",
-                    "is_forecast": True,
-                    "created_at": datetime.now()
-                })
+                with metrics.timed("mongo_write"):
+                    cdata_month_collection.delete_many({
+                        "company_code": company_id,
+                        "month": current_month,
+                        "type_year": previous_type_year,
+                        "reporting_year": previous_reporting_year,
+                        "site_code" : str(site_code),
+                        "internal_code_id": ObjectId(internal_code_id),
+                        "code_name": c_name,
+                        "code": c_code,
+                    })
+                    cdata_month_collection.insert_one({
+                        "company_code": company_id,
+                        "month": current_month,
+                        "type_year": previous_type_year,
+                        "reporting_year": previous_reporting_year,
+                        "qty": stored_qty(pred_value),
+                        "site_code" : str(site_code),
+                        "internal_code_id": ObjectId(internal_code_id),
+                        "code_name": c_name,
+                        "code": c_code,
+                        "value": 0,
+                        "description": "",
+                        "ref_table": "prediction",
+                        "is_forecast": True,
+                        "created_at": datetime.now()
+                    })
+                affected_years.add(previous_reporting_year)
                 last_reporting_count += 1
                 count += 1
                 previous_month = str(current_month)
@@ -829,6 +839,9 @@ def process_monthly_data(company_id, internal_code_id, year, start_month, site_c
             }
             
         # Retrieve the documents matching the query
+        if incremental:
+            # Only rebuild the derived levels of the reporting years written above
+            query = reporting_year_filter(query, affected_years)
         result = list(cdata_month_collection.find(query))
         # print("cdata_month_collection :: ", len(result))
         process_quarterly_data(result, company_id)
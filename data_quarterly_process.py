@@ -2,7 +2,10 @@ from pymongo import MongoClient
 from RegionAPI import fetch_company_data
 from bson.objectid import ObjectId
 from dotenv import load_dotenv
-from sarima import run_sarima
+from sarima import refit_sarima, run_sarima
+from incremental import forecast_series, forecast_state_key, history_series, reporting_year_filter
+from code_catalog import get_code_catalog
+from schema_migration import read_number, stored_qty, stored_value, type_year_match, type_year_since
 from datetime import datetime, timedelta
 from helper import get_min_year, get_next_month_name, get_function_type
 import os
@@ -10,11 +13,12 @@ import json
 import re
 from collections import defaultdict
 import db_connection
+import metrics
 import math
 
 load_dotenv()
 
-def process_quarterly_data(company_id, internal_code_id, year, start_month, site_code):
+def process_quarterly_data(company_id, internal_code_id, year, start_month, site_code, incremental=False):
     print("Complete Data :: ", company_id, internal_code_id, year, start_month, site_code)
 
     connection = db_connection.connect_to_database()
@@ -25,7 +29,7 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
         cdata_BiAnnual_collection = connection["cdata_bi_annual"]
         cdata_yearly_collection = connection["cdata_yearly"]
         cdata_collection = connection["cdata"]
-        code_collection = connection["codes"]
+        code_catalog = get_code_catalog(connection)
     else:
         print("Database connection is not available.")
    
@@ -47,29 +51,6 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
         "December": 12
     }
 
-    def get_min_year(company_code):
-        min_year_query = [
-        {"$match": {"company_code": company_code}},
-        {"$group": {"_id": None, "min_year": {"$min": "$type_year"}}}
-        ]
-        min_year_result = list(cdata_collection.aggregate(min_year_query))
-
-        if min_year_result:
-            return min_year_result[0]["min_year"]
-        else:
-            return None
-
-    def get_internal_code_ids(company_code, internal_code_ids):
-        query = {
-            "_id": {"$in": internal_code_ids}
-        }
-        projection = {
-            "code": 1, 
-            "name": 1,  
-        }
-        matching_documents = list(code_collection.find(query, projection))
-        return matching_documents
-
     def all_values_same_length(lst):
         str_lst = [str(x) for x in lst]
         
@@ -176,7 +157,7 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
     def process_BiAnnual_data(result, company_code):
 
         count = 1
-        data_type = get_function_type(allCodes)
+        data_type = get_function_type([internal_code_id])
         reporting_year_count = 1
         
         for i in range(0, len(result), 2):
@@ -218,7 +199,7 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
                     
                     quarter = f"Semester{count}"
                     c_name = " "
-                    code = next((doc for doc in allCodes if doc['_id'] == ObjectId(result[i]['internal_code_id'])), None)
+                    code = code_catalog.get(ObjectId(result[i]['internal_code_id']))
                     if code is not None:
                         c_code = code['code']
                         c_name = code['name']
@@ -228,37 +209,38 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
                     next_data = result[i+2] if i+2 < len(result) else None
                     if next_data is not None and next_data['type_year'] != result[i]['type_year']:
                         count = 0
-                    cdata_BiAnnual_collection.delete_many({
-                        "company_code": result[i]['company_code'],
-                        "semi_annual": quarter,
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": reporting_year,
-                        "qty": str(total_qty),
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": ObjectId(result[i]['internal_code_id']),
-                        "code_name": c_name,
-                        "code": c_code,
-                        "is_forecast": False,
-                    })
-                    cdata_BiAnnual_collection.insert_one({
-                        "company_code": result[i]['company_code'],
-                        "semi_annual": quarter,
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": reporting_year,
-                        "qty": str(total_qty),
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": ObjectId(result[i]['internal_code_id']),
-                        "code_name": c_name,
-                        "code": c_code,
-                        "value": total_value,
-                        "currency": result[i]['currency'],
-                        "dimension": final_dimension,
-                        "unit": result[i]['unit'],
-                        "description": result[i]['description'],
-                        "ref_table": "cdata_quarter",
-                        "is_forecast": False,
-                        "created_at": datetime.now()
-                    })
+                    with metrics.timed("mongo_write"):
+                        cdata_BiAnnual_collection.delete_many({
+                            "company_code": result[i]['company_code'],
+                            "semi_annual": quarter,
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": reporting_year,
+                            "qty": stored_qty(total_qty),
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": ObjectId(result[i]['internal_code_id']),
+                            "code_name": c_name,
+                            "code": c_code,
+                            "is_forecast": False,
+                        })
+                        cdata_BiAnnual_collection.insert_one({
+                            "company_code": result[i]['company_code'],
+                            "semi_annual": quarter,
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": reporting_year,
+                            "qty": stored_qty(total_qty),
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": ObjectId(result[i]['internal_code_id']),
+                            "code_name": c_name,
+                            "code": c_code,
+                            "value": total_value,
+                            "currency": result[i]['currency'],
+                            "dimension": final_dimension,
+                            "unit": result[i]['unit'],
+                            "description": result[i]['description'],
+                            "ref_table": "cdata_quarter",
+                            "is_forecast": False,
+                            "created_at": datetime.now()
+                        })
                     
                     sarima_array.append(total_qty)
                     count += 1 
@@ -268,7 +250,7 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
                     total_value = sum(safe_int(obj['value']) for obj in group)
                     quarter = f"Semester{count}"
                     c_name = " "
-                    code = next((doc for doc in allCodes if doc['_id'] == ObjectId(result[i]['internal_code_id'])), None)
+                    code = code_catalog.get(ObjectId(result[i]['internal_code_id']))
                     if code is not None:
                         c_code = code['code']
                         c_name = code['name']
@@ -278,33 +260,34 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
                     next_data = result[i+2] if i+2 < len(result) else None
                     if next_data is not None and next_data['type_year'] != result[i]['type_year']:
                         count = 0
-                    cdata_BiAnnual_collection.delete_many({
-                        "company_code": result[i]['company_code'],
-                        "semi_annual": quarter,
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": reporting_year,
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": ObjectId(result[i]['internal_code_id']),
-                        "code_name": c_name,
-                        "code": c_code,
-                        "is_forecast": True,
-                    })
-                    cdata_BiAnnual_collection.insert_one({
-                        "company_code": result[i]['company_code'],
-                        "semi_annual": quarter,
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": reporting_year,
-                        "qty": str(total_qty),
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": ObjectId(result[i]['internal_code_id']),
-                        "code_name": c_name,
-                        "code": c_code,
-                        "value": total_value,
-                        "description": result[i]['description'],
-                        "ref_table": "cdata",
-                        "is_forecast": True,
-                        "created_at": datetime.now()
-                    })
+                    with metrics.timed("mongo_write"):
+                        cdata_BiAnnual_collection.delete_many({
+                            "company_code": result[i]['company_code'],
+                            "semi_annual": quarter,
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": reporting_year,
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": ObjectId(result[i]['internal_code_id']),
+                            "code_name": c_name,
+                            "code": c_code,
+                            "is_forecast": True,
+                        })
+                        cdata_BiAnnual_collection.insert_one({
+                            "company_code": result[i]['company_code'],
+                            "semi_annual": quarter,
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": reporting_year,
+                            "qty": stored_qty(total_qty),
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": ObjectId(result[i]['internal_code_id']),
+                            "code_name": c_name,
+                            "code": c_code,
+                            "value": total_value,
+                            "description": result[i]['description'],
+                            "ref_table": "cdata",
+                            "is_forecast": True,
+                            "created_at": datetime.now()
+                        })
                     
                     sarima_array.append(total_qty)
                     count += 1 
@@ -313,7 +296,7 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
     # Yearly Start 
     def process_yearly_data(result, company_code):
         count = 1
-        data_type = get_function_type(allCodes)
+        data_type = get_function_type([internal_code_id])
         for i in range(0, len(result), 4):
             group = result[i:i+4]
             if len(group) >= 4:
@@ -340,7 +323,7 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
                         if len(merged_objects) > 0:
                             final_dimension = merge_objects(merged_objects)
                     c_name = " "
-                    code = next((doc for doc in allCodes if doc['_id'] == ObjectId(result[i]['internal_code_id'])), None)
+                    code = code_catalog.get(ObjectId(result[i]['internal_code_id']))
                     if code is not None:
                         c_code = code['code']
                         c_name = code['name']
@@ -350,41 +333,42 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
                     next_data = result[i+4] if i+4 < len(result) else None
                     if next_data is not None and next_data['type_year'] != result[i]['type_year']:
                         count = 0
-                    cdata_yearly_collection.delete_many({
-                        "company_code": result[i]['company_code'],
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": result[i]['internal_code_id'],
-                        "code_name": c_name,                                       
-                        "code": c_code,
-                        "is_forecast": False,
-                    })
-                    cdata_yearly_collection.insert_one({
-                        "company_code": result[i]['company_code'],
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "qty": str(total_qty),
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": result[i]['internal_code_id'],
-                        "code_name": c_name,
-                        "code": c_code,
-                        "value": total_value,
-                        "currency": result[i]['currency'],
-                        "dimension": final_dimension,
-                        "unit": result[i]['unit'],
-                        "description": result[i]['description'],
-                        "ref_table": "cdata_quarter",
-                        "is_forecast": False,
-                        "created_at": datetime.now()
-                    })
+                    with metrics.timed("mongo_write"):
+                        cdata_yearly_collection.delete_many({
+                            "company_code": result[i]['company_code'],
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": result[i]['internal_code_id'],
+                            "code_name": c_name,                                       
+                            "code": c_code,
+                            "is_forecast": False,
+                        })
+                        cdata_yearly_collection.insert_one({
+                            "company_code": result[i]['company_code'],
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "qty": stored_qty(total_qty),
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": result[i]['internal_code_id'],
+                            "code_name": c_name,
+                            "code": c_code,
+                            "value": total_value,
+                            "currency": result[i]['currency'],
+                            "dimension": final_dimension,
+                            "unit": result[i]['unit'],
+                            "description": result[i]['description'],
+                            "ref_table": "cdata_quarter",
+                            "is_forecast": False,
+                            "created_at": datetime.now()
+                        })
                     
                     sarima_array.append(total_qty)
                     count += 1 
                 else:
                     total_qty = sum(safe_int(obj['qty']) for obj in group)
                     c_name = " "
-                    code = next((doc for doc in allCodes if doc['_id'] == ObjectId(result[i]['internal_code_id'])), None)
+                    code = code_catalog.get(ObjectId(result[i]['internal_code_id']))
                     if code is not None:
                         c_code = code['code']
                         c_name = code['name']
@@ -394,36 +378,38 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
                     next_data = result[i+4] if i+4 < len(result) else None
                     if next_data is not None and next_data['type_year'] != result[i]['type_year']:
                         count = 0
-                    cdata_yearly_collection.delete_many({
-                        "company_code": result[i]['company_code'],
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": result[i]['internal_code_id'],
-                        "code_name": c_name,                                       
-                        "code": c_code,
-                        "is_forecast": True,
-                    })
+                    with metrics.timed("mongo_write"):
+                        cdata_yearly_collection.delete_many({
+                            "company_code": result[i]['company_code'],
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": result[i]['internal_code_id'],
+                            "code_name": c_name,                                       
+                            "code": c_code,
+                            "is_forecast": True,
+                        })
                     
-                    cdata_yearly_collection.insert_one({
-                        "company_code": result[i]['company_code'],
-                        "type_year": result[i]['type_year'],
-                        "reporting_year": result[i]['reporting_year'],
-                        "qty": str(total_qty),
-                        "site_code": result[i]['site_code'],
-                        "internal_code_id": (result[i]['internal_code_id']),
-                        "code_name": c_name,
-                        "code": c_code,
-                        "description": result[i]['description'],
-                        "is_forecast": True,
-                        "created_at": datetime.now()
-                    })
+                    with metrics.timed("mongo_write"):
+                        cdata_yearly_collection.insert_one({
+                            "company_code": result[i]['company_code'],
+                            "type_year": result[i]['type_year'],
+                            "reporting_year": result[i]['reporting_year'],
+                            "qty": stored_qty(total_qty),
+                            "site_code": result[i]['site_code'],
+                            "internal_code_id": (result[i]['internal_code_id']),
+                            "code_name": c_name,
+                            "code": c_code,
+                            "description": result[i]['description'],
+                            "is_forecast": True,
+                            "created_at": datetime.now()
+                        })
                     
                     sarima_array.append(total_qty)
                     count += 1 
     # Yearly End 
 
-    get_company_year = get_min_year(company_id)
+    get_company_year = get_min_year(company_id, cdata_collection)
 
     if get_company_year is not None:
 
@@ -443,26 +429,25 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
             "type": "actual",
             "site_code": str(site_code),
             "is_aggregated": False,
-            "$or": [
-                {
-                    "$and": [
-                        {"type_year": str(min_year)},
-                        {"quarter": {"$exists": True, "$nin": [None, ""]}}
-                    ]
-                },
-                {
-                    "type_year": {"$gt": str(min_year)},
-                    "quarter": {"$exists": True, "$nin": [None, ""]}
-                }
-            ]
+            "quarter": {"$exists": True, "$nin": [None, ""]},
+            **type_year_since(min_year)
         }
 
-        documents = list(cdata_collection.find(query))
-        cdata = sorted(documents, key=lambda x: x["type_year"])
-        ids = get_unique_code_ids(cdata)
-        allCodes = get_internal_code_ids(company_id, ids)
+        def period_order(doc):
+            return int(doc["type_year"])
+
+        def series_value(doc):
+            qty = doc.get("qty")
+            if qty is None or qty == "":
+                return None
+            return read_number(qty, extract_number_from_string)
+
+        with metrics.timed("cdata_read"):
+            documents = list(cdata_collection.find(query))
+        cdata = sorted(documents, key=period_order)
 
         sarima_array = []
+        affected_years = set()
         count =  1
         sarima_group = []
 
@@ -470,7 +455,7 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
             first_record = cdata[0]
             last_record = cdata[-1]
             c_name= " "
-            code = next((doc for doc in allCodes if doc['_id'] == entry["internal_code_id"]), None)
+            code = code_catalog.get(entry["internal_code_id"])
             if code is not None:
                 c_code = code['code']
                 c_name = code['name']
@@ -501,62 +486,67 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
             narration = entry.get("narration", "")
             url = entry.get("url", "")
             description = f"{narration} {url}" 
-            cdata_collection.update_many({
-                "company_code": company_id,
-                "quarter": entry.get("quarter", ""),
-                "site_code" : str(site_code),
-                "type": "actual",
-                "type_year": str(entry.get("type_year", "")),
-                "internal_code_id": entry.get("internal_code_id", ""),
-                },
-                {"$set": {"is_aggregated": True}}
-            ) 
-            cdata_quarter_collection.delete_many({
-                "company_code": company_id,
-                "quarter": entry.get("quarter", ""),
-                "type_year": int(entry.get("type_year", "")),
-                "reporting_year": reporting_year,
-                "qty": str(final_qty),
-                "site_code" : str(site_code),
-                "code_name": c_name,
-                "code": c_code,
-                "internal_code_id": entry.get("internal_code_id", ""),
-                "is_forecast": False,
-            })
-            cdata_quarter_collection.insert_one({
-                "company_code": company_id,
-                "quarter": entry.get("quarter", ""),
-                "type_year": int(entry.get("type_year", "")),
-                "reporting_year": reporting_year,
-                "qty": str(final_qty),
-                "site_code" : str(site_code),
-                "internal_code_id": entry.get("internal_code_id", ""),
-                "code_name": c_name,
-                "code": c_code,
-                "value": entry.get("value", ""),
-                "currency": entry.get("currency", ""),
-                "dimension": entry.get("dimension", ""),
-                "unit": entry.get("unit", ""),
-                "description": description,
-                "ref_table": "cdata",
-                "is_forecast": False,
-                "created_at": datetime.now()
-            })
+            with metrics.timed("mongo_write"):
+                cdata_collection.update_many({
+                    "company_code": company_id,
+                    "quarter": entry.get("quarter", ""),
+                    "site_code" : str(site_code),
+                    "type": "actual",
+                    "type_year": type_year_match(entry.get("type_year", "")),
+                    "internal_code_id": entry.get("internal_code_id", ""),
+                    },
+                    {"$set": {"is_aggregated": True}}
+                ) 
+                cdata_quarter_collection.delete_many({
+                    "company_code": company_id,
+                    "quarter": entry.get("quarter", ""),
+                    "type_year": int(entry.get("type_year", "")),
+                    "reporting_year": reporting_year,
+                    "qty": stored_qty(final_qty),
+                    "site_code" : str(site_code),
+                    "code_name": c_name,
+                    "code": c_code,
+                    "internal_code_id": entry.get("internal_code_id", ""),
+                    "is_forecast": False,
+                })
+                cdata_quarter_collection.insert_one({
+                    "company_code": company_id,
+                    "quarter": entry.get("quarter", ""),
+                    "type_year": int(entry.get("type_year", "")),
+                    "reporting_year": reporting_year,
+                    "qty": stored_qty(final_qty),
+                    "site_code" : str(site_code),
+                    "internal_code_id": entry.get("internal_code_id", ""),
+                    "code_name": c_name,
+                    "code": c_code,
+                    "value": stored_value(entry.get("value", "")),
+                    "currency": entry.get("currency", ""),
+                    "dimension": entry.get("dimension", ""),
+                    "unit": entry.get("unit", ""),
+                    "description": description,
+                    "ref_table": "cdata",
+                    "is_forecast": False,
+                    "created_at": datetime.now()
+                })
             cdata_last_reporting_year = reporting_year
+            affected_years.add(reporting_year)
             count += 1
-            
-            qty = entry.get("qty")
-            # print("qty before :: ", qty)
-            if qty is not None and qty != "":
-                number = extract_number_from_string(qty)
-                if number is not None and number != "":
-                    # print("qty after :: ", number)
-                    sarima_array.append(int(number))
+
+        # Forecast from the whole actual history, not just the rows aggregated in this run
+        if cdata:
+            sarima_array, history_last = history_series(cdata_collection, query, period_order, series_value)
+            if period_order(history_last) != period_order(last_record):
+                # Backfill behind the latest actual year: the stored forecast still follows that year
+                print("History backfilled, keeping stored forecast :: ", internal_code_id, site_code)
+                sarima_array = []
 
         sarima_predictions = []
         if len(sarima_array) != 0:
             if len(sarima_array) >=2:
-                sarima_predictions = run_sarima(sarima_array, predictedValue=11, m=4)
+                sarima_predictions = forecast_series(
+                    connection, forecast_state_key(company_id, internal_code_id, site_code, "quater"),
+                    sarima_array, incremental, run_sarima, refit_fn=refit_sarima, predictedValue=11, m=4
+                )
 
         if sarima_predictions is not None and len(sarima_predictions) > 0:
             next_year = int(last_record['type_year'])
@@ -564,7 +554,7 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
             last_reporting_count = last_record['quarter']
             c_code = " "
             c_name = " "
-            code = next((doc for doc in allCodes if doc['_id'] == entry["internal_code_id"]), None)
+            code = code_catalog.get(entry["internal_code_id"])
             if code is not None:
                 c_code = code['code']
                 c_name = code['name']
@@ -581,32 +571,34 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
                     last_record['quarter'] = ''  
                     last_reporting_year += 1
                     
-                cdata_quarter_collection.delete_many({
-                    "company_code": company_id,
-                    "quarter": next_quarter,
-                    "type_year": next_year,
-                    "reporting_year": last_reporting_year,
-                    "site_code" : str(site_code),
-                    "internal_code_id": ObjectId(internal_code_id),
-                    "code_name": c_name,
-                    "code": c_code,
-                    "is_forecast": True,
-                })
-                cdata_quarter_collection.insert_one({
-                    "company_code": company_id,
-                    "quarter": next_quarter,
-                    "type_year": next_year,
-                    "reporting_year": last_reporting_year,
-                    "qty": str(pred_value),
-                    "site_code" : str(site_code),
-                    "internal_code_id": ObjectId(internal_code_id),
-                    "code_name": c_name,
-                    "code": c_code,
-                    "value": 0,
-                    "description": " ",
-                    "is_forecast": True,
-                    "created_at": datetime.now()
-                })
+                with metrics.timed("mongo_write"):
+                    cdata_quarter_collection.delete_many({
+                        "company_code": company_id,
+                        "quarter": next_quarter,
+                        "type_year": next_year,
+                        "reporting_year": last_reporting_year,
+                        "site_code" : str(site_code),
+                        "internal_code_id": ObjectId(internal_code_id),
+                        "code_name": c_name,
+                        "code": c_code,
+                        "is_forecast": True,
+                    })
+                    cdata_quarter_collection.insert_one({
+                        "company_code": company_id,
+                        "quarter": next_quarter,
+                        "type_year": next_year,
+                        "reporting_year": last_reporting_year,
+                        "qty": stored_qty(pred_value),
+                        "site_code" : str(site_code),
+                        "internal_code_id": ObjectId(internal_code_id),
+                        "code_name": c_name,
+                        "code": c_code,
+                        "value": 0,
+                        "description": " ",
+                        "is_forecast": True,
+                        "created_at": datetime.now()
+                    })
+                affected_years.add(last_reporting_year)
                 last_reporting_count = next_quarter
 
         
@@ -616,6 +608,9 @@ def process_quarterly_data(company_id, internal_code_id, year, start_month, site
                 "internal_code_id": ObjectId(internal_code_id)
             }
 
+        if incremental:
+            # Only rebuild the derived levels of the reporting years written above
+            query = reporting_year_filter(query, affected_years)
         result = list(cdata_quarter_collection.find(query))
         process_BiAnnual_data(result, company_id)
         process_yearly_data(result, company_id)
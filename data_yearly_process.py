@@ -2,7 +2,10 @@ from pymongo import MongoClient
 from RegionAPI import fetch_company_data
 from bson.objectid import ObjectId
 from dotenv import load_dotenv
-from sarima import run_sarima
+from sarima import refit_sarima, run_sarima
+from incremental import forecast_series, forecast_state_key, history_series
+from code_catalog import get_code_catalog
+from schema_migration import read_number, stored_qty, stored_value, type_year_match, type_year_since
 from datetime import datetime, timedelta
 import os
 import json
@@ -10,10 +13,11 @@ import re
 from collections import defaultdict
 from helper import get_min_year, get_next_month_name, get_function_type
 import db_connection
+import metrics
 
 load_dotenv()
 
-def process_yearly_data(company_id, internal_code_id, year, start_month, site_code):
+def process_yearly_data(company_id, internal_code_id, year, start_month, site_code, incremental=False):
     print("Detail :: ", company_id, internal_code_id, year, start_month, site_code)
     
     connection = db_connection.connect_to_database()
@@ -24,7 +28,7 @@ def process_yearly_data(company_id, internal_code_id, year, start_month, site_co
         cdata_BiAnnual_collection = connection["cdata_bi_annual"]
         cdata_yearly_collection = connection["cdata_yearly"]
         cdata_collection = connection["cdata"]
-        code_collection = connection["codes"]
+        code_catalog = get_code_catalog(connection)
     else:
         print("Database connection is not available.")
 
@@ -45,29 +49,6 @@ def process_yearly_data(company_id, internal_code_id, year, start_month, site_co
         "December": 12
     }
 
-    def get_min_year(company_code):
-        min_year_query = [
-        {"$match": {"company_code": company_code}},
-        {"$group": {"_id": None, "min_year": {"$min": "$type_year"}}}
-        ]
-        min_year_result = list(cdata_collection.aggregate(min_year_query))
-
-        if min_year_result:
-            return min_year_result[0]["min_year"]
-        else:
-            return None
-
-    def get_internal_code_ids(company_code, internal_code_ids):
-        query = {
-            "_id": {"$in": internal_code_ids}
-        }
-        projection = {
-            "code": 1, 
-            "name": 1,  
-        }
-        matching_documents = list(code_collection.find(query, projection))
-        return matching_documents
-
     def all_values_same_length(lst):
         str_lst = [str(x) for x in lst]
         
@@ -148,7 +129,7 @@ def process_yearly_data(company_id, internal_code_id, year, start_month, site_co
                 
         return list(merged.values())
 
-    get_company_year = get_min_year(company_id)
+    get_company_year = get_min_year(company_id, cdata_collection)
 
     if get_company_year is not None:
         get_company_year = int(get_company_year)
@@ -170,16 +151,21 @@ def process_yearly_data(company_id, internal_code_id, year, start_month, site_co
             "quarter": "",
             "is_aggregated": False,
             "site_code": str(site_code),
-            "$or": [
-                {"type_year": {"$eq": str(min_year)}},
-                {"type_year": {"$gt": str(min_year)}}
-            ]
+            **type_year_since(min_year)
         }
 
-        documents = list(cdata_collection.find(query))
-        cdata = sorted(documents, key=lambda x: x["type_year"])
-        ids = get_unique_code_ids(cdata)
-        allCodes = get_internal_code_ids(company_id, ids)
+        def period_order(doc):
+            return int(doc["type_year"])
+
+        def series_value(doc):
+            qty = doc.get("qty")
+            if qty is None or qty == "":
+                return None
+            return read_number(qty, extract_number_from_string)
+
+        with metrics.timed("cdata_read"):
+            documents = list(cdata_collection.find(query))
+        cdata = sorted(documents, key=period_order)
 
         sarima_array = []
         count =  1
@@ -188,7 +174,7 @@ def process_yearly_data(company_id, internal_code_id, year, start_month, site_co
             first_record = cdata[0]
             last_record = cdata[-1]
             c_name = " "
-            code = next((doc for doc in allCodes if doc['_id'] == entry["internal_code_id"]), None)
+            code = code_catalog.get(entry["internal_code_id"])
             if code is not None:
                 c_code = code['code']
                 c_name = code['name']
@@ -212,7 +198,7 @@ def process_yearly_data(company_id, internal_code_id, year, start_month, site_co
             
             qty_value =  entry.get("qty", "")
 
-            data_type = get_function_type(allCodes)
+            data_type = get_function_type([internal_code_id])
 
             if qty_value is not None and qty_value != "":
                     if isinstance(qty_value, str):
@@ -229,65 +215,72 @@ def process_yearly_data(company_id, internal_code_id, year, start_month, site_co
             narration = entry.get("narration", "")
             url = entry.get("url", "")
             description = f"{narration} {url}"
-            cdata_collection.update_many({
-                "company_code": company_id,
-                "site_code" : str(site_code),
-                "month": entry.get("month", ""),
-                "type": "actual",
-                "type_year": str(entry.get("type_year", "")),
-                "internal_code_id": entry.get("internal_code_id", ""),
-                },
-                {"$set": {"is_aggregated": True}}
-            )
-            cdata_yearly_collection.delete_many({   #completed
-                "company_code": company_id,
-                "month": entry.get("month", ""),
-                "type_year": int(entry.get("type_year", "")),
-                "reporting_year": reporting_year,
-                "site_code" : str(site_code),
-                "internal_code_id": entry.get("internal_code_id", ""),
-                "code_name": c_name,
-                "code": c_code,
-                "is_forecast": False,
-            })
-            cdata_yearly_collection.insert_one({
-                "company_code": company_id,
-                "month": entry.get("month", ""),
-                "type_year": int(entry.get("type_year", "")),
-                "reporting_year": reporting_year,
-                "qty": str(final_qty),
-                "site_code" : str(site_code),
-                "internal_code_id": entry.get("internal_code_id", ""),
-                "code_name": c_name,
-                "code": c_code,
-                "value": entry.get("value", ""),
-                "currency": entry.get("currency", ""),
-                "dimension": entry.get("dimension", ""),
-                "unit": entry.get("unit", ""),
-                "description": description,
-                "ref_table": "cdata",
-                "is_forecast": False,
-                "created_at": datetime.now()
-            })
+            with metrics.timed("mongo_write"):
+                cdata_collection.update_many({
+                    "company_code": company_id,
+                    "site_code" : str(site_code),
+                    "month": entry.get("month", ""),
+                    "type": "actual",
+                    "type_year": type_year_match(entry.get("type_year", "")),
+                    "internal_code_id": entry.get("internal_code_id", ""),
+                    },
+                    {"$set": {"is_aggregated": True}}
+                )
+                cdata_yearly_collection.delete_many({   #completed
+                    "company_code": company_id,
+                    "month": entry.get("month", ""),
+                    "type_year": int(entry.get("type_year", "")),
+                    "reporting_year": reporting_year,
+                    "site_code" : str(site_code),
+                    "internal_code_id": entry.get("internal_code_id", ""),
+                    "code_name": c_name,
+                    "code": c_code,
+                    "is_forecast": False,
+                })
+                cdata_yearly_collection.insert_one({
+                    "company_code": company_id,
+                    "month": entry.get("month", ""),
+                    "type_year": int(entry.get("type_year", "")),
+                    "reporting_year": reporting_year,
+                    "qty": stored_qty(final_qty),
+                    "site_code" : str(site_code),
+                    "internal_code_id": entry.get("internal_code_id", ""),
+                    "code_name": c_name,
+                    "code": c_code,
+                    "value": stored_value(entry.get("value", "")),
+                    "currency": entry.get("currency", ""),
+                    "dimension": entry.get("dimension", ""),
+                    "unit": entry.get("unit", ""),
+                    "description": description,
+                    "ref_table": "cdata",
+                    "is_forecast": False,
+                    "created_at": datetime.now()
+                })
             count += 1
             last_report_year = reporting_year
-            qty = entry.get("qty")
-            if qty is not None and qty != "":
-                number = extract_number_from_string(qty)
-                if number is not None and number != "":
-                    sarima_array.append(int(number))
+
+        # Forecast from the whole actual history, not just the rows aggregated in this run
+        if cdata:
+            sarima_array, history_last = history_series(cdata_collection, query, period_order, series_value)
+            if period_order(history_last) != period_order(last_record):
+                # Backfill behind the latest actual year: the stored forecast still follows that year
+                print("History backfilled, keeping stored forecast :: ", internal_code_id, site_code)
+                sarima_array = []
 
         sarima_predictions = []
         if len(sarima_array) != 0:
             if len(sarima_array) >= 2:
-                sarima_predictions = run_sarima(sarima_array, predictedValue=5, m=0)
+                sarima_predictions = forecast_series(
+                    connection, forecast_state_key(company_id, internal_code_id, site_code, "annual"),
+                    sarima_array, incremental, run_sarima, refit_fn=refit_sarima, predictedValue=5, m=0
+                )
 
         if sarima_predictions is not None and len(sarima_predictions) > 0:
             next_year = int(last_record['type_year']) + 1
             last_reporting_year = int(last_report_year) + 1
             c_code = " "
             c_name = " "
-            code = next((doc for doc in allCodes if doc['_id'] == entry["internal_code_id"]), None)
+            code = code_catalog.get(entry["internal_code_id"])
             if code is not None:
                 c_code = code['code']
                 c_name = code['name']
@@ -295,29 +288,30 @@ def process_yearly_data(company_id, internal_code_id, year, start_month, site_co
                 c_code = " "
                 c_name = " "
             for idx, pred_value in enumerate(sarima_predictions):
-                cdata_yearly_collection.delete_many({
-                    "company_code": company_id,
-                    "type_year": next_year,
-                    "reporting_year": last_reporting_year,
-                    "site_code" : str(site_code),
-                    "internal_code_id": ObjectId(internal_code_id),
-                    "code": c_code,
-                    "code_name": c_name,
-                    "is_forecast": True,
-                })
-                cdata_yearly_collection.insert_one({
-                    "company_code": company_id,
-                    "type_year": next_year,
-                    "reporting_year": last_reporting_year,
-                    "qty": str(pred_value),
-                    "value": 0,
-                    "site_code" : str(site_code),
-                    "internal_code_id": ObjectId(internal_code_id),
-                    "code": c_code,
-                    "description": "",
-                    "code_name": c_name,
-                    "is_forecast": True,
-                    "created_at": datetime.now()
-                })
+                with metrics.timed("mongo_write"):
+                    cdata_yearly_collection.delete_many({
+                        "company_code": company_id,
+                        "type_year": next_year,
+                        "reporting_year": last_reporting_year,
+                        "site_code" : str(site_code),
+                        "internal_code_id": ObjectId(internal_code_id),
+                        "code": c_code,
+                        "code_name": c_name,
+                        "is_forecast": True,
+                    })
+                    cdata_yearly_collection.insert_one({
+                        "company_code": company_id,
+                        "type_year": next_year,
+                        "reporting_year": last_reporting_year,
+                        "qty": stored_qty(pred_value),
+                        "value": 0,
+                        "site_code" : str(site_code),
+                        "internal_code_id": ObjectId(internal_code_id),
+                        "code": c_code,
+                        "description": "",
+                        "code_name": c_name,
+                        "is_forecast": True,
+                        "created_at": datetime.now()
+                    })
                 next_year += 1
                 last_reporting_year += 1
@@ -1,21 +1,173 @@
+"""
+The process-wide MongoDB client.
+
+Every module gets its database through connect_to_database() (or the shared
+client through get_client()), so a process holds one connection pool and one
+set of monitor threads. The client is configured from the environment:
+
+- MONGODB_URL (MONGODB_URI is accepted for older scripts), MONGODB_DB_NAME
+- MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_MAX_IDLE_TIME_MS
+- MONGO_DIRECT_CONNECTION; when unset, directConnection is used only for a
+  single-host, non-SRV URL without replicaSet (a replica set needs discovery)
+- MONGO_COMPRESSORS, e.g. "zstd,snappy,zlib"; zstd and snappy need the
+  zstandard / python-snappy packages and are skipped when those are missing
+- MONGO_SERVER_SELECTION_TIMEOUT_MS, MONGO_CONNECT_TIMEOUT_MS,
+  MONGO_SOCKET_TIMEOUT_MS, MONGO_WAIT_QUEUE_TIMEOUT_MS
+- MONGO_CONCERN_PROFILE: default read / write concern profile (CONCERN_PROFILES)
+
+Callers that need other settings (a standalone script's own URL, a longer
+server-selection timeout) pass them to get_client(url=..., **overrides) and
+get a separate shared client for that combination.
+
+Connection churn (connections created / closed, checkout failures, pool
+clears) is exported by the pool listener in metrics.py.
+"""
 import logging
 import sys
 import os
-from pymongo import MongoClient
+import threading
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qs
 
+from pymongo import MongoClient, ReadPreference
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+import metrics  # registers the Mongo metrics listeners before any client is created
+
+logger = logging.getLogger(__name__)
+
+# Read / write concern per workload; "default" uses the server / URL defaults
+CONCERN_PROFILES = {
+    "default": {},
+    # Aggregate rows are rebuilt on every run: acknowledged writes are enough
+    "bulk": {"write_concern": WriteConcern(w=1, j=False)},
+    # Ledgers, leases and migrations must survive a failover
+    "durable": {"write_concern": WriteConcern(w="majority", j=True), "read_concern": ReadConcern("majority"),
+                "read_preference": ReadPreference.PRIMARY},
+    # Reporting reads that tolerate slightly stale data
+    "analytics": {"read_concern": ReadConcern("local"), "read_preference": ReadPreference.SECONDARY_PREFERRED},
+}
 
 _connection = None
+_clients: Dict[Tuple, MongoClient] = {}
+_async_connection = None
+_lock = threading.Lock()
 
-def connect_to_database():
-    try:
-        global _connection
-        MONGODB_URL = os.getenv("MONGODB_URL", "")
-        MONGODB_DB_NAME = os.getenv("MONGODB_DB_NAME", "")
 
-        if not _connection:
-            _connection = MongoClient(MONGODB_URL, serverSelectionTimeoutMS=5000, directConnection=True)
-        return _connection[MONGODB_DB_NAME]
+def _int_setting(name: str, default: Optional[int]) -> Optional[int]:
+    value = os.getenv(name, "")
+    return int(value) if value.strip() else default
+
+
+def _compressors() -> Optional[str]:
+    """MONGO_COMPRESSORS without the ones whose libraries are not installed"""
+    requested = [c.strip() for c in os.getenv("MONGO_COMPRESSORS", "").split(",") if c.strip()]
+    modules = {"zstd": "zstandard", "snappy": "snappy"}
+    available = []
+    for compressor in requested:
+        try:
+            if compressor in modules:
+                __import__(modules[compressor])
+            available.append(compressor)
+        except ImportError:
+            logger.warning(f"Mongo compressor '{compressor}' needs the {modules[compressor]} package, skipping it")
+    return ",".join(available) or None
+
+
+def _direct_connection(url: str) -> bool:
+    """MONGO_DIRECT_CONNECTION, else True only for a single-host, non-SRV URL outside a replica set"""
+    setting = os.getenv("MONGO_DIRECT_CONNECTION", "").strip().lower()
+    if setting:
+        return setting in ("1", "true", "yes")
+    if url.startswith("mongodb+srv://"):
+        return False
+    rest = url.split("://", 1)[-1]
+    hosts, _, query = rest.partition("?")
+    hosts = hosts.split("/", 1)[0].rpartition("@")[2]
+    if "replicaSet" in parse_qs(query):
+        return False
+    return "," not in hosts
+
+
+def client_options(url: Optional[str] = None) -> Dict[str, Any]:
+    """Keyword arguments for the shared (sync or async) client of url (MONGODB_URL by default)"""
+    options = {
+        "maxPoolSize": _int_setting("MONGO_MAX_POOL_SIZE", 100),
+        "minPoolSize": _int_setting("MONGO_MIN_POOL_SIZE", 0),
+        "maxIdleTimeMS": _int_setting("MONGO_MAX_IDLE_TIME_MS", None),
+        "serverSelectionTimeoutMS": _int_setting("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+        "connectTimeoutMS": _int_setting("MONGO_CONNECT_TIMEOUT_MS", 20000),
+        "socketTimeoutMS": _int_setting("MONGO_SOCKET_TIMEOUT_MS", None),
+        "waitQueueTimeoutMS": _int_setting("MONGO_WAIT_QUEUE_TIMEOUT_MS", None),
+        "directConnection": _direct_connection(_mongodb_url() if url is None else url),
+        "appname": os.getenv("MONGO_APP_NAME", "aggregation"),
+    }
+    compressors = _compressors()
+    if compressors:
+        options["compressors"] = compressors
+    return {key: value for key, value in options.items() if value is not None}
+
+
+def _mongodb_url() -> str:
+    return os.getenv("MONGODB_URL", "") or os.getenv("MONGODB_URI", "")
+
+
+def _create_client(url: str, overrides: Dict[str, Any]) -> MongoClient:
+    options = {**client_options(url), **overrides}
+    client = MongoClient(url, **options)
+    metrics.inc("mongo_clients_created_total", driver="pymongo")
+    logger.info(f"Created Mongo client (pool {options['maxPoolSize']}, "
+                f"compressors {options.get('compressors', 'none')})")
+    return client
+
+
+def get_client(url: Optional[str] = None, **overrides) -> MongoClient:
+    """
+    The shared MongoClient, created on first use. A url other than MONGODB_URL
+    or client option overrides (e.g. serverSelectionTimeoutMS=30000) get their
+    own client, shared by every caller asking for the same combination.
+    """
+    global _connection
+    if url is None and not overrides:
+        if _connection is None:
+            with _lock:
+                if _connection is None:
+                    _connection = _create_client(_mongodb_url(), {})
+        return _connection
+
+    url = _mongodb_url() if url is None else url
+    key = (url, tuple(sorted(overrides.items())))
+    with _lock:
+        if key not in _clients:
+            _clients[key] = _create_client(url, overrides)
+        return _clients[key]
+
+
+def _database(client, profile: Optional[str]):
+    profile = profile or os.getenv("MONGO_CONCERN_PROFILE", "default")
+    if profile not in CONCERN_PROFILES:
+        raise ValueError(f"Unknown Mongo concern profile {profile!r}, expected one of {', '.join(CONCERN_PROFILES)}")
+    return client.get_database(os.getenv("MONGODB_DB_NAME", ""), **CONCERN_PROFILES[profile])
+
+
+def connect_to_database(profile: Optional[str] = None):
+    """Database handle on the shared client, with the read / write concerns of a CONCERN_PROFILES entry"""
+    try:
+        client = get_client()
 
     except Exception as e:
         print("Failed to connect to the database: %s", str(e))
         sys.exit(1)
+    return _database(client, profile)
+
+def connect_to_database_async(profile: Optional[str] = None):
+    """Get the database handle for the async (motor) driver used by the ASGI app.
+    Must be called from inside the running event loop."""
+    global _async_connection
+    # Imported lazily so the sync service does not need motor installed
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    if not _async_connection:
+        _async_connection = AsyncIOMotorClient(_mongodb_url(), **client_options())
+        metrics.inc("mongo_clients_created_total", driver="motor")
+    return _database(_async_connection, profile)
@@ -1,4 +1,4 @@
-from pymongo import MongoClient
+import db_connection
 from RegionAPI import fetch_company_data
 from bson.objectid import ObjectId
 from dotenv import load_dotenv
@@ -14,12 +14,8 @@ load_dotenv()
 
 def process_monthly_data(company_id, internal_code_id, year, start_month, site_code):
     print("Company Details :: ", company_id, internal_code_id, year, start_month, site_code)
-    MONGODB_URL = os.getenv("MONGODB_URL", "")
-    MONGODB_DB_NAME = os.getenv("MONGODB_DB_NAME", "")
-
-    # Connect to MongoDB
-    client = MongoClient(MONGODB_URL)
-    db = client[MONGODB_DB_NAME]
+    # Connect to MongoDB through the shared client
+    db = db_connection.connect_to_database()
     cdata_month_collection = db["cdata_month"]
     cdata_quarter_collection = db["cdata_quarter"]
     cdata_BiAnnual_collection = db["cdata_bi_annual"]
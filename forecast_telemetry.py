@@ -0,0 +1,190 @@
+"""
+Telemetry for the run_sarima model tournament.
+
+Every run_sarima call builds a ForecastRunReport: the series length, the
+detected seasonality, fit time / score / failure reason per candidate model and
+the model that was finally selected. A finished report is
+
+- logged as one line,
+- folded into metrics (forecast_model_duration_seconds,
+  forecast_model_runs_total{model,outcome}, forecast_model_wins_total{model},
+  forecast_series_length), so it shows on /metrics and is carried back from
+  the CPU process pool like every other metric,
+- handed to the caller through collect_report(), which forecast_series uses to
+  keep the selected model per (company, code, site, frequency).
+
+A warm-started refit (sarima.refit_sarima) that fails and falls back to the
+tournament is added to that tournament's report as a failed candidate.
+
+model_report() turns those metrics into a per-model table (runs, failures,
+wins, win rate, fit time) for the /forecast/model-report endpoint and the run
+summary.
+"""
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+OUTCOME_SCORED = "scored"
+OUTCOME_FAILED = "failed"
+OUTCOME_REJECTED = "rejected"  # scored, but its forecast was flat or non-positive
+OUTCOME_SKIPPED = "skipped"  # not fitted, see model_selection
+
+_last_report = threading.local()
+
+
+class ForecastRunReport:
+    def __init__(self, series_length: int, horizon: int):
+        self.series_length = series_length
+        self.horizon = horizon
+        self.seasonality_period: Optional[int] = None
+        self.candidates: List[Dict[str, Any]] = []
+        self.selected: Optional[str] = None
+        self.method: Optional[str] = None
+        self.params: Optional[List[float]] = None
+        self._started = time.perf_counter()
+
+    def add_candidate(self, model: str, duration: float, score: Optional[float] = None,
+                      error: Optional[str] = None) -> None:
+        # Warm-started refits have no tournament score; only an error or an infinite score means failure
+        failed = error is not None or (score is not None and score == float('inf'))
+        self.candidates.append({
+            "model": model,
+            "duration_seconds": round(duration, 6),
+            "score": None if failed or score is None else float(score),
+            "outcome": OUTCOME_FAILED if failed else OUTCOME_SCORED,
+            "error": error[:200] if failed and error else None,
+        })
+
+    def skip(self, model: str, reason: str) -> None:
+        self.candidates.append({
+            "model": model,
+            "duration_seconds": 0.0,
+            "score": None,
+            "outcome": OUTCOME_SKIPPED,
+            "error": reason,
+        })
+
+    def reject(self, model: str, reason: str) -> None:
+        for candidate in self.candidates:
+            if candidate["model"] == model and candidate["outcome"] == OUTCOME_SCORED:
+                candidate["outcome"] = OUTCOME_REJECTED
+                candidate["error"] = reason
+
+    def finish(self, selected: str, method: str, params: Optional[List[float]] = None) -> None:
+        """
+        Record the selected model (method: pattern / tournament / fallback /
+        warm_start) and its fitted params, and publish the report
+        """
+        self.selected = selected
+        self.method = method
+        self.params = params
+        total = time.perf_counter() - self._started
+
+        for candidate in self.candidates:
+            if candidate["outcome"] == OUTCOME_SKIPPED:
+                metrics.inc("forecast_model_skipped_total", model=candidate["model"], reason=candidate["error"])
+                continue
+            metrics.observe("forecast_model_duration_seconds", candidate["duration_seconds"], model=candidate["model"])
+            metrics.inc("forecast_model_runs_total", model=candidate["model"], outcome=candidate["outcome"])
+        metrics.inc("forecast_model_wins_total", model=selected, method=method)
+        metrics.observe("forecast_tournament_duration_seconds", total, method=method)
+        metrics.observe("forecast_series_length", self.series_length)
+
+        report = self.to_dict()
+        report["duration_seconds"] = round(total, 6)
+        _last_report.value = report
+        logger.info(f"Forecast run: {json.dumps(report, default=str)}")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "series_length": self.series_length,
+            "horizon": self.horizon,
+            "seasonality_period": self.seasonality_period,
+            "selected_model": self.selected,
+            "method": self.method,
+            "params": self.params,
+            "candidates": self.candidates,
+        }
+
+
+def record_failed_refit(model: str, duration: float, error: str) -> None:
+    """
+    Add a warm-started refit that failed, and fell back to the tournament, to
+    the report of that tournament (as a failed candidate and as "warm_start")
+    """
+    error = f"warm refit: {error}"[:200]
+    metrics.observe("forecast_model_duration_seconds", duration, model=model)
+    metrics.inc("forecast_model_runs_total", model=model, outcome=OUTCOME_FAILED)
+    report = getattr(_last_report, "value", None)
+    if report is None:
+        return
+    report["candidates"].insert(0, {
+        "model": model,
+        "duration_seconds": round(duration, 6),
+        "score": None,
+        "outcome": OUTCOME_FAILED,
+        "error": error,
+    })
+    report["warm_start"] = {"model": model, "outcome": OUTCOME_FAILED, "error": error}
+
+
+def collect_report(forecast_fn: Callable[..., Any], *args, **kwargs) -> Tuple[Any, Optional[Dict[str, Any]]]:
+    """Run forecast_fn and return (result, report of the run_sarima call it made)"""
+    _last_report.value = None
+    result = forecast_fn(*args, **kwargs)
+    return result, getattr(_last_report, "value", None)
+
+
+def model_report(since: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Per-model runs, failures, skips, wins and fit time, slowest first.
+
+    since: a metrics.snapshot() taken earlier, to report only what happened after it.
+    """
+    current = metrics.snapshot()
+    data = metrics.delta(since, current) if since is not None else current
+    runs = data["counters"].get("forecast_model_runs_total", {})
+    skips = data["counters"].get("forecast_model_skipped_total", {})
+    wins = data["counters"].get("forecast_model_wins_total", {})
+    durations = data["summaries"].get("forecast_model_duration_seconds", {})
+
+    models: Dict[str, Dict[str, Any]] = {}
+
+    def entry(model: str) -> Dict[str, Any]:
+        return models.setdefault(model, {"runs": 0, "failed": 0, "rejected": 0, "skipped": 0, "wins": 0,
+                                         "total_seconds": 0.0, "max_seconds": 0.0})
+
+    for labels, count in runs.items():
+        labels = dict(labels)
+        item = entry(labels["model"])
+        item["runs"] += int(count)
+        if labels.get("outcome") in (OUTCOME_FAILED, OUTCOME_REJECTED):
+            item[labels["outcome"]] += int(count)
+    for labels, count in skips.items():
+        entry(dict(labels)["model"])["skipped"] += int(count)
+    for labels, count in wins.items():
+        entry(dict(labels)["model"])["wins"] += int(count)
+    for labels, (count, total, maximum) in durations.items():
+        item = entry(dict(labels)["model"])
+        item["total_seconds"] += total
+        item["max_seconds"] = max(item["max_seconds"], maximum)
+
+    tournaments = sum(int(count) for count in wins.values())
+    all_seconds = sum(item["total_seconds"] for item in models.values()) or 1.0
+    for item in models.values():
+        item["win_rate"] = round(item["wins"] / item["runs"], 4) if item["runs"] else None
+        item["mean_seconds"] = round(item["total_seconds"] / item["runs"], 6) if item["runs"] else None
+        item["time_share"] = round(item["total_seconds"] / all_seconds, 4)
+        item["total_seconds"] = round(item["total_seconds"], 6)
+        item["max_seconds"] = round(item["max_seconds"], 6)
+
+    return {
+        "forecasts": tournaments,
+        "models": dict(sorted(models.items(), key=lambda kv: kv[1]["total_seconds"], reverse=True)),
+    }
@@ -1,26 +1,54 @@
+import os
+import threading
+import time
+
+from pymongo import ASCENDING
+
+from code_catalog import get_code_catalog
+from schema_migration import earliest_type_year
+
+# The earliest year of a company is looked up once per code, site and frequency;
+# cache it per company until the next run invalidates it (see invalidate_min_year)
+MIN_YEAR_CACHE_TTL = float(os.getenv("MIN_YEAR_CACHE_TTL", "3600"))
+_min_years = {}
+_min_years_generation = 0
+_min_years_lock = threading.Lock()
+_min_year_indexed = set()
+
+
+def ensure_min_year_index(cdata_collection):
+    if cdata_collection.full_name not in _min_year_indexed:
+        cdata_collection.create_index([("company_code", ASCENDING), ("type_year", ASCENDING)], name="cdata_company_year")
+        _min_year_indexed.add(cdata_collection.full_name)
+
 # Get minimum year of company
 def get_min_year(company_code, cdata_collection):
-    min_year_query = [
-    {"$match": {"company_code": company_code}},
-    {"$group": {"_id": None, "min_year": {"$min": "$type_year"}}}
-    ]
-    min_year_result = list(cdata_collection.aggregate(min_year_query))
-    if min_year_result:
-        return min_year_result[0]["min_year"]
-    else:
-        return None
+    key = (cdata_collection.full_name, str(company_code))
+    cached = _min_years.get(key)
+    if cached is not None and time.monotonic() - cached[1] < MIN_YEAR_CACHE_TTL:
+        return cached[0]
+
+    generation = _min_years_generation
+    ensure_min_year_index(cdata_collection)
+    min_year = earliest_type_year(cdata_collection, {"company_code": company_code})
+    with _min_years_lock:
+        # Not stored if the company was invalidated while the query ran
+        if generation == _min_years_generation:
+            _min_years[key] = (min_year, time.monotonic())
+    return min_year
+
+def invalidate_min_year(company_code=None):
+    """Forget the cached minimum year of a company, or of all companies"""
+    global _min_years_generation
+    with _min_years_lock:
+        _min_years_generation += 1
+        for key in list(_min_years):
+            if company_code is None or key[1] == str(company_code):
+                del _min_years[key]
 
 # Get Company internal code
 def get_internal_code_ids(company_code, internal_code_ids):
-        query = {
-            "_id": {"$in": internal_code_ids}
-        }
-        projection = {
-            "code": 1, 
-            "name": 1,  
-        }
-        matching_documents = list(code_collection.find(query, projection))
-        return matching_documents
+    return get_code_catalog().get_many(internal_code_ids)
 
 
 # get next month
@@ -58,6 +86,9 @@ def get_next_month_name(current_month):
     return next_month
 
 def get_function_type(allCodes):
+    # Code documents or their ids
+    allCodes = [code if isinstance(code, dict) else get_code_catalog().get(code) for code in allCodes]
+    allCodes = [code for code in allCodes if code is not None]
     if any('function' in code and code['function'] is not None for code in allCodes):
         for code in allCodes:
             if code.get('function') is not None:
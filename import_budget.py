@@ -0,0 +1,90 @@
+"""
+Import-time budget for service startup.
+
+Imports the entry module (app by default) in a fresh interpreter with
+-X importtime, reports the total and the slowest modules, and fails when the
+import takes longer than the budget or pulls in the forecasting stack, which
+must only load on the first forecast (see sarima._load_forecasting_stack).
+
+    python import_budget.py                      # app, IMPORT_BUDGET_SECONDS
+    python import_budget.py --module asgi_app --budget 1.5 --json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from typing import Any, Dict, List
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+IMPORT_BUDGET_SECONDS = float(os.getenv("IMPORT_BUDGET_SECONDS", "2.0"))
+# Top-level packages that must not be imported at startup
+DEFERRED_PACKAGES = ("pandas", "sklearn", "statsmodels", "sktime", "pmdarima")
+
+
+def measure(module: str) -> Dict[str, Any]:
+    """Import module in a subprocess and return per-module cumulative import times"""
+    probe = (
+        f"import sys, json; import {module}; "
+        f"print(json.dumps(sorted({{m.split('.')[0] for m in sys.modules}})))"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", probe],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{proc.stderr[-2000:]}")
+
+    modules: List[Dict[str, Any]] = []
+    total_us = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        # "import time:  self [us] | cumulative | <indent>package"; nesting is shown by indentation
+        _, cumulative, name = line.split("|", 2)
+        cumulative_us = int(cumulative)
+        top_level = len(name) - len(name.lstrip()) <= 1
+        if top_level:
+            total_us += cumulative_us
+        modules.append({"module": name.strip(), "cumulative_seconds": cumulative_us / 1e6})
+
+    loaded = set(json.loads(proc.stdout.strip().splitlines()[-1]))
+    return {
+        "module": module,
+        "total_seconds": round(total_us / 1e6, 3),
+        "slowest": sorted(modules, key=lambda m: m["cumulative_seconds"], reverse=True),
+        "deferred_packages_loaded": sorted(p for p in DEFERRED_PACKAGES if p in loaded),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Check the import-time budget of the service entry point')
+    parser.add_argument('--module', default='app', help='Module to import (app, asgi_app, main, ...)')
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET_SECONDS, help='Allowed import time in seconds')
+    parser.add_argument('--top', type=int, default=15, help='Number of slowest modules to show')
+    parser.add_argument('--json', action='store_true', help='Print the result as JSON')
+    args = parser.parse_args()
+
+    result = measure(args.module)
+    result["slowest"] = result["slowest"][:args.top]
+    result["budget_seconds"] = args.budget
+    result["ok"] = result["total_seconds"] <= args.budget and not result["deferred_packages_loaded"]
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f"import {args.module}: {result['total_seconds']:.3f}s (budget {args.budget:.3f}s)")
+        for entry in result["slowest"]:
+            print(f"  {entry['cumulative_seconds']:8.3f}s  {entry['module']}")
+        if result["deferred_packages_loaded"]:
+            print(f"Loaded at startup but should be deferred: {', '.join(result['deferred_packages_loaded'])}")
+        print("OK" if result["ok"] else "OVER BUDGET")
+    return 0 if result["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
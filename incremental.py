@@ -0,0 +1,150 @@
+"""
+Incremental aggregation support.
+
+In incremental mode the processors only rewrite what the dirty cdata rows
+(is_aggregated = False) touch:
+
+- the reporting (fiscal) years the processors assign to the rows they write,
+  given the company's start month, are collected while the rows are written,
+  and the derived levels (quarter / semi-annual / year) are rebuilt only for
+  those reporting years instead of for the whole history of the code/site;
+- forecasts are re-run only when the input series changed since the last
+  run; a hash of the full series per (company, code, site, frequency) is kept
+  in the forecast_state collection, together with the report of the last
+  forecast, how often each model was selected for that series and the stored
+  winner used for warm-started refits (warm_start.py).
+
+The forecast input itself is always the full actual history of the
+code/site (history_series), aggregated rows included; only the rows that get
+rewritten are limited to the dirty ones.
+
+Full runs still record the series hash, so switching a deployment to
+incremental mode does not force one extra round of forecasts.
+"""
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+from dotenv import load_dotenv
+
+import metrics
+from concurrency import run_forecast
+from forecast_telemetry import collect_report
+from model_selection import FORECAST_FULL_TOURNAMENT
+from warm_start import model_state, warm_start_model
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+AGGREGATION_INCREMENTAL = os.getenv("AGGREGATION_INCREMENTAL", "false").lower() in ("1", "true", "yes")
+
+FORECAST_STATE_COLLECTION = "forecast_state"
+
+
+def reporting_year_filter(query: Dict, reporting_years: Iterable[int]) -> Dict:
+    """Restrict a derived-level query to the reporting years touched by this run"""
+    restricted = dict(query)
+    restricted["reporting_year"] = {"$in": sorted({int(y) for y in reporting_years})}
+    return restricted
+
+
+def series_hash(series: List[Any], **params) -> str:
+    """Hash of every value of the series (the full history of its key) and the forecast parameters"""
+    payload = {
+        "series": [float(v) for v in series],
+        "params": params,
+    }
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def history_series(cdata_collection, query: Dict, sort_key: Callable[[Dict], Any],
+                   value_fn: Callable[[Dict], Any],
+                   row_filter: Optional[Callable[[Dict], bool]] = None) -> Tuple[List[int], Optional[Dict]]:
+    """
+    Forecast input for a code/site: value_fn(row) of every cdata row matching
+    query, whether it is already aggregated or not, ordered by sort_key (rows
+    where value_fn returns None or "" are left out). Returns the series and the
+    last row in that order.
+    """
+    history_query = {k: v for k, v in query.items() if k != "is_aggregated"}
+    with metrics.timed("cdata_read"):
+        rows = list(cdata_collection.find(history_query))
+    if row_filter is not None:
+        rows = [row for row in rows if row_filter(row)]
+    rows.sort(key=sort_key)
+
+    series = []
+    for row in rows:
+        number = value_fn(row)
+        if number is not None and number != "":
+            series.append(int(number))
+    return series, (rows[-1] if rows else None)
+
+
+def forecast_state_key(company_id: str, internal_code_id: str, site_code: str, frequency: str) -> Dict[str, Any]:
+    return {
+        "company_code": str(company_id),
+        "internal_code_id": ObjectId(internal_code_id),
+        "site_code": str(site_code),
+        "frequency": frequency,
+    }
+
+
+def code_model_wins(state_collection, key: Dict[str, Any]) -> Dict[str, int]:
+    """How often each model was selected for this code and frequency, summed over its sites"""
+    wins: Dict[str, int] = {}
+    code_query = {k: key[k] for k in ("company_code", "internal_code_id", "frequency")}
+    for state in state_collection.find(code_query, {"model_wins": 1}):
+        for model, count in (state.get("model_wins") or {}).items():
+            wins[model] = wins.get(model, 0) + count
+    return wins
+
+
+def forecast_series(connection, key: Dict[str, Any], series: List[Any], incremental: bool,
+                    forecast_fn: Callable[..., Any], refit_fn: Optional[Callable[..., Any]] = None,
+                    **params) -> Optional[List[Any]]:
+    """
+    Run forecast_fn(series, **params) on the CPU executor unless, in incremental
+    mode, the series is unchanged since the last forecast (then []
+    is returned and the stored forecast rows are left as they are).
+
+    When the series only grew since its last forecast, refit_fn(series, stored_model,
+    **params) refits the stored winner instead (see warm_start).
+    """
+    state_collection = connection[FORECAST_STATE_COLLECTION]
+    history_hash = series_hash(series, **params)
+    state = state_collection.find_one(key, {"series_hash": 1, "model": 1})
+
+    if incremental:
+        if state and state.get("series_hash") == history_hash:
+            logger.info(f"Forecast series unchanged for {key}, keeping stored forecast")
+            metrics.inc("forecast_cache_hits_total", frequency=key["frequency"])
+            return []
+
+    # Past winners for the code let run_sarima skip models that never win for it
+    model_wins = None if FORECAST_FULL_TOURNAMENT else code_model_wins(state_collection, key)
+
+    stored_model = warm_start_model(state, series) if refit_fn is not None else None
+
+    metrics.inc("forecast_cache_misses_total", frequency=key["frequency"])
+    with metrics.timed("forecasting", frequency=key["frequency"]):
+        if stored_model:
+            predictions, report = run_forecast(collect_report, refit_fn, series, stored_model,
+                                               model_wins=model_wins, **params)
+        else:
+            predictions, report = run_forecast(collect_report, forecast_fn, series, model_wins=model_wins, **params)
+
+    if predictions is not None and len(predictions) > 0:
+        update = {"$set": {"series_hash": history_hash, "series_length": len(series), "updated_at": datetime.now()}}
+        if report and report.get("selected_model"):
+            # Per-key model history, used to see which candidates ever win for this series
+            update["$set"]["last_forecast"] = report
+            update["$set"]["model"] = model_state(report, series, predictions, (state or {}).get("model"))
+            update["$inc"] = {f"model_wins.{report['selected_model']}": 1}
+        state_collection.update_one(key, update, upsert=True)
+    return predictions
@@ -0,0 +1,130 @@
+import logging
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from bson import ObjectId
+from dotenv import load_dotenv
+
+import profiling
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Global dictionary to track running jobs (keyed by thread_id for API compatibility)
+running_threads = {}
+thread_lock = threading.Lock()
+
+JOB_POOL_WORKERS = int(os.getenv("JOB_POOL_WORKERS", "4"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_job_pool() -> ThreadPoolExecutor:
+    """Get the process-wide job pool used for long-running aggregation and rollup jobs"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=JOB_POOL_WORKERS, thread_name_prefix="JobPool")
+    return _executor
+
+
+def convert_objectids_to_strings(data):
+    """Recursively convert ObjectId instances to strings"""
+    if isinstance(data, dict):
+        return {key: convert_objectids_to_strings(value) for key, value in data.items()}
+    elif isinstance(data, list):
+        return [convert_objectids_to_strings(item) for item in data]
+    elif isinstance(data, ObjectId):
+        return str(data)
+    else:
+        return data
+
+
+def find_running_job(job_type: str, company_id: Optional[int]) -> Optional[str]:
+    """Return the thread_id of a running job of this type for the company, if any"""
+    with thread_lock:
+        for thread_id, thread_info in running_threads.items():
+            if (thread_info['status'] in ('queued', 'running') and
+                thread_info['company_id'] == company_id and
+                thread_info['type'] == job_type):
+                return thread_id
+    return None
+
+
+def run_job(job_type: str, company_id: Optional[int], thread_id: str, target: Callable[..., Any],
+            profile: Optional[str] = None, **kwargs) -> None:
+    """Run a job and record its status in running_threads; profile: a profiling mode, keyed by thread_id"""
+    try:
+        with thread_lock:
+            running_threads[thread_id] = {
+                'status': 'running',
+                'company_id': company_id,
+                'start_time': time.time(),
+                'type': job_type
+            }
+            if profile:
+                running_threads[thread_id]['profile'] = f"/profiles/{thread_id}"
+
+        logger.info(f"Starting {job_type} script for company_id: {company_id}")
+        if profile:
+            with profiling.profile_job(thread_id, profile):
+                result = target(company_id=company_id, **kwargs)
+        else:
+            result = target(company_id=company_id, **kwargs)
+
+        with thread_lock:
+            if thread_id in running_threads:
+                running_threads[thread_id]['status'] = 'completed'
+                running_threads[thread_id]['result'] = result
+                running_threads[thread_id]['end_time'] = time.time()
+
+        logger.info(f"{job_type.capitalize()} script completed successfully")
+
+    except (Exception, SystemExit) as e:  # db_connection exits on connection failure
+        logger.error(f"Error in background {job_type}: {str(e)}")
+        logger.error(traceback.format_exc())
+
+        with thread_lock:
+            if thread_id in running_threads:
+                running_threads[thread_id]['status'] = 'error'
+                running_threads[thread_id]['error'] = str(e)
+                running_threads[thread_id]['traceback'] = traceback.format_exc()
+                running_threads[thread_id]['end_time'] = time.time()
+
+
+def submit_job(job_type: str, company_id: Optional[int], thread_id: str, target: Callable[..., Any],
+               profile: Optional[str] = None, **kwargs) -> str:
+    """Queue a job on the job pool and return immediately"""
+    with thread_lock:
+        running_threads[thread_id] = {
+            'status': 'queued',
+            'company_id': company_id,
+            'start_time': time.time(),
+            'type': job_type
+        }
+        if profile:
+            running_threads[thread_id]['profile'] = f"/profiles/{thread_id}"
+    get_job_pool().submit(run_job, job_type, company_id, thread_id, target, profile, **kwargs)
+    return thread_id
+
+
+def with_duration(thread_info: Dict) -> Dict:
+    """Add the duration of a job to a copy of its status entry"""
+    if 'end_time' in thread_info:
+        thread_info['duration'] = thread_info['end_time'] - thread_info['start_time']
+    elif thread_info['status'] in ('queued', 'running'):
+        thread_info['duration'] = time.time() - thread_info['start_time']
+    return thread_info
+
+
+def count_active_jobs() -> int:
+    """Number of queued or running jobs"""
+    with thread_lock:
+        return len([t for t in running_threads.values() if t['status'] in ('queued', 'running')])
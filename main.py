@@ -1,9 +1,9 @@
 from script_functions import fetch_company_data, process_monthly_data, process_bi_annual_data, process_yearly_data, delete_monthly_data
-from RegionAPI import fetch_company_data_safe as fetch_company_data, fetch_all_company
+from RegionAPI import fetch_company_data_safe as fetch_company_data, fetch_all_company, get_company_by_id
 from data_quarterly_process import process_quarterly_data
 from data_BiAnnual_process import process_BiAnnual_data
 from data_monthly_process import process_monthly_data
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import as_completed
 from data_yearly_process import process_yearly_data
 from pymongo import MongoClient
 from dotenv import load_dotenv
@@ -13,6 +13,16 @@ import logging
 import sys
 import os
 import db_connection
+import metrics
+import profiling
+from prefetch import prefetch_companies
+from scheduler import CompanyScheduler
+from concurrency import get_concurrency_controller
+from incremental import AGGREGATION_INCREMENTAL
+from forecast_telemetry import model_report
+from helper import invalidate_min_year
+from run_ledger import RunLedger, unit_key
+from work_leases import lease_manager, shared_lease_epoch
 from typing import Optional, Dict, List, Any
 import traceback
 
@@ -29,14 +39,28 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Number of processes for all-company runs (1 = process companies sequentially in this process)
+COMPANY_PROCESS_WORKERS = int(os.getenv("COMPANY_PROCESS_WORKERS", "1"))
+
 class CompanyDataController:
-    def __init__(self):
-        """Initialize the controller with database connection"""
+    def __init__(self, workers: Optional[int] = None, incremental: Optional[bool] = None,
+                 run_id: Optional[str] = None, lease_epoch: Optional[str] = None):
+        """
+        Initialize the controller with database connection (run_id of an earlier run resumes it).
+        lease_epoch overrides the work lease epoch derived from the environment / run_id.
+        """
+        self.workers = workers or COMPANY_PROCESS_WORKERS
+        self.incremental = AGGREGATION_INCREMENTAL if incremental is None else incremental
         try:
             self.connection = db_connection.connect_to_database()
             if self.connection is not None:
                 self.company_code_collection = self.connection["company_codes"]
                 self.cdata_collection = self.connection["cdata"]
+                self.ledger = RunLedger(self.connection, 'aggregation', run_id)
+                # Cross-replica claim on each company, so parallel service replicas split the work
+                if lease_epoch is None:
+                    lease_epoch = shared_lease_epoch(self.connection, run_id)
+                self.leases = lease_manager(self.connection, 'aggregation', lease_epoch)
                 
                 logger.info("Database connection established successfully")
             else:
@@ -56,6 +80,7 @@ class CompanyDataController:
             Dict containing success status, message, and processed data
         """
         start_time = datetime.now()
+        metrics_at_start = metrics.snapshot()
         logger.info(f"Starting company data processing at {start_time}")
         
         try:
@@ -68,7 +93,8 @@ class CompanyDataController:
             logger.info(f"Target company_id: {company_id}")
             
             # Fetch companies to process
-            companies = self._get_companies_to_process(company_id)
+            with metrics.timed("company_fetch"):
+                companies = self._get_companies_to_process(company_id)
             
             if not companies:
                 return {
@@ -79,6 +105,10 @@ class CompanyDataController:
             
             logger.info(f"Processing {len(companies)} companies")
             
+            # Resolve start months for all companies up front
+            if len(companies) > 1:
+                prefetch_companies([c['id'] for c in companies])
+            
             # Process companies
             processed_companies = self._process_companies(companies, year)
             
@@ -98,6 +128,8 @@ class CompanyDataController:
                         "total_companies": len(processed_companies),
                         "successful": success_count,
                         "failed": error_count,
+                        "run_id": self.ledger.run_id,
+                        "forecast_models": model_report(since=metrics_at_start),
                         "processing_time_seconds": processing_time,
                         "start_time": start_time.isoformat(),
                         "end_time": end_time.isoformat()
@@ -117,17 +149,9 @@ class CompanyDataController:
     def _get_companies_to_process(self, company_id: Optional[int]) -> List[Dict]:
         """Get companies to process based on company_id parameter"""
         try:
-            all_companies = fetch_all_company()
-            
-            if not all_companies:
-                logger.error("Failed to fetch companies from API")
-                return []
-                
-            logger.info(f"Fetched {len(all_companies)} total companies from API")
-            
             if company_id is not None:
-                # Process specific company
-                company = next((c for c in all_companies if c['id'] == company_id), None)
+                # Process specific company (indexed lookup in the cached company list)
+                company = get_company_by_id(company_id)
                 if company:
                     logger.info(f"Found company with ID {company_id}: {company.get('company_name', 'Unknown')}")
                     return [company]
@@ -136,6 +160,13 @@ class CompanyDataController:
                     return []
             else:
                 # Process all companies
+                all_companies = fetch_all_company()
+                
+                if not all_companies:
+                    logger.error("Failed to fetch companies from API")
+                    return []
+                
+                logger.info(f"Fetched {len(all_companies)} total companies from API")
                 logger.info("Processing all companies")
                 return all_companies
                 
@@ -145,16 +176,27 @@ class CompanyDataController:
 
     def _process_companies(self, companies: List[Dict], year: int) -> List[Dict]:
         """Process multiple companies"""
+        remaining = [c for c in companies if not self.ledger.is_completed(c['id'])]
+        if len(remaining) < len(companies):
+            logger.info(f"Skipping {len(companies) - len(remaining)} companies completed in run {self.ledger.run_id}")
+            companies = remaining
+
+        if self.workers > 1 and len(companies) > 1:
+            scheduler = CompanyScheduler(self.workers, incremental=self.incremental, run_id=self.ledger.run_id,
+                                         lease_epoch=self.leases.epoch if self.leases else "")
+            return scheduler.run(companies, year, self.cdata_collection)
+
         processed_companies = []
         
         for i, company in enumerate(companies, 1):
             try:
                 company_id = str(company['id'])
-                cdata = list(self.cdata_collection.find({"company_code": company_id, "is_aggregated": False}))
-                logger.info(f"Processing company {i}/{len(companies)}: ID {company.get('id')}, records to process: {len(cdata)}")
-                if len(cdata):
-                    result = self._process_single_company(company, year)
-                    processed_companies.append(result)
+                pending = self.cdata_collection.count_documents({"company_code": company_id, "is_aggregated": False})
+                logger.info(f"Processing company {i}/{len(companies)}: ID {company.get('id')}, records to process: {pending}")
+                if pending:
+                    result = self._process_company_unit(company, year)
+                    if result is not None:
+                        processed_companies.append(result)
                 
             except Exception as e:
                 logger.error(f"Error processing company {company.get('id', 'unknown')}: {str(e)}")
@@ -168,6 +210,31 @@ class CompanyDataController:
         
         return processed_companies
 
+    def _process_company_unit(self, company: Dict, year: int) -> Optional[Dict]:
+        """
+        Process a company and record the outcome in the run ledger. With work leases
+        enabled, returns None when another replica holds the company or already
+        finished it in this lease epoch.
+        """
+        if self.leases is None:
+            self.ledger.start(company['id'])
+            return self.ledger.record(self._process_single_company(company, year), company['id'])
+
+        with self.leases.lease(unit_key(company['id'])) as acquired:
+            if not acquired:
+                logger.info(f"Company {company['id']} is leased by another worker or done in this run, skipping")
+                return None
+            # Pending counts are taken before the claim; another replica may have finished it since
+            if not self.cdata_collection.count_documents({"company_code": str(company['id']), "is_aggregated": False}):
+                logger.info(f"Company {company['id']} was aggregated by another worker, skipping")
+                return None
+            self.ledger.start(company['id'])
+            result = self.ledger.record(self._process_single_company(company, year), company['id'])
+            if self.ledger.is_completed(company['id']):
+                # Keep the claim so replicas reaching the company later skip it
+                self.leases.complete(unit_key(company['id']))
+            return result
+
     def _process_single_company(self, company: Dict, year: int) -> Dict:
         """Process a single company's data"""
         company_start_time = datetime.now()
@@ -177,6 +244,8 @@ class CompanyDataController:
             company_name = company.get('company_name', 'Unknown')
             
             logger.info(f"Processing company: {company_id} - {company_name}")
+            # Read the company's earliest year afresh once per run; the processors share it
+            invalidate_min_year(company_id)
             
             # Get start month
             month_data = fetch_company_data(company_id)
@@ -236,6 +305,41 @@ class CompanyDataController:
                 "traceback": traceback.format_exc()
             }
 
+    def process_company_code(self, company: Dict, internal_code_id: str, site_codes: Optional[List[str]] = None) -> Dict:
+        """
+        Re-aggregate a single code of a company, e.g. after a change to its cdata
+
+        Args:
+            company: Company record as returned by the company API
+            internal_code_id: Code to process
+            site_codes: Optional internal site codes to limit the site-level processing to
+        """
+        company_id = str(company['id'])
+        year = date.today().year - 6
+        # New cdata may reach further back than the cached earliest year
+        invalidate_min_year(company_id)
+
+        month_data = fetch_company_data(company_id)
+        start_month = str(month_data[0]) if month_data else 'January'
+
+        if site_codes is not None:
+            company = dict(company)
+            company['company_sites'] = [
+                site for site in company.get('company_sites', []) if site.get('internal_site_code') in site_codes
+            ]
+
+        reporting_frequencies = self._get_reporting_frequencies(company)
+        is_reporting_next = False if len(reporting_frequencies) == 4 else True
+        frequency_results = [
+            self._process_frequency(company, company_id, internal_code_id, freq, year, start_month, is_reporting_next)
+            for freq in reporting_frequencies
+        ]
+        return {
+            "internal_code_id": internal_code_id,
+            "frequency_results": frequency_results,
+            "status": "processed"
+        }
+
     def _get_reporting_frequencies(self, company: Dict) -> List[str]:
         """Extract and validate reporting frequencies"""
         reporting_frequency = company.get("reporting_frequency")
@@ -269,14 +373,19 @@ class CompanyDataController:
             
             if len(cdata):
                 for freq in reporting_frequencies:
+                    if self.ledger.is_completed(company_id, internal_code_id, freq):
+                        code_results.append({"frequency": freq, "status": "skipped", "message": "Completed earlier in this run"})
+                        continue
                     try:
+                        self.ledger.start(company_id, internal_code_id, freq)
                         is_reporting_next = False if len(reporting_frequencies) == 4 else True
                         result = self._process_frequency(
                             company, company_id, internal_code_id, freq, year, start_month, is_reporting_next
                         )
-                        code_results.append(result)
+                        code_results.append(self.ledger.record(result, company_id, internal_code_id, freq))
                     except Exception as e:
                         logger.error(f"Error processing frequency {freq} for code {internal_code_id}: {str(e)}")
+                        self.ledger.fail(company_id, internal_code_id, freq, str(e))
                         code_results.append({
                             "frequency": freq,
                             "status": "error",
@@ -300,11 +409,16 @@ class CompanyDataController:
         processed_codes = []
         company_id = str(company['id'])
         logger.info(f"company id id processing: {company_id}")
-        with ThreadPoolExecutor(max_workers=50) as executor:
-            
+        concurrency = get_concurrency_controller()
+        with concurrency.io_stage(f"company-{company_id}", len(company_codes), self.connection) as (executor, limiter):
+
+            def run_code(*args):
+                with limiter.slot():
+                    return self._process_single_code(*args)
+
             futures = [
                 executor.submit(
-                    self._process_single_code,
+                    run_code,
                     company,
                     company_id,
                     code,
@@ -335,13 +449,17 @@ class CompanyDataController:
             # Process main company data
             if frequency == 'month':
                 logger.info(f"Processing code {start_month}, code {year}")
-                self._process_monthly(company_id, internal_code_id, year, start_month, company)
+                with metrics.timed("monthly_aggregation"):
+                    self._process_monthly(company_id, internal_code_id, year, start_month, company)
             elif frequency == 'quater':
-                self._process_quarterly(company_id, internal_code_id, year, start_month, company)
+                with metrics.timed("quarterly_aggregation"):
+                    self._process_quarterly(company_id, internal_code_id, year, start_month, company)
             elif frequency == 'semi_annual':
-                self._process_bi_annual(company_id, internal_code_id, year, start_month, company)
+                with metrics.timed("bi_annual_aggregation"):
+                    self._process_bi_annual(company_id, internal_code_id, year, start_month, company)
             elif frequency == 'annual':
-                self._process_yearly(company_id, internal_code_id, year, start_month, company, is_reporting_next)
+                with metrics.timed("yearly_aggregation"):
+                    self._process_yearly(company_id, internal_code_id, year, start_month, company, is_reporting_next)
             
             return {
                 "frequency": frequency,
@@ -360,62 +478,74 @@ class CompanyDataController:
     def _process_monthly(self, company_id: str, internal_code_id: str, year: int, start_month: str, company: Dict):
         """Process monthly data for a company"""
         # Process main company data
+        # Incremental runs rewrite only the buckets touched by dirty rows, so the base window is kept
         if all([company_id, internal_code_id, year, start_month]):
-            delete_monthly_data(company_id, start_month, year, internal_code_id, "")
-            process_monthly_data(company_id, internal_code_id, year, start_month, site_code="")
+            if not self.incremental:
+                delete_monthly_data(company_id, start_month, year, internal_code_id, "")
+            process_monthly_data(company_id, internal_code_id, year, start_month, site_code="", incremental=self.incremental)
         
         # Process site data
         for site_code in company.get('company_sites', []):
             if (all([company_id, internal_code_id, year, start_month]) and 
                 site_code.get("internal_site_code")):
-                delete_monthly_data(company_id, start_month, year, internal_code_id, site_code["internal_site_code"])
-                process_monthly_data(company_id, internal_code_id, year, start_month, site_code["internal_site_code"])
+                if not self.incremental:
+                    delete_monthly_data(company_id, start_month, year, internal_code_id, site_code["internal_site_code"])
+                process_monthly_data(company_id, internal_code_id, year, start_month, site_code["internal_site_code"],
+                                     incremental=self.incremental)
     
     def _process_quarterly(self, company_id: str, internal_code_id: str, year: int, start_month: str, company: Dict):
         """Process quarterly data for a company"""
         # Process main company data
         if all([company_id, internal_code_id, year, start_month]):
-            process_quarterly_data(company_id, internal_code_id, year, start_month, site_code="")
+            process_quarterly_data(company_id, internal_code_id, year, start_month, site_code="", incremental=self.incremental)
         
         # Process site data
         for site_code in company.get('company_sites', []):
             if (all([company_id, internal_code_id, year, start_month]) and 
                 site_code.get("internal_site_code")):
-                process_quarterly_data(company_id, internal_code_id, year, start_month, site_code["internal_site_code"])
+                process_quarterly_data(company_id, internal_code_id, year, start_month, site_code["internal_site_code"],
+                                       incremental=self.incremental)
     
     def _process_bi_annual(self, company_id: str, internal_code_id: str, year: int, 
                         start_month: str, company: Dict):
         """Process bi-annual data for a company"""
         # Process main company data
         if all([company_id, internal_code_id, year, start_month]):
-            process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_code="")
+            process_BiAnnual_data(company_id, internal_code_id, year, start_month, site_code="", incremental=self.incremental)
         
         # Process site data
         for site_code in company.get('company_sites', []):
             if (all([company_id, internal_code_id, year, start_month]) and 
                 site_code.get("internal_site_code")):
                 process_BiAnnual_data(company_id, internal_code_id, year, start_month, 
-                                    site_code["internal_site_code"])
+                                    site_code["internal_site_code"], incremental=self.incremental)
     
     def _process_yearly(self, company_id: str, internal_code_id: str, year: int, start_month: str, company: Dict, is_reporting_next: bool):
         """Process yearly data for a company"""
         # Process main company data
         if all([company_id, internal_code_id, year, start_month]):
             reporting_month = start_month if is_reporting_next else "January"
-            process_yearly_data(company_id, internal_code_id, year, reporting_month, site_code="")
+            process_yearly_data(company_id, internal_code_id, year, reporting_month, site_code="", incremental=self.incremental)
         
         # Process site data
         for site_code in company.get('company_sites', []):
             if (all([company_id, internal_code_id, year, start_month]) and 
                 site_code.get("internal_site_code")):
-                process_yearly_data(company_id, internal_code_id, year, reporting_month, site_code["internal_site_code"])
+                process_yearly_data(company_id, internal_code_id, year, reporting_month, site_code["internal_site_code"],
+                                    incremental=self.incremental)
 
-def main(company_id: Optional[int] = None) -> Dict[str, Any]:
+def main(company_id: Optional[int] = None, workers: Optional[int] = None,
+         incremental: Optional[bool] = None, run_id: Optional[str] = None,
+         profile: Optional[str] = None) -> Dict[str, Any]:
     """
     Main function for command line execution and programmatic use
     
     Args:
         company_id: Optional company ID to process
+        workers: Optional number of processes for all-company runs
+        incremental: Only rewrite the buckets touched by dirty rows (default: AGGREGATION_INCREMENTAL)
+        run_id: Optional ledger run id; pass the id of an interrupted run to resume it
+        profile: Optional profiling mode (cprofile or sample); the profile is stored under the run id
         
     Returns:
         Dict containing processing results
@@ -426,12 +556,27 @@ def main(company_id: Optional[int] = None) -> Dict[str, Any]:
     if company_id is None:
         parser = argparse.ArgumentParser(description='Process company data.')
         parser.add_argument('--company_id', type=int, help='Specific company ID to process')
-        args = parser.parse_args()
+        parser.add_argument('--workers', type=int, help='Number of processes for all-company runs')
+        parser.add_argument('--incremental', action='store_true', default=None,
+                            help='Only rewrite the periods touched by unaggregated records')
+        parser.add_argument('--resume', metavar='RUN_ID', help='Resume an interrupted run, skipping completed units')
+        parser.add_argument('--profile', nargs='?', const=profiling.DEFAULT_PROFILE_MODE, choices=profiling.PROFILE_MODES,
+                            help='Profile the run (sample or cprofile) into PROFILE_DIR/<run id>')
+        args, _ = parser.parse_known_args()  # ignore arguments meant for the hosting server (flask/uvicorn)
         company_id = args.company_id
+        workers = workers or args.workers
+        incremental = args.incremental if incremental is None else incremental
+        run_id = run_id or args.resume
+        profile = profile or args.profile
     
     try:
-        controller = CompanyDataController()
-        result = controller.process_company_data(company_id=company_id)
+        controller = CompanyDataController(workers=workers, incremental=incremental, run_id=run_id)
+        if profile:
+            with profiling.profile_job(controller.ledger.run_id, profile):
+                result = controller.process_company_data(company_id=company_id)
+            logger.info(f"Profile stored under {profiling.profile_path(controller.ledger.run_id)}")
+        else:
+            result = controller.process_company_data(company_id=company_id)
         
         if result["success"]:
             logger.info(result["message"])
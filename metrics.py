@@ -0,0 +1,291 @@
+"""
+Process-wide timers, counters and gauges, rendered in Prometheus text format
+at /metrics.
+
+    with metrics.timed("cdata_read"):
+        documents = list(cdata_collection.find(query))
+    metrics.inc("forecast_cache_hits_total")
+
+Stage timers are summaries (<name>_count / <name>_sum, plus a <name>_max gauge). Mongo
+documents read/written and command durations are counted by a pymongo
+CommandListener, and connection churn by a ConnectionPoolListener, both
+registered on import (db_connection imports this module before creating its
+client). Work done in child processes (CPU executor,
+scheduler workers) is shipped back with call_and_collect and merged.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Tuple
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+_lock = threading.Lock()
+_counters: Dict[str, Dict[LabelKey, float]] = {}
+_summaries: Dict[str, Dict[LabelKey, List[float]]] = {}  # [count, sum, max]
+_gauges: Dict[str, Dict[LabelKey, float]] = {}
+_gauge_callbacks: List[Callable[[], None]] = []
+
+HELP = {
+    "aggregation_stage_duration_seconds": "Time spent per processing stage",
+    "forecast_model_duration_seconds": "Fit and predict time per forecasting model",
+    "forecast_model_runs_total": "Forecast candidate models evaluated, by outcome",
+    "forecast_model_skipped_total": "Forecast candidate models not fitted, by reason",
+    "forecast_model_wins_total": "Forecasts by selected model and selection method",
+    "forecast_tournament_duration_seconds": "Total run_sarima time per forecast",
+    "forecast_series_length": "Length of the series passed to run_sarima",
+    "forecast_tournaments_total": "Full forecast tournaments, by the reason a warm start was not possible",
+    "forecast_warm_starts_total": "Warm-started forecast refits, by outcome",
+    "forecast_cache_hits_total": "Forecasts skipped because the series history was unchanged",
+    "forecast_cache_misses_total": "Forecasts computed",
+    "cpu_executor_restarts_total": "CPU process pools recreated after a worker died",
+    "mongo_documents_read_total": "Documents returned by Mongo find/getMore/aggregate",
+    "mongo_documents_written_total": "Documents inserted, updated or deleted",
+    "mongo_command_duration_seconds": "Mongo command round-trip time",
+    "mongo_command_failures_total": "Failed Mongo commands",
+    "api_requests_total": "Upstream API requests by endpoint and outcome",
+    "api_retries_total": "Upstream API retries (transport and application level)",
+    "api_cache_hits_total": "Upstream API lookups served from the local cache",
+    "circuit_breaker_open": "1 if the circuit breaker for an endpoint is open",
+    "code_catalog_refreshes_total": "Bulk reloads of the code catalog",
+    "code_catalog_misses_total": "Code lookups not found in the code catalog",
+    "mongo_clients_created_total": "Mongo clients created by db_connection",
+    "mongo_connections_created_total": "Mongo connections opened, by server",
+    "mongo_connections_closed_total": "Mongo connections closed, by server and reason",
+    "mongo_connections_open": "Mongo connections currently open, by server",
+    "mongo_connection_checkout_failures_total": "Mongo connection checkouts that failed, by reason",
+    "mongo_pool_cleared_total": "Mongo connection pools cleared after errors, by server",
+}
+
+
+def _key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    """Increment a counter"""
+    key = _key(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Record one observation (e.g. a duration in seconds) in a summary"""
+    key = _key(labels)
+    with _lock:
+        series = _summaries.setdefault(name, {})
+        entry = series.setdefault(key, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += value
+        entry[2] = max(entry[2], value)
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    with _lock:
+        _gauges.setdefault(name, {})[_key(labels)] = value
+
+
+def register_gauge_callback(callback: Callable[[], None]) -> None:
+    """Callback run before rendering, used to refresh gauges from live state"""
+    _gauge_callbacks.append(callback)
+
+
+@contextmanager
+def timed(stage: str, **labels):
+    """Time a block as aggregation_stage_duration_seconds{stage=...}"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("aggregation_stage_duration_seconds", time.perf_counter() - started, stage=stage, **labels)
+
+
+def snapshot() -> Dict[str, Any]:
+    """Copy of all counters and summaries (for shipping between processes)"""
+    with _lock:
+        return {
+            "counters": {name: dict(series) for name, series in _counters.items()},
+            "summaries": {name: {k: list(v) for k, v in series.items()} for name, series in _summaries.items()},
+        }
+
+
+def delta(before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, Any]:
+    """What was recorded between two snapshots"""
+    changes = {"counters": {}, "summaries": {}}
+    for name, series in after["counters"].items():
+        previous = before["counters"].get(name, {})
+        changed = {k: v - previous.get(k, 0) for k, v in series.items() if v != previous.get(k, 0)}
+        if changed:
+            changes["counters"][name] = changed
+    for name, series in after["summaries"].items():
+        previous = before["summaries"].get(name, {})
+        changed = {}
+        for k, (count, total, maximum) in series.items():
+            prev = previous.get(k, [0, 0.0, 0.0])
+            if count != prev[0]:
+                changed[k] = [count - prev[0], total - prev[1], maximum]
+        if changed:
+            changes["summaries"][name] = changed
+    return changes
+
+
+def merge(delta: Dict[str, Any]) -> None:
+    """Add a delta collected in another process"""
+    with _lock:
+        for name, series in delta.get("counters", {}).items():
+            target = _counters.setdefault(name, {})
+            for k, v in series.items():
+                target[k] = target.get(k, 0) + v
+        for name, series in delta.get("summaries", {}).items():
+            target = _summaries.setdefault(name, {})
+            for k, (count, total, maximum) in series.items():
+                entry = target.setdefault(k, [0, 0.0, 0.0])
+                entry[0] += count
+                entry[1] += total
+                entry[2] = max(entry[2], maximum)
+
+
+def call_and_collect(fn: Callable[..., Any], *args, **kwargs) -> Tuple[Any, Dict[str, Any]]:
+    """Run fn in a child process and return (result, metrics recorded meanwhile)"""
+    before = snapshot()
+    result = fn(*args, **kwargs)
+    return result, delta(before, snapshot())
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels_text(key: LabelKey) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in key) + "}"
+
+
+def render_prometheus() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    for callback in list(_gauge_callbacks):
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"Gauge callback failed: {str(e)}")
+
+    lines = []
+    with _lock:
+        for name in sorted(_counters):
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in sorted(_counters[name].items()):
+                lines.append(f"{name}{_labels_text(key)} {value}")
+        for name in sorted(_summaries):
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} summary")
+            for key, (count, total, _) in sorted(_summaries[name].items()):
+                lines.append(f"{name}_count{_labels_text(key)} {count}")
+                lines.append(f"{name}_sum{_labels_text(key)} {total}")
+            # The slowest observation is exported as its own gauge family
+            lines.append(f"# HELP {name}_max Largest observation of {name}")
+            lines.append(f"# TYPE {name}_max gauge")
+            for key, (_, _, maximum) in sorted(_summaries[name].items()):
+                lines.append(f"{name}_max{_labels_text(key)} {maximum}")
+        for name in sorted(_gauges):
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} gauge")
+            for key, value in sorted(_gauges[name].items()):
+                lines.append(f"{name}{_labels_text(key)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class MongoMetricsListener(monitoring.CommandListener):
+    """Counts documents read/written and command latency for every Mongo client"""
+
+    READ_COMMANDS = ("find", "getMore", "aggregate")
+    WRITE_COMMANDS = ("insert", "update", "delete", "findAndModify")
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        command = event.command_name
+        observe("mongo_command_duration_seconds", event.duration_micros / 1e6, command=command)
+        reply = event.reply or {}
+        if command in self.READ_COMMANDS:
+            cursor = reply.get("cursor") or {}
+            batch = cursor.get("firstBatch", cursor.get("nextBatch"))
+            if batch is not None:
+                inc("mongo_documents_read_total", len(batch), command=command)
+        elif command in self.WRITE_COMMANDS:
+            if command == "update":
+                written = reply.get("nModified", reply.get("n", 0))
+            elif command == "findAndModify":
+                written = (reply.get("lastErrorObject") or {}).get("n", 0)
+            else:
+                written = reply.get("n", 0)
+            inc("mongo_documents_written_total", written, command=command)
+
+    def failed(self, event):
+        observe("mongo_command_duration_seconds", event.duration_micros / 1e6, command=event.command_name)
+        inc("mongo_command_failures_total", command=event.command_name)
+
+
+class MongoPoolMetricsListener(monitoring.ConnectionPoolListener):
+    """Connection churn of every Mongo client: opens, closes, failed checkouts and pool clears"""
+
+    def __init__(self):
+        self._open: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _address(self, event) -> str:
+        host, port = event.address
+        return f"{host}:{port}"
+
+    def _track(self, event, change: int) -> None:
+        address = self._address(event)
+        with self._lock:
+            self._open[address] = self._open.get(address, 0) + change
+            set_gauge("mongo_connections_open", self._open[address], server=address)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        inc("mongo_pool_cleared_total", server=self._address(event))
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        inc("mongo_connections_created_total", server=self._address(event))
+        self._track(event, 1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        inc("mongo_connections_closed_total", server=self._address(event), reason=event.reason)
+        self._track(event, -1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        inc("mongo_connection_checkout_failures_total", reason=event.reason)
+
+    def connection_checked_out(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+monitoring.register(MongoMetricsListener())
+monitoring.register(MongoPoolMetricsListener())
@@ -0,0 +1,123 @@
+"""
+Candidate selection for the run_sarima model tournament.
+
+Instead of fitting every model on every series, select_candidates() drops the
+models that cannot fit the series meaningfully (too few points for their
+order or seasonal period, no seasonality for SARIMA, near-constant input,
+pmdarima not installed) and, once a code has enough forecast history, the
+models that never won for it. Every FORECAST_EXPLORE_EVERY-th forecast of a
+code still runs all eligible models so a pruned model can come back.
+
+FORECAST_FULL_TOURNAMENT=true restores the full tournament, for validating
+that pruning does not change the selected forecasts.
+"""
+import importlib.util
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+FORECAST_FULL_TOURNAMENT = os.getenv("FORECAST_FULL_TOURNAMENT", "false").lower() in ("1", "true", "yes")
+# Forecasts of a code needed before its historical win rates are trusted
+FORECAST_PRUNE_MIN_HISTORY = int(os.getenv("FORECAST_PRUNE_MIN_HISTORY", "10"))
+# Run every eligible model on each n-th forecast of a code (0 disables exploration)
+FORECAST_EXPLORE_EVERY = int(os.getenv("FORECAST_EXPLORE_EVERY", "10"))
+# AutoARIMA's order search is only worth its cost on longer histories
+AUTO_ARIMA_MIN_LENGTH = int(os.getenv("AUTO_ARIMA_MIN_LENGTH", "24"))
+
+REGRESSION_MODELS = ['Linear Regression', 'Ridge Regression', 'Lasso Regression', 'Elastic Net Regression',
+                     'Bayesian Regression', 'Polynomial Regression']
+TIME_SERIES_MODELS = ['AR', 'ARMA', 'ARIMA', 'SARIMA', 'SARIMAX', 'Auto ARIMA']
+
+# Always evaluated when eligible, so pruning by win rate never leaves an empty tournament
+BASELINE_MODELS = ('Linear Regression', 'AR')
+
+# Shortest series each model is fitted on (SARIMA/SARIMAX additionally need two seasons)
+MIN_LENGTH = {
+    'Polynomial Regression': 4,
+    'AR': 3,
+    'ARMA': 5,
+    'ARIMA': 6,
+    'Auto ARIMA': AUTO_ARIMA_MIN_LENGTH,
+}
+SARIMAX_SEASONAL_PERIOD = 12
+
+# Skip reasons (also used as metric labels)
+SKIP_TOO_SHORT = "too_short"
+SKIP_NO_SEASONALITY = "no_seasonality"
+SKIP_LOW_VARIANCE = "low_variance"
+SKIP_UNAVAILABLE = "unavailable"
+SKIP_NEVER_WINS = "never_wins"
+
+# Coefficient of variation below which ARIMA-family fits degenerate to a flat line
+LOW_VARIANCE_CV = 1e-3
+
+_pmdarima_available: Optional[bool] = None
+
+
+def _auto_arima_available() -> bool:
+    global _pmdarima_available
+    if _pmdarima_available is None:
+        _pmdarima_available = importlib.util.find_spec("pmdarima") is not None
+    return _pmdarima_available
+
+
+def _ineligible_reason(model: str, length: int, seasonality_period: Optional[int], low_variance: bool) -> Optional[str]:
+    if length < MIN_LENGTH.get(model, 2):
+        return SKIP_TOO_SHORT
+    if model in REGRESSION_MODELS:
+        return None
+    if low_variance:
+        return SKIP_LOW_VARIANCE
+    if model == 'SARIMA':
+        if not seasonality_period:
+            return SKIP_NO_SEASONALITY
+        if length < 2 * seasonality_period:
+            return SKIP_TOO_SHORT
+    if model == 'SARIMAX' and length < 2 * SARIMAX_SEASONAL_PERIOD:
+        return SKIP_TOO_SHORT
+    if model == 'Auto ARIMA' and not _auto_arima_available():
+        return SKIP_UNAVAILABLE
+    return None
+
+
+def select_candidates(series: List[float], seasonality_period: Optional[int] = None,
+                      model_wins: Optional[Dict[str, int]] = None,
+                      full_tournament: bool = FORECAST_FULL_TOURNAMENT) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Models to evaluate for series, in tournament order, and {model: reason} for the skipped ones.
+
+    model_wins: how often each model was selected in earlier forecasts of the same code.
+    """
+    all_models = REGRESSION_MODELS + TIME_SERIES_MODELS
+    if full_tournament:
+        return list(all_models), {}
+
+    values = np.asarray(series, dtype=float)
+    mean = abs(float(values.mean())) if len(values) else 0.0
+    low_variance = len(values) > 1 and float(values.std()) <= LOW_VARIANCE_CV * max(mean, 1.0)
+
+    selected, skipped = [], {}
+    for model in all_models:
+        reason = _ineligible_reason(model, len(values), seasonality_period, low_variance)
+        if reason:
+            skipped[model] = reason
+        else:
+            selected.append(model)
+
+    history = sum((model_wins or {}).values())
+    exploring = FORECAST_EXPLORE_EVERY > 0 and history % FORECAST_EXPLORE_EVERY == 0
+    if history >= FORECAST_PRUNE_MIN_HISTORY and not exploring:
+        winners = {model for model, wins in model_wins.items() if wins > 0}
+        for model in list(selected):
+            if model not in winners and model not in BASELINE_MODELS:
+                selected.remove(model)
+                skipped[model] = SKIP_NEVER_WINS
+
+    return selected, skipped
@@ -0,0 +1,127 @@
+"""
+Async prefetch stage for company metadata.
+
+Before an all-companies aggregation or rollup run, resolve every target
+company's start month and (for rollups) site list concurrently, under a
+concurrency limit and behind per-endpoint circuit breakers. Results are
+stored in the RegionAPI caches, so the controllers' per-company calls
+(fetch_company_data_safe, fetch_company_sites) are served locally.
+"""
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+import RegionAPI
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() in ("1", "true", "yes")
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "16"))
+PREFETCH_TIMEOUT = float(os.getenv("PREFETCH_TIMEOUT", "10"))
+PREFETCH_ATTEMPTS = int(os.getenv("PREFETCH_ATTEMPTS", "2"))
+
+
+async def _get_json(client, breaker: RegionAPI.CircuitBreaker, url: str) -> Optional[Dict]:
+    """GET a JSON document, honouring the circuit breaker"""
+    for attempt in range(PREFETCH_ATTEMPTS):
+        if not breaker.allow_request():
+            logger.debug(f"Circuit '{breaker.name}' open, skipping {url}")
+            return None
+        succeeded = None
+        try:
+            response = await client.get(url)
+            if response.status_code == 200:
+                data = response.json()
+                succeeded = True
+            else:
+                succeeded = False
+                logger.error(f"Prefetch request failed. Status: {response.status_code}, URL: {url}")
+        except Exception as e:
+            succeeded = False
+            logger.error(f"Prefetch error for {url}: {str(e)}")
+        finally:
+            if succeeded is None:
+                # Cancelled mid-request: no outcome, so give back a half-open trial
+                breaker.release_trial()
+        if succeeded:
+            breaker.record_success()
+            return data
+        breaker.record_failure()
+        if attempt < PREFETCH_ATTEMPTS - 1:
+            await asyncio.sleep(0.5 * (attempt + 1))
+    return None
+
+
+async def prefetch_company_metadata(company_ids: List[Any], include_sites: bool = False,
+                                    concurrency: int = PREFETCH_CONCURRENCY) -> Dict[str, Dict[str, bool]]:
+    """
+    Resolve start months (and optionally site lists) for all companies concurrently.
+
+    Returns:
+        Dict of company_id -> {"details": bool, "sites": bool} telling what was fetched
+    """
+    import httpx
+
+    company_url = os.getenv("COMPANY_DATA_URL", "").rstrip('/')
+    site_url = RegionAPI.SITE_DATA_URL.rstrip('/')
+    # Same breakers as the synchronous APIClient: one per upstream endpoint
+    company_breaker = RegionAPI.get_circuit_breaker("/company/data/{id}")
+    site_breaker = RegionAPI.get_circuit_breaker("/companies/{id}/sites")
+    semaphore = asyncio.Semaphore(concurrency)
+    results: Dict[str, Dict[str, bool]] = {}
+
+    async def prefetch_one(client, company_id):
+        outcome = {"details": False, "sites": False}
+        async with semaphore:
+            if company_url:
+                data = await _get_json(client, company_breaker, f"{company_url}/company/data/{company_id}")
+                company_data = RegionAPI.parse_company_details(company_id, data) if data else None
+                if company_data:
+                    RegionAPI.prime_company_details(company_id, company_data)
+                    outcome["details"] = True
+            if include_sites:
+                data = await _get_json(client, site_breaker, f"{site_url}/companies/{company_id}/sites")
+                sites = RegionAPI.parse_company_sites(company_id, data) if data else None
+                if sites:
+                    RegionAPI.prime_company_sites(company_id, sites)
+                    outcome["sites"] = True
+        results[str(company_id)] = outcome
+
+    pending = [c for c in company_ids if not RegionAPI.is_company_cached(c, include_sites)]
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    headers = {'User-Agent': 'CompanyDataClient/1.0', 'Accept': 'application/json'}
+    async with httpx.AsyncClient(timeout=PREFETCH_TIMEOUT, limits=limits, headers=headers) as client:
+        await asyncio.gather(*[prefetch_one(client, company_id) for company_id in pending])
+
+    return results
+
+
+def prefetch_companies(company_ids: List[Any], include_sites: bool = False) -> Dict[str, Dict[str, bool]]:
+    """
+    Synchronous entry point used by the controllers. Never raises: a failed
+    prefetch only means the controllers fall back to per-company fetches.
+    """
+    if not PREFETCH_ENABLED or not company_ids:
+        return {}
+
+    try:
+        asyncio.get_running_loop()
+        logger.info("Event loop already running in this thread, skipping prefetch")
+        return {}
+    except RuntimeError:
+        pass
+
+    try:
+        results = asyncio.run(prefetch_company_metadata(company_ids, include_sites=include_sites))
+        fetched = len([r for r in results.values() if r["details"]])
+        logger.info(f"Prefetched metadata for {fetched}/{len(results)} companies "
+                    f"({len(company_ids) - len(results)} already cached)")
+        return results
+    except Exception as e:
+        logger.error(f"Prefetch stage failed: {str(e)}")
+        return {}
@@ -0,0 +1,320 @@
+"""
+On-demand profiling of aggregation and rollup jobs.
+
+A job started with a profile option runs inside profile_job(), which records
+one of:
+
+- "sample" (the default): a wall-clock sampling profiler over the job's
+  thread and the pool threads started on its behalf (concurrency.io_stage
+  pools adopt their threads with adopt_pool_thread), stored as
+  stacks.collapsed in the folded format flamegraph.pl and speedscope read;
+  other jobs running in the same process are left out
+- "cprofile": deterministic cProfile of the job's own thread only, stored as
+  profile.pstats (load with pstats / snakeviz) and profile.txt (top functions
+  by cumulative time). The per-code work runs in the I/O pool threads and
+  shows up only as waiting; use it for the orchestration itself
+
+plus tracemalloc's top allocation sites at the memory peak and those still
+held at the end (allocations.txt), and a summary.json, under
+PROFILE_DIR/<job_id>/. Only the newest PROFILE_RETENTION profiles are kept.
+tracemalloc slows allocation-heavy code down
+noticeably; keep PROFILE_TRACEMALLOC_FRAMES low. Work sent to the CPU process
+pool (forecasting) runs in other processes and is not included; its time
+shows up as waiting.
+
+    with profile_job("agg_123_1700000000", "sample"):
+        main.main(company_id=123)
+"""
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import shutil
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))  # seconds between samples
+PROFILE_TOP_ALLOCATIONS = int(os.getenv("PROFILE_TOP_ALLOCATIONS", "25"))
+PROFILE_TRACEMALLOC_FRAMES = int(os.getenv("PROFILE_TRACEMALLOC_FRAMES", "1"))
+PROFILE_MEMORY_POLL_INTERVAL = float(os.getenv("PROFILE_MEMORY_POLL_INTERVAL", "0.25"))  # seconds
+# Profiles kept under PROFILE_DIR; older ones are deleted when a new one is written
+PROFILE_RETENTION = int(os.getenv("PROFILE_RETENTION", "50"))
+# Take a new peak snapshot once traced memory grows this much past the last one
+PEAK_SNAPSHOT_GROWTH = 1.2
+
+PROFILE_MODES = ("cprofile", "sample")
+# Mode for a plain "true" / --profile: the only one that sees the I/O pool threads
+DEFAULT_PROFILE_MODE = "sample"
+# What each mode covers, recorded in summary.json
+PROFILE_COVERAGE = {
+    "cprofile": "calling thread only; I/O pool threads and the CPU process pool are not profiled",
+    "sample": "the job's thread and the I/O pool threads it started; other jobs, shared CPU executor "
+              "threads and the CPU process pool are not profiled",
+}
+# Files a profile directory may contain (the only names the download endpoints serve)
+PROFILE_ARTIFACTS = {
+    "summary.json": "application/json",
+    "profile.pstats": "application/octet-stream",
+    "profile.txt": "text/plain",
+    "stacks.collapsed": "text/plain",
+    "allocations.txt": "text/plain",
+}
+
+_JOB_ID = re.compile(r"^[\w.-]+$")
+
+# tracemalloc is process-wide; nested / concurrent profiled jobs share one session
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+
+def parse_mode(value: Any) -> Optional[str]:
+    """Profile option from a request or CLI: None/false -> None, true -> DEFAULT_PROFILE_MODE, or a mode name"""
+    if value is None or value is False:
+        return None
+    text = str(value).strip().lower()
+    if text in ("", "0", "false", "no", "off"):
+        return None
+    if text in ("1", "true", "yes", "on"):
+        return DEFAULT_PROFILE_MODE
+    if text not in PROFILE_MODES:
+        raise ValueError(f"Invalid profile mode {value!r}, expected one of {', '.join(PROFILE_MODES)}")
+    return text
+
+
+def profile_path(job_id: str, artifact: Optional[str] = None) -> Optional[str]:
+    """Path of a job's profile directory or artifact, None for unknown names"""
+    if not _JOB_ID.match(job_id or "") or (artifact is not None and artifact not in PROFILE_ARTIFACTS):
+        return None
+    directory = os.path.join(PROFILE_DIR, job_id)
+    return directory if artifact is None else os.path.join(directory, artifact)
+
+
+def adopt_pool_thread(parent: int) -> None:
+    """
+    Pool initializer: mark the current thread as working for the thread parent
+    (an ident), so a sample profile of parent's job includes it
+    """
+    threading.current_thread().profile_parent = parent
+
+
+def _job_threads(root: int) -> Dict[int, str]:
+    """ident -> name of root and of every thread adopted by it, directly or through another pool thread"""
+    threads = {t.ident: t for t in threading.enumerate()}
+    selected = {}
+    for ident, thread in threads.items():
+        current, seen = thread, set()
+        while current is not None and current.ident not in seen:
+            if current.ident == root:
+                selected[ident] = thread.name
+                break
+            seen.add(current.ident)
+            current = threads.get(getattr(current, "profile_parent", None))
+    return selected
+
+
+class StackSampler:
+    """Samples the stacks of a job's threads (see _job_threads) every interval and counts them in folded form"""
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL, root: Optional[int] = None):
+        self.interval = interval
+        self.root = threading.get_ident() if root is None else root
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ProfileSampler", daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            names = _job_threads(self.root)
+            for ident, frame in sys._current_frames().items():
+                if ident not in names:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                # Root first, thread name as the base frame so pools stay apart in the graph
+                thread_name = re.sub(r"[-_]\d+$", "", names.get(ident, "thread"))
+                self.stacks[";".join([thread_name] + stack[::-1])] += 1
+            self.samples += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class PeakSnapshotter:
+    """Keeps a tracemalloc snapshot from (close to) the highest traced memory seen"""
+
+    def __init__(self, interval: float = PROFILE_MEMORY_POLL_INTERVAL):
+        self.interval = interval
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        self.snapshot_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ProfileMemory", daemon=True)
+
+    def _run(self) -> None:
+        threshold = 1e6
+        while not self._stop.wait(self.interval):
+            current, _ = tracemalloc.get_traced_memory()
+            if current > threshold:
+                self.snapshot = tracemalloc.take_snapshot()
+                self.snapshot_mb = current / 1e6
+                threshold = current * PEAK_SNAPSHOT_GROWTH
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def _top_allocations(snapshot: tracemalloc.Snapshot) -> List[str]:
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+    return [f"{stat.size / 1e6:10.3f} MB {stat.count:9d} blocks  {stat.traceback}"
+            for stat in snapshot.statistics("lineno")[:PROFILE_TOP_ALLOCATIONS]]
+
+
+def _start_tracemalloc() -> None:
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc(peak_snapshot: Optional[tracemalloc.Snapshot], peak_snapshot_mb: float) -> Dict[str, Any]:
+    """Top allocation sites and traced memory; stops tracing when the last profiled job ends"""
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+    lines = [f"traced memory: current {current / 1e6:.1f} MB, peak {peak / 1e6:.1f} MB", ""]
+    if peak_snapshot is not None:
+        lines += [f"top allocation sites near the peak ({peak_snapshot_mb:.1f} MB traced):"]
+        lines += _top_allocations(peak_snapshot) + [""]
+    lines += ["top allocation sites still held at the end:"] + _top_allocations(snapshot)
+    return {"current_mb": round(current / 1e6, 3), "peak_mb": round(peak / 1e6, 3), "text": "\n".join(lines) + "\n"}
+
+
+@contextmanager
+def profile_job(job_id: str, mode: str = DEFAULT_PROFILE_MODE):
+    """
+    Profile the enclosed block and write the results to PROFILE_DIR/<job_id>/.
+    Yields the summary dict, which is complete once the block exits.
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Invalid profile mode {mode!r}")
+    directory = profile_path(job_id)
+    if directory is None:
+        raise ValueError(f"Invalid job id for profiling: {job_id!r}")
+    os.makedirs(directory, exist_ok=True)
+
+    summary: Dict[str, Any] = {"job_id": job_id, "mode": mode, "coverage": PROFILE_COVERAGE[mode],
+                               "started_at": datetime.now().isoformat()}
+    profiler = cProfile.Profile() if mode == "cprofile" else None
+    sampler = StackSampler() if mode == "sample" else None
+    _start_tracemalloc()
+    memory = PeakSnapshotter()
+    memory.start()
+    started = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    if sampler:
+        sampler.start()
+    try:
+        yield summary
+    finally:
+        if profiler:
+            profiler.disable()
+        if sampler:
+            sampler.stop()
+        memory.stop()
+        summary["duration_seconds"] = round(time.perf_counter() - started, 3)
+        try:
+            allocations = _stop_tracemalloc(memory.snapshot, memory.snapshot_mb)
+            with open(os.path.join(directory, "allocations.txt"), "w") as f:
+                f.write(allocations["text"])
+            summary["memory"] = {"current_mb": allocations["current_mb"], "peak_mb": allocations["peak_mb"]}
+
+            if profiler:
+                profiler.dump_stats(os.path.join(directory, "profile.pstats"))
+                text = io.StringIO()
+                pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(50)
+                with open(os.path.join(directory, "profile.txt"), "w") as f:
+                    f.write(text.getvalue())
+            if sampler:
+                with open(os.path.join(directory, "stacks.collapsed"), "w") as f:
+                    f.write(sampler.collapsed())
+                summary["samples"] = sampler.samples
+                summary["sample_interval_seconds"] = sampler.interval
+
+            summary["artifacts"] = sorted(name for name in PROFILE_ARTIFACTS
+                                          if name != "summary.json" and os.path.exists(os.path.join(directory, name)))
+            with open(os.path.join(directory, "summary.json"), "w") as f:
+                json.dump(summary, f, indent=2)
+            logger.info(f"Profile for job {job_id} written to {directory}")
+            _prune_profiles(keep=job_id)
+        except Exception as e:
+            # A failed profile write must not fail the job itself
+            logger.error(f"Writing profile for job {job_id} failed: {str(e)}")
+
+
+def _prune_profiles(keep: str, retention: Optional[int] = None) -> None:
+    """Delete the oldest profile directories beyond retention (PROFILE_RETENTION); never keep's"""
+    retention = PROFILE_RETENTION if retention is None else retention
+    if retention <= 0:
+        return
+    directories = [os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR)
+                   if _JOB_ID.match(name) and os.path.isdir(os.path.join(PROFILE_DIR, name))]
+    directories.sort(key=os.path.getmtime, reverse=True)
+    for directory in directories[retention:]:
+        if os.path.basename(directory) != keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def load_summary(job_id: str) -> Optional[Dict[str, Any]]:
+    path = profile_path(job_id, "summary.json")
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def list_profiles() -> List[Dict[str, Any]]:
+    """Summaries of all stored profiles, newest first"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    summaries = [load_summary(job_id) for job_id in os.listdir(PROFILE_DIR)]
+    return sorted((s for s in summaries if s), key=lambda s: s.get("started_at", ""), reverse=True)
@@ -10,10 +10,14 @@ import traceback
 from datetime import date, datetime
 from pymongo import MongoClient
 import os
-import requests
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from RegionAPI import fetch_company_data_safe as fetch_company_data, fetch_all_company
+from RegionAPI import fetch_company_data_safe as fetch_company_data, fetch_all_company, get_company_by_id, fetch_company_sites
 import db_connection
+import metrics
+import profiling
+from prefetch import prefetch_companies
+from run_ledger import RunLedger, unit_key
+from work_leases import lease_manager, shared_lease_epoch
 from typing import Optional, Dict, List, Any
 from bson import ObjectId
 
@@ -31,8 +35,8 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 class SiteDataRollup:
-    def __init__(self):
-        """Initialize the controller with database connection"""
+    def __init__(self, run_id: Optional[str] = None):
+        """Initialize the controller with database connection (run_id of an earlier run resumes it)"""
         try:
             self.connection = db_connection.connect_to_database()
             if self.connection is not None:
@@ -52,6 +56,12 @@ class SiteDataRollup:
                 self.rollup_quarterly = self.connection["rollup_quarterly"]
                 self.rollup_bi_annual = self.connection["rollup_bi_annual"]
                 self.rollup_yearly = self.connection["rollup_yearly"]
+                # Reruns replace a unit's rows by rollup_unit_key
+                for collection in (self.rollup_monthly, self.rollup_quarterly, self.rollup_bi_annual, self.rollup_yearly):
+                    collection.create_index("rollup_unit_key")
+                self.ledger = RunLedger(self.connection, 'rollup', run_id)
+                # Cross-replica claim on each company, so parallel service replicas split the work
+                self.leases = lease_manager(self.connection, 'rollup', shared_lease_epoch(self.connection, run_id))
                 logger.info("Database connection established successfully")
                 self._test_rollup_collection_creation()
             else:
@@ -82,22 +92,9 @@ class SiteDataRollup:
         Dynamically detects if sites are flat or hierarchical based on API response
         """
         try:
-            api_url = f"https://stagging-region.spectreco.com/api/companies/{company_id}/sites"
-            logger.info(f"Fetching site data from: {api_url}")
-            
-            response = requests.get(api_url, timeout=30)
-            if response.status_code != 200:
-                logger.error(f"Failed to fetch site data. Status: {response.status_code}")
-                return None
-            
-            data = response.json()
-            if not data.get('success') or data.get('code') != 200:
-                logger.error(f"API returned error: {data}")
-                return None
-            
-            sites = data.get('data', [])
+            # Cached (and possibly prefetched) flat site list; the hierarchy is not served from the stale window
+            sites = fetch_company_sites(company_id, allow_stale=False)
             if not sites:
-                logger.warning(f"No sites found for company {company_id}")
                 return None
             
             # Analyze the site structure to determine if it's flat or hierarchical
@@ -384,10 +381,16 @@ class SiteDataRollup:
         
         return result
     
-    def save_rollup_to_db(self, frequency='yearly'):
+    def save_rollup_to_db(self, frequency='yearly', rollup_unit_key=None, legacy_filter=None):
         """
         Save the current rollup table to the appropriate MongoDB collection based on frequency.
         Handles conversion of any non-serializable fields.
+        When rollup_unit_key is given, records saved earlier for the same unit are replaced,
+        so re-running (or resuming) a unit does not duplicate its rollup: the new records are
+        inserted under a fresh rollup_generation first and the unit's other generations are
+        deleted afterwards, so a failed insert leaves the previous rollup in place. Records
+        saved before rollup_unit_key existed are matched by legacy_filter instead.
+        Raises when the records cannot be written, so the unit is not recorded as completed.
         """
         import uuid
         db_name = self.connection.name if hasattr(self.connection, 'name') else str(self.connection)
@@ -409,55 +412,75 @@ class SiteDataRollup:
         print(f"[DEBUG] Using database: {db_name}, collection: {collection_name}")
         logger.info(f"save_rollup_to_db called for {frequency}. new_rollup_table length: {len(self.new_rollup_table)}")
         print(f"save_rollup_to_db called for {frequency}. new_rollup_table length: {len(self.new_rollup_table)}")
+        generation = str(uuid.uuid4())
         if not self.new_rollup_table:
             logger.info(f"No rollup records to save for {frequency}.")
             print(f"No rollup records to save for {frequency}.")
-            return
-        try:
-            # Prepare records for MongoDB (remove any problematic fields)
-            records_to_insert = []
-            for i, record in enumerate(self.new_rollup_table):
-                rec = dict(record)
-                rec.pop('_id', None)
-                # Add a unique field for this test run
-                rec['rollup_insert_uuid'] = str(uuid.uuid4())
-                rec['rollup_frequency'] = frequency  # Add frequency info to the record
-                records_to_insert.append(rec)
-            logger.info(f"Attempting to insert {len(records_to_insert)} records into {collection_name}.")
-            print(f"Attempting to insert {len(records_to_insert)} records into {collection_name}.")
-            # Print all records (up to 10)
-            for idx, rec in enumerate(records_to_insert[:10]):
-                print(f"Record {idx+1}: {rec}")
-            if len(records_to_insert) > 10:
-                print(f"... {len(records_to_insert)-10} more records not shown ...")
-            result = collection.insert_many(records_to_insert)
-            logger.info(f"Inserted {len(result.inserted_ids)} rollup records into {collection_name}.")
-            print(f"Inserted {len(result.inserted_ids)} rollup records into {collection_name}.")
-            print(f"[DEBUG] Inserted IDs: {result.inserted_ids}")
-            # Print count after insert
-            count = collection.count_documents({})
-            print(f"[DEBUG] {collection_name} document count after insert: {count}")
-        except Exception as e:
-            logger.error(f"Failed to insert rollup records for {frequency}: {str(e)}")
-            print(f"Failed to insert rollup records for {frequency}: {str(e)}")
+        else:
+            try:
+                # Prepare records for MongoDB (remove any problematic fields)
+                records_to_insert = []
+                for i, record in enumerate(self.new_rollup_table):
+                    rec = dict(record)
+                    rec.pop('_id', None)
+                    # Add a unique field for this test run
+                    rec['rollup_insert_uuid'] = str(uuid.uuid4())
+                    rec['rollup_frequency'] = frequency  # Add frequency info to the record
+                    if rollup_unit_key:
+                        rec['rollup_unit_key'] = rollup_unit_key
+                        rec['rollup_generation'] = generation
+                        rec['rollup_run_id'] = self.ledger.run_id
+                    records_to_insert.append(rec)
+                logger.info(f"Attempting to insert {len(records_to_insert)} records into {collection_name}.")
+                print(f"Attempting to insert {len(records_to_insert)} records into {collection_name}.")
+                # Print all records (up to 10)
+                for idx, rec in enumerate(records_to_insert[:10]):
+                    print(f"Record {idx+1}: {rec}")
+                if len(records_to_insert) > 10:
+                    print(f"... {len(records_to_insert)-10} more records not shown ...")
+                result = collection.insert_many(records_to_insert)
+                logger.info(f"Inserted {len(result.inserted_ids)} rollup records into {collection_name}.")
+                print(f"Inserted {len(result.inserted_ids)} rollup records into {collection_name}.")
+                print(f"[DEBUG] Inserted IDs: {result.inserted_ids}")
+                # Print count after insert
+                count = collection.count_documents({})
+                print(f"[DEBUG] {collection_name} document count after insert: {count}")
+            except Exception as e:
+                logger.error(f"Failed to insert rollup records for {frequency}: {str(e)}")
+                print(f"Failed to insert rollup records for {frequency}: {str(e)}")
+                raise
+        if rollup_unit_key:
+            # Also when the unit no longer produces rows, so its stale rows do not linger
+            try:
+                deleted = collection.delete_many({"rollup_unit_key": rollup_unit_key,
+                                                  "rollup_generation": {"$ne": generation}})
+                if legacy_filter:
+                    deleted_legacy = collection.delete_many({**legacy_filter, "rollup_unit_key": {"$exists": False}})
+                    logger.info(f"Replaced {deleted_legacy.deleted_count} records of unit {rollup_unit_key} "
+                                f"saved without a unit key")
+                logger.info(f"Replaced {deleted.deleted_count} earlier records of unit {rollup_unit_key}")
+            except Exception as e:
+                logger.error(f"Failed to remove earlier rollup records of unit {rollup_unit_key}: {str(e)}")
+                raise
     
-    def save_rollup_monthly_to_db(self):
+    def save_rollup_monthly_to_db(self, rollup_unit_key=None, legacy_filter=None):
         """Save rollup data to monthly collection"""
-        self.save_rollup_to_db('monthly')
+        self.save_rollup_to_db('monthly', rollup_unit_key, legacy_filter)
     
-    def save_rollup_quarterly_to_db(self):
+    def save_rollup_quarterly_to_db(self, rollup_unit_key=None, legacy_filter=None):
         """Save rollup data to quarterly collection"""
-        self.save_rollup_to_db('quarterly')
+        self.save_rollup_to_db('quarterly', rollup_unit_key, legacy_filter)
     
-    def save_rollup_bi_annual_to_db(self):
+    def save_rollup_bi_annual_to_db(self, rollup_unit_key=None, legacy_filter=None):
         """Save rollup data to bi-annual collection"""
-        self.save_rollup_to_db('bi_annual')
+        self.save_rollup_to_db('bi_annual', rollup_unit_key, legacy_filter)
     
-    def save_rollup_yearly_to_db(self):
+    def save_rollup_yearly_to_db(self, rollup_unit_key=None, legacy_filter=None):
         """Save rollup data to yearly collection"""
-        self.save_rollup_to_db('yearly')
+        self.save_rollup_to_db('yearly', rollup_unit_key, legacy_filter)
     
-    def process_rollup(self, site_data: Dict, cdata_list: List[Dict], year: int, internal_code_id: str, frequency: str = 'yearly'):
+    def process_rollup(self, site_data: Dict, cdata_list: List[Dict], year: int, internal_code_id: str, frequency: str = 'yearly',
+                       rollup_unit_key: Optional[str] = None, legacy_filter: Optional[Dict] = None):
         """
         Main entry point for rollup processing
         """
@@ -469,21 +492,23 @@ class SiteDataRollup:
         self.processed_combinations = set()
         
         # Start recursive processing from root
-        root_result = self.rollup_recursive(site_data, cdata_list, year, internal_code_id)
+        with metrics.timed("rollup_traversal", frequency=frequency):
+            root_result = self.rollup_recursive(site_data, cdata_list, year, internal_code_id)
         
         print("\n" + "="*80)
         print(f"Rollup completed! Created {len(self.new_rollup_table)} records")
         print(f"Root site total contribution: qty={root_result['own_contribution']['qty']:.2f}, value={root_result['own_contribution']['value']:.2f}")
         
         # Save all rollup records to MongoDB based on frequency
-        if frequency == 'monthly':
-            self.save_rollup_monthly_to_db()
-        elif frequency == 'quarterly':
-            self.save_rollup_quarterly_to_db()
-        elif frequency == 'bi_annual':
-            self.save_rollup_bi_annual_to_db()
-        else:  # yearly (default)
-            self.save_rollup_yearly_to_db()
+        with metrics.timed("rollup_save", frequency=frequency):
+            if frequency == 'monthly':
+                self.save_rollup_monthly_to_db(rollup_unit_key, legacy_filter)
+            elif frequency == 'quarterly':
+                self.save_rollup_quarterly_to_db(rollup_unit_key, legacy_filter)
+            elif frequency == 'bi_annual':
+                self.save_rollup_bi_annual_to_db(rollup_unit_key, legacy_filter)
+            else:  # yearly (default)
+                self.save_rollup_yearly_to_db(rollup_unit_key, legacy_filter)
     
     def get_rollup_table(self) -> List[Dict]:
         """
@@ -574,10 +599,16 @@ class SiteDataRollup:
                     "message": f"Could not fetch site data for company {company_id}. Skipping {frequency} data."
                 }
             
+            # Natural key of this rollup unit; its earlier output is replaced on save
+            rollup_unit_key = f"{unit_key(company_id, internal_code_id, frequency)}:{year}"
+            # The unit's source rows; rollup rows copy these fields, so the same filter finds
+            # rows this unit saved before rollup_unit_key existed
+            unit_query = {"company_id": str(company_id), "reporting_year": year, "internal_code_id": internal_code_id}
+            
             # Process main company data
             if frequency == 'month':
                 # Read cdata monthly from db
-                sample_cdata = list(self.cdata_monthly.find({"company_id": str(company_id), "reporting_year": year, "internal_code_id": internal_code_id}))
+                sample_cdata = list(self.cdata_monthly.find(unit_query))
                 logger.info(f"Processing monthly data for year {year}, internal_code_id {internal_code_id}")
                 # Process the rollup
                 self.process_rollup(
@@ -585,10 +616,12 @@ class SiteDataRollup:
                     sample_cdata, 
                     year, 
                     internal_code_id,
-                    'monthly'
+                    'monthly',
+                    rollup_unit_key,
+                    unit_query
                 )
             elif frequency == 'quater':
-                sample_cdata = list(self.cdata_quarterly.find({"company_id": str(company_id), "reporting_year": year, "internal_code_id": internal_code_id}))
+                sample_cdata = list(self.cdata_quarterly.find(unit_query))
                 logger.info(f"Processing quarterly data for year {year}, internal_code_id {internal_code_id}")
                 # Process the rollup
                 self.process_rollup(
@@ -596,10 +629,12 @@ class SiteDataRollup:
                     sample_cdata, 
                     year, 
                     internal_code_id,
-                    'quarterly'
+                    'quarterly',
+                    rollup_unit_key,
+                    unit_query
                 )
             elif frequency == 'semi_annual':
-                sample_cdata = list(self.cdata_bi_annual.find({"company_id": str(company_id), "reporting_year": year, "internal_code_id": internal_code_id}))
+                sample_cdata = list(self.cdata_bi_annual.find(unit_query))
                 logger.info(f"Processing semi-annual data for year {year}, internal_code_id {internal_code_id}")
                 # Process the rollup
                 self.process_rollup(
@@ -607,10 +642,12 @@ class SiteDataRollup:
                     sample_cdata, 
                     year, 
                     internal_code_id,
-                    'bi_annual'
+                    'bi_annual',
+                    rollup_unit_key,
+                    unit_query
                 )
             elif frequency == 'annual':
-                sample_cdata = list(self.cdata_yearly.find({"company_id": str(company_id), "reporting_year": year, "internal_code_id": internal_code_id}))
+                sample_cdata = list(self.cdata_yearly.find(unit_query))
                 logger.info(f"Processing annual data for year {year}, internal_code_id {internal_code_id}")
                 # Process the rollup
                 self.process_rollup(
@@ -618,7 +655,9 @@ class SiteDataRollup:
                     sample_cdata, 
                     year, 
                     internal_code_id,
-                    'yearly'
+                    'yearly',
+                    rollup_unit_key,
+                    unit_query
                 )
             
             return {
@@ -671,15 +710,20 @@ class SiteDataRollup:
                 
                 # Process each reporting frequency
                 for freq in reporting_frequencies:
+                    if self.ledger.is_completed(company_id, internal_code_id, freq):
+                        code_results.append({"frequency": freq, "status": "skipped", "message": "Completed earlier in this run"})
+                        continue
                     try:
+                        self.ledger.start(company_id, internal_code_id, freq)
                         is_reporting_next = False if len(reporting_frequencies) == 4 else True
                         result = self._process_frequency(
                             company, company_id, internal_code_id, freq, year, start_month, is_reporting_next
                         )
-                        code_results.append(result)
+                        code_results.append(self.ledger.record(result, company_id, internal_code_id, freq))
                         
                     except Exception as e:
                         logger.error(f"Error processing frequency {freq} for code {internal_code_id}: {str(e)}")
+                        self.ledger.fail(company_id, internal_code_id, freq, str(e))
                         code_results.append({
                             "frequency": freq,
                             "status": "error",
@@ -776,10 +820,24 @@ class SiteDataRollup:
         processed_companies = []
         
         for i, company in enumerate(companies, 1):
+            if self.ledger.is_completed(company['id']):
+                logger.info(f"Skipping company {company.get('id')}, completed in run {self.ledger.run_id}")
+                continue
             try:
                 logger.info(f"Processing company {i}/{len(companies)}: ID {company.get('id')}")
-                result = self._process_single_company(company, year)
-                processed_companies.append(result)
+                if self.leases is not None and not self.leases.acquire(unit_key(company['id'])):
+                    logger.info(f"Company {company.get('id')} is leased by another worker or done in this run, skipping")
+                    continue
+                try:
+                    self.ledger.start(company['id'])
+                    result = self._process_single_company(company, year)
+                    processed_companies.append(self.ledger.record(result, company['id']))
+                    if self.leases is not None and self.ledger.is_completed(company['id']):
+                        # Keep the claim so replicas reaching the company later skip it
+                        self.leases.complete(unit_key(company['id']))
+                finally:
+                    if self.leases is not None and self.leases.is_held(unit_key(company['id'])):
+                        self.leases.release(unit_key(company['id']))
                 
             except Exception as e:
                 logger.error(f"Error processing company {company.get('id', 'unknown')}: {str(e)}")
@@ -796,17 +854,9 @@ class SiteDataRollup:
     def _get_companies_to_process(self, company_id: Optional[int]) -> List[Dict]:
         """Get companies to process based on company_id parameter"""
         try:
-            all_companies = fetch_all_company()
-            
-            if not all_companies:
-                logger.error("Failed to fetch companies from API")
-                return []
-                
-            logger.info(f"Fetched {len(all_companies)} total companies from API")
-            
             if company_id is not None:
-                # Process specific company
-                company = next((c for c in all_companies if c['id'] == company_id), None)
+                # Process specific company (indexed lookup in the cached company list)
+                company = get_company_by_id(company_id)
                 if company:
                     logger.info(f"Found company with ID {company_id}: {company.get('company_name', 'Unknown')}")
                     return [company]
@@ -815,6 +865,13 @@ class SiteDataRollup:
                     return []
             else:
                 # Process all companies
+                all_companies = fetch_all_company()
+                
+                if not all_companies:
+                    logger.error("Failed to fetch companies from API")
+                    return []
+                
+                logger.info(f"Fetched {len(all_companies)} total companies from API")
                 logger.info("Processing all companies")
                 return all_companies
                 
@@ -856,6 +913,10 @@ class SiteDataRollup:
             
             logger.info(f"Processing {len(companies)} companies")
             
+            # Resolve start months and site hierarchies for all companies up front
+            if len(companies) > 1:
+                prefetch_companies([c['id'] for c in companies], include_sites=True)
+            
             # Process companies
             processed_companies = self._process_companies(companies, year)
             
@@ -875,6 +936,7 @@ class SiteDataRollup:
                         "total_companies": len(processed_companies),
                         "successful": success_count,
                         "failed": error_count,
+                        "run_id": self.ledger.run_id,
                         "processing_time_seconds": processing_time,
                         "start_time": start_time.isoformat(),
                         "end_time": end_time.isoformat()
@@ -891,12 +953,15 @@ class SiteDataRollup:
                 "data": None
             }
 
-def main(company_id: Optional[int] = None) -> Dict[str, Any]:
+def main(company_id: Optional[int] = None, run_id: Optional[str] = None,
+         profile: Optional[str] = None) -> Dict[str, Any]:
     """
     Main function for command line execution and programmatic use
     
     Args:
         company_id: Optional company ID to process
+        run_id: Optional ledger run id; pass the id of an interrupted run to resume it
+        profile: Optional profiling mode (cprofile or sample); the profile is stored under the run id
         
     Returns:
         Dict containing processing results
@@ -907,12 +972,22 @@ def main(company_id: Optional[int] = None) -> Dict[str, Any]:
     if company_id is None:
         parser = argparse.ArgumentParser(description='Process company data.')
         parser.add_argument('--company_id', type=int, help='Specific company ID to process')
-        args = parser.parse_args()
+        parser.add_argument('--resume', metavar='RUN_ID', help='Resume an interrupted run, skipping completed units')
+        parser.add_argument('--profile', nargs='?', const=profiling.DEFAULT_PROFILE_MODE, choices=profiling.PROFILE_MODES,
+                            help='Profile the run (sample or cprofile) into PROFILE_DIR/<run id>')
+        args, _ = parser.parse_known_args()  # ignore arguments meant for the hosting server (flask/uvicorn)
         company_id = args.company_id
+        run_id = run_id or args.resume
+        profile = profile or args.profile
     
     try:
-        controller = SiteDataRollup()
-        result = controller.process_company_data(company_id)
+        controller = SiteDataRollup(run_id=run_id)
+        if profile:
+            with profiling.profile_job(controller.ledger.run_id, profile):
+                result = controller.process_company_data(company_id)
+            logger.info(f"Profile stored under {profiling.profile_path(controller.ledger.run_id)}")
+        else:
+            result = controller.process_company_data(company_id)
         
         if result["success"]:
             logger.info(result["message"])
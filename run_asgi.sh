@@ -0,0 +1,5 @@
+#!/bin/bash
+# Async serving mode: read endpoints run on the event loop, long-running jobs go to the job pool.
+# Keep a single worker process: the job registry used by /status lives in-process.
+export JOB_POOL_WORKERS=${JOB_POOL_WORKERS:-4}
+python3 -m uvicorn asgi_app:app --host=0.0.0.0 --port=5000 --workers 1 --loop asyncio
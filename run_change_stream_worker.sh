@@ -0,0 +1,4 @@
+#!/bin/bash
+# Near-real-time aggregation: tails the cdata change stream (needs a replica set, see change_stream_worker.py).
+export CHANGE_STREAM_DEBOUNCE_SECONDS=${CHANGE_STREAM_DEBOUNCE_SECONDS:-2}
+python3 change_stream_worker.py "$@"
@@ -0,0 +1,116 @@
+"""
+Run ledger for checkpointed, resumable aggregation and rollup runs.
+
+Every run has a run_id. Each (company, code, frequency) unit, and each company
+as a whole, gets a document in the run_ledger collection holding its state
+(running / completed / failed). When a run is started again with the same
+run_id (--resume RUN_ID on the CLI, resume_run_id on the API) the units that
+already completed are skipped.
+"""
+import logging
+import threading
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from pymongo import ASCENDING
+
+logger = logging.getLogger(__name__)
+
+RUN_LEDGER_COLLECTION = "run_ledger"
+
+STATUS_RUNNING = "running"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+
+
+def new_run_id(job_type: str) -> str:
+    return f"{job_type}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+
+
+def unit_key(company_id: Any, internal_code_id: Any = None, frequency: Optional[str] = None) -> str:
+    """Natural key of a unit: company[:code:frequency]"""
+    parts = [str(company_id)]
+    if internal_code_id is not None:
+        parts.append(str(internal_code_id))
+    if frequency is not None:
+        parts.append(frequency)
+    return ":".join(parts)
+
+
+class RunLedger:
+    def __init__(self, connection, job_type: str, run_id: Optional[str] = None):
+        self.collection = connection[RUN_LEDGER_COLLECTION]
+        self.job_type = job_type
+        self.run_id = run_id or new_run_id(job_type)
+        self._lock = threading.Lock()
+        self.collection.create_index([("run_id", ASCENDING), ("status", ASCENDING)])
+
+        # Units finished by an earlier attempt of this run; loaded once so the checks are local
+        self._completed = {
+            doc["unit_key"] for doc in self.collection.find(
+                {"run_id": self.run_id, "status": STATUS_COMPLETED}, {"unit_key": 1}
+            )
+        }
+        if self._completed:
+            logger.info(f"Resuming run {self.run_id}: {len(self._completed)} unit(s) already completed")
+        else:
+            logger.info(f"Run {self.run_id} ({job_type})")
+
+    def is_completed(self, company_id: Any, internal_code_id: Any = None, frequency: Optional[str] = None) -> bool:
+        with self._lock:
+            return unit_key(company_id, internal_code_id, frequency) in self._completed
+
+    def start(self, company_id: Any, internal_code_id: Any = None, frequency: Optional[str] = None) -> None:
+        key = unit_key(company_id, internal_code_id, frequency)
+        self.collection.update_one(
+            {"_id": f"{self.run_id}:{key}"},
+            {
+                "$set": {
+                    "run_id": self.run_id,
+                    "job_type": self.job_type,
+                    "unit_key": key,
+                    "company_id": str(company_id),
+                    "internal_code_id": str(internal_code_id) if internal_code_id is not None else None,
+                    "frequency": frequency,
+                    "status": STATUS_RUNNING,
+                    "started_at": datetime.now(),
+                },
+                "$inc": {"attempts": 1},
+                "$unset": {"error": ""},
+            },
+            upsert=True
+        )
+
+    def complete(self, company_id: Any, internal_code_id: Any = None, frequency: Optional[str] = None) -> None:
+        key = unit_key(company_id, internal_code_id, frequency)
+        self.collection.update_one(
+            {"_id": f"{self.run_id}:{key}"},
+            {"$set": {"status": STATUS_COMPLETED, "finished_at": datetime.now()}}
+        )
+        with self._lock:
+            self._completed.add(key)
+
+    def fail(self, company_id: Any, internal_code_id: Any = None, frequency: Optional[str] = None,
+             error: str = "") -> None:
+        key = unit_key(company_id, internal_code_id, frequency)
+        self.collection.update_one(
+            {"_id": f"{self.run_id}:{key}"},
+            {"$set": {"status": STATUS_FAILED, "error": error, "finished_at": datetime.now()}}
+        )
+
+    def record(self, result: Dict, company_id: Any, internal_code_id: Any = None,
+               frequency: Optional[str] = None) -> Dict:
+        """Mark a unit completed or failed from its result dict and return the result"""
+        if result.get("status") in ("success", "warning", "processed"):
+            self.complete(company_id, internal_code_id, frequency)
+        else:
+            self.fail(company_id, internal_code_id, frequency, result.get("error", ""))
+        return result
+
+    def summary(self) -> Dict[str, int]:
+        counts = self.collection.aggregate([
+            {"$match": {"run_id": self.run_id}},
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+        ])
+        return {doc["_id"]: doc["count"] for doc in counts}
@@ -1,14 +1,18 @@
-from pymongo import MongoClient
 from bson import ObjectId
 import os
+import sys
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()  
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import db_connection
+
+# This script reads MONGODB_URI (not the service's MONGODB_URL), with a localhost default
 MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
 DATABASE_NAME = os.getenv('MONGODB_DB_NAME', 'ensogove')
-# Connect to MongoDB
-client = MongoClient(MONGODB_URI)  # Replace with your MongoDB URI
+# Connect to MongoDB through a shared, configured client for that URI
+client = db_connection.get_client(MONGODB_URI)
 db = client[DATABASE_NAME]  # Replace with your database name
 collection = db['company_codes']  # Replace with your collection name
 print("Connected to Mongo DB")
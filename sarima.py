@@ -1,23 +1,102 @@
-import pandas as pd
 import numpy as np
 import logging
-from sktime.forecasting.arima import AutoARIMA
-from sklearn.linear_model import LinearRegression, Ridge, Lasso, ElasticNet, BayesianRidge
-from sklearn.preprocessing import PolynomialFeatures
-from sklearn.metrics import mean_squared_error, mean_absolute_error
-from statsmodels.tsa.ar_model import AutoReg
-from statsmodels.tsa.arima.model import ARIMA
-from statsmodels.tsa.statespace.sarimax import SARIMAX
-from statsmodels.tsa.stattools import acf
-from statsmodels.tsa.seasonal import seasonal_decompose
+import threading
+import time
 import warnings
+
+from forecast_telemetry import ForecastRunReport, record_failed_refit
+import metrics
+from model_selection import REGRESSION_MODELS, TIME_SERIES_MODELS, select_candidates
 warnings.filterwarnings("ignore")  # Suppress all warnings
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# pandas, scikit-learn and statsmodels take seconds to import, so they are loaded on
+# the first forecast rather than when the service (or a pool worker) starts
+_stack_lock = threading.Lock()
+_stack_loaded = False
+
+
+def _load_forecasting_stack():
+    global pd, LinearRegression, Ridge, Lasso, ElasticNet, BayesianRidge, PolynomialFeatures
+    global mean_squared_error, mean_absolute_error, AutoReg, ARIMA, SARIMAX, acf, seasonal_decompose
+    global _stack_loaded
+    if _stack_loaded:
+        return
+    with _stack_lock:
+        if _stack_loaded:
+            return
+        started = time.perf_counter()
+        import pandas as pd
+        from sklearn.linear_model import LinearRegression, Ridge, Lasso, ElasticNet, BayesianRidge
+        from sklearn.preprocessing import PolynomialFeatures
+        from sklearn.metrics import mean_squared_error, mean_absolute_error
+        from statsmodels.tsa.ar_model import AutoReg
+        from statsmodels.tsa.arima.model import ARIMA
+        from statsmodels.tsa.statespace.sarimax import SARIMAX
+        from statsmodels.tsa.stattools import acf
+        from statsmodels.tsa.seasonal import seasonal_decompose
+        # statsmodels installs its own "always" filters on import; keep the fits quiet as before
+        warnings.filterwarnings("ignore")
+        _stack_loaded = True
+        logger.info(f"Forecasting stack loaded in {time.perf_counter() - started:.2f}s")
+
+
+def run_linear_models(pred_array, predictedValue, model_type):
+    """Fit one regression candidate on the point index and forecast predictedValue steps"""
+    _load_forecasting_stack()
+    X = np.arange(len(pred_array)).reshape(-1, 1)
+    y = np.array(pred_array)
+
+    if model_type == 'Linear Regression':
+        model = LinearRegression()
+    elif model_type == 'Ridge Regression':
+        model = Ridge()
+    elif model_type == 'Lasso Regression':
+        model = Lasso()
+    elif model_type == 'Elastic Net Regression':
+        model = ElasticNet()
+    elif model_type == 'Bayesian Regression':
+        model = BayesianRidge()
+    elif model_type == 'Polynomial Regression':
+        poly = PolynomialFeatures(degree=2)
+        X_poly = poly.fit_transform(X)
+        model = LinearRegression()
+        model.fit(X_poly, y)
+        X_future_poly = poly.transform(np.arange(len(pred_array), len(pred_array) + predictedValue).reshape(-1, 1))
+        forecast = model.predict(X_future_poly)
+        return [round(p, 3) for p in forecast]
+
+    model.fit(X, y)
+    X_future = np.arange(len(pred_array), len(pred_array) + predictedValue).reshape(-1, 1)
+    forecast = model.predict(X_future)
+    return [round(p, 3) for p in forecast]
+
+
+def fit_time_series_model(model_type, series, seasonality_period=None, start_params=None):
+    """
+    Fit one statsmodels candidate. start_params (the parameters of an earlier fit
+    of the same model) warm-starts the optimiser; AR is plain OLS and ignores it.
+    """
+    _load_forecasting_stack()
+    fit_kwargs = {} if start_params is None else {'start_params': np.asarray(start_params)}
+    if model_type == 'AR':
+        return AutoReg(series, lags=1).fit()
+    if model_type == 'ARMA':
+        return ARIMA(series, order=(1, 0, 1)).fit(**fit_kwargs)
+    if model_type == 'ARIMA':
+        return ARIMA(series, order=(1, 1, 1)).fit(**fit_kwargs)
+    if model_type == 'SARIMA':
+        return ARIMA(series, seasonal_order=(3, 1, 1, seasonality_period)).fit(**fit_kwargs)
+    if model_type == 'SARIMAX':
+        return SARIMAX(series, order=(3, 1, 1), seasonal_order=(3, 1, 1, 12)).fit(disp=False, **fit_kwargs)
+    raise ValueError(f"{model_type} is not a statsmodels candidate")
+
+
+def run_sarima(pred_array, predictedValue, m=None, model_wins=None):
+    _load_forecasting_stack()
 
-def run_sarima(pred_array, predictedValue, m=None):
     def is_repeating_pattern(series):
         for i in range(1, len(series) // 2 + 1):
             pattern = series[:i]
@@ -57,58 +136,19 @@ def run_sarima(pred_array, predictedValue, m=None):
             print(f"Seasonality detection failed: {e}")
             return None
 
-    def run_linear_models(pred_array, predictedValue, model_type):
-        X = np.arange(len(pred_array)).reshape(-1, 1)
-        y = np.array(pred_array)
-
-        if model_type == 'Linear Regression':
-            model = LinearRegression()
-        elif model_type == 'Ridge Regression':
-            model = Ridge()
-        elif model_type == 'Lasso Regression':
-            model = Lasso()
-        elif model_type == 'Elastic Net Regression':
-            model = ElasticNet()
-        elif model_type == 'Bayesian Regression':
-            model = BayesianRidge()
-        elif model_type == 'Polynomial Regression':
-            poly = PolynomialFeatures(degree=2)
-            X_poly = poly.fit_transform(X)
-            model = LinearRegression()
-            model.fit(X_poly, y)
-            X_future_poly = poly.transform(np.arange(len(pred_array), len(pred_array) + predictedValue).reshape(-1, 1))
-            forecast = model.predict(X_future_poly)
-            return [round(p, 3) for p in forecast]
-
-        model.fit(X, y)
-        X_future = np.arange(len(pred_array), len(pred_array) + predictedValue).reshape(-1, 1)
-        forecast = model.predict(X_future)
-        return [round(p, 3) for p in forecast]
-
     def run_arima_models(series, predictedValue, model_type, seasonality_period=None):
         try:
-            if model_type == 'AR':
-                model = AutoReg(series, lags=1).fit()
+            if model_type == 'SARIMA' and not seasonality_period:
+                failure_reasons[model_type] = "no seasonality detected"
+                return [100] * predictedValue, float('inf'), float('inf')  # Return high score if seasonality is not detected
+            if model_type in ('AR', 'ARMA', 'ARIMA', 'SARIMA', 'SARIMAX'):
+                model = fit_time_series_model(model_type, series, seasonality_period)
+                # Kept so the next forecast of this series can warm-start from them
+                fitted_params[model_type] = np.asarray(model.params).tolist()
                 forecast = model.predict(start=len(series), end=len(series) + predictedValue - 1)
-            elif model_type == 'ARMA':
-                
-                model = ARIMA(series, order=(1, 0, 1)).fit()
-                forecast = model.predict(start=len(series), end=len(series) + predictedValue - 1)
-            elif model_type == 'ARIMA':
-                model = ARIMA(series, order=(1, 1, 1)).fit()
-                forecast = model.predict(start=len(series), end=len(series) + predictedValue - 1)
-            elif model_type == 'SARIMA':
-                if seasonality_period:
-                    model = ARIMA(series, seasonal_order=(3, 1, 1, seasonality_period)).fit()
-                    forecast = model.predict(start=len(series), end=len(series) + predictedValue - 1)
-                else:
-                    return [100] * predictedValue, float('inf'), float('inf')  # Return high score if seasonality is not detected
-            elif model_type == 'SARIMAX':
-                model = SARIMAX(series, order=(3, 1, 1), seasonal_order=(3, 1, 1, 12))
-                sarima_result = model.fit(disp=False)
-                forecast = sarima_result.predict(start=len(series), end=len(series) + predictedValue - 1)
             elif model_type == 'Auto ARIMA':
                 logger.info(f"Auto Arima:, {seasonality_period}")
+                from sktime.forecasting.arima import AutoARIMA  # slowest import of all, only needed here
                 model = AutoARIMA(sp=seasonality_period if seasonality_period else 1)
                 model.fit(series)
                 forecast = model.predict(fh=np.arange(1, predictedValue + 1))
@@ -121,19 +161,25 @@ def run_sarima(pred_array, predictedValue, m=None):
 
         except Exception as e:
             print(f"Model {model_type} failed: {e}")
+            failure_reasons[model_type] = f"{type(e).__name__}: {e}"
             return [100] * predictedValue, float('inf'), float('inf')
 
     model_results = {}
+    failure_reasons = {}
+    fitted_params = {}
     series = pd.Series(pred_array)
+    report = ForecastRunReport(len(pred_array), predictedValue)
 
     # Check for repeating pattern
     if len(set(pred_array)) == 1:
         print("Using pattern repetition as model")
+        report.finish('Pattern Repetition', 'pattern')
         return [pred_array[0]] * predictedValue
 
     pattern = is_repeating_pattern(pred_array)
     if pattern:
         print("Using pattern repetition as model")
+        report.finish('Pattern Repetition', 'pattern')
         return (pattern * ((predictedValue // len(pattern)) + 1))[:predictedValue]
 
     # Detect seasonality only if m is not provided
@@ -141,12 +187,18 @@ def run_sarima(pred_array, predictedValue, m=None):
         seasonality_period = detect_seasonality(series)
     else:
         seasonality_period = m
+    report.seasonality_period = int(seasonality_period) if seasonality_period else None
+
+    # Only fit the models that can work on this series (and, with enough history, that ever won for it)
+    candidates, skipped = select_candidates(pred_array, seasonality_period, model_wins)
+    for model_name, reason in skipped.items():
+        report.skip(model_name, reason)
 
     # Run regression models
-    regression_models = ['Linear Regression', 'Ridge Regression', 'Lasso Regression', 'Elastic Net Regression',
-                         'Bayesian Regression', 'Polynomial Regression']
+    regression_models = [model for model in REGRESSION_MODELS if model in candidates]
 
     for model_name in regression_models:
+        started = time.perf_counter()
         try:
             forecast = run_linear_models(pred_array, predictedValue, model_name)
             rmse = np.sqrt(mean_squared_error(series[-min(len(series), len(forecast)):], forecast[:min(len(series), len(forecast))]))
@@ -161,11 +213,15 @@ def run_sarima(pred_array, predictedValue, m=None):
             print(f"Model: {model_name} | RMSE: {rmse} | MAE: {mae} | Combined Score: {combined_score}")
         except Exception as e:
             model_results[model_name] = {'combined_score': float('inf')}
+            failure_reasons.setdefault(model_name, f"{type(e).__name__}: {e}")
+        report.add_candidate(model_name, time.perf_counter() - started,
+                             model_results[model_name]['combined_score'], failure_reasons.get(model_name))
 
     # Run time series models
-    time_series_models = ['AR', 'ARMA', 'ARIMA', 'SARIMA', 'SARIMAX', 'Auto ARIMA']
+    time_series_models = [model for model in TIME_SERIES_MODELS if model in candidates]
 
     for model_name in time_series_models:
+        started = time.perf_counter()
         try:
             forecast, rmse, mae, combined_score = run_arima_models(series, predictedValue, model_name, seasonality_period)
             model_results[model_name] = {
@@ -177,6 +233,9 @@ def run_sarima(pred_array, predictedValue, m=None):
             print(f"Model: {model_name} | RMSE: {rmse} | MAE: {mae} | Combined Score: {combined_score}")
         except Exception as e:
             model_results[model_name] = {'combined_score': float('inf')}
+            failure_reasons.setdefault(model_name, f"{type(e).__name__}: {e}")
+        report.add_candidate(model_name, time.perf_counter() - started,
+                             model_results[model_name]['combined_score'], failure_reasons.get(model_name))
 
     # Sort models by combined score
     sorted_models = sorted(model_results.items(), key=lambda x: x[1].get('combined_score', float('inf')))
@@ -186,17 +245,61 @@ def run_sarima(pred_array, predictedValue, m=None):
         forecast = best_model_data.get('forecast')
         if forecast and len(set(forecast)) > 1 and all(p > 0 for p in forecast):
             print(f"Using {best_model_name} as the model with the lowest valid combined score")
+            report.finish(best_model_name, 'tournament', params=fitted_params.get(best_model_name))
             return forecast
+        if forecast:
+            report.reject(best_model_name, "flat or non-positive forecast")
 
     # If all models fail, fall back to AR model
     forecast, _, _, _ = run_arima_models(pred_array, predictedValue, 'AR')
     print("All models failed; defaulting to AR model")
+    report.finish('AR', 'fallback', params=fitted_params.get('AR'))
     return forecast
 
 
-# Example usage
-series = [11,29,29,6,22,23]
+def refit_sarima(pred_array, model, predictedValue, m=None, model_wins=None):
+    """
+    Warm-started forecast: refit only the series' stored winning model
+    ({'name', 'params', 'seasonality_period'}), starting the optimiser from its
+    previous params, instead of running the whole tournament. Falls back to
+    run_sarima when the refit fails or its forecast is not usable.
+    """
+    _load_forecasting_stack()
+    model_name = model['name']
+    report = ForecastRunReport(len(pred_array), predictedValue)
+    report.seasonality_period = model.get('seasonality_period')
+    started = time.perf_counter()
+    forecast, params, error = None, None, None
+    try:
+        if model_name in REGRESSION_MODELS:
+            forecast = run_linear_models(pred_array, predictedValue, model_name)
+        else:
+            series = pd.Series(pred_array)
+            fitted = fit_time_series_model(model_name, series, model.get('seasonality_period'), model.get('params'))
+            params = np.asarray(fitted.params).tolist()
+            forecast = [round(p, 3) for p in fitted.predict(start=len(series), end=len(series) + predictedValue - 1)]
+    except Exception as e:
+        error = str(e) or type(e).__name__
+        logger.warning(f"Warm refit of {model_name} failed: {e}")
+
+    if forecast and len(set(forecast)) > 1 and all(p > 0 for p in forecast):
+        report.add_candidate(model_name, time.perf_counter() - started)
+        report.finish(model_name, 'warm_start', params=params)
+        metrics.inc("forecast_warm_starts_total", outcome="refit")
+        return forecast
+
+    duration = time.perf_counter() - started
+    logger.info(f"Warm refit of {model_name} not usable, running the full tournament")
+    metrics.inc("forecast_warm_starts_total", outcome="fallback")
+    predictions = run_sarima(pred_array, predictedValue, m=m, model_wins=model_wins)
+    record_failed_refit(model_name, duration, error or "flat or non-positive forecast")
+    return predictions
+
+
+if __name__ == "__main__":
+    # Example usage
+    series = [11,29,29,6,22,23]
 
-predictions = run_sarima(series, predictedValue=35)
+    predictions = run_sarima(series, predictedValue=35)
 
-print("Predictions:", predictions)
+    print("Predictions:", predictions)
@@ -131,11 +131,12 @@ def run_sarima(pred_array, predictedValue=11, m=None):
     print("All models failed.")
     return None
 
-# Example usage
-series = [29, 29, 6, 22, 23]
-predictions = run_sarima(series, predictedValue=3)
-if predictions is not None:
-    print("Predictions:", predictions)
-else:
-    print("No valid predictions generated.")
+if __name__ == "__main__":
+    # Example usage
+    series = [29, 29, 6, 22, 23]
+    predictions = run_sarima(series, predictedValue=3)
+    if predictions is not None:
+        print("Predictions:", predictions)
+    else:
+        print("No valid predictions generated.")
 
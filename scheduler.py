@@ -0,0 +1,157 @@
+"""
+Process-pool scheduler for all-company aggregation runs.
+
+Companies are weighted by their expected cost (unaggregated records x sites x
+reporting frequencies) and submitted largest-first to a pool of worker
+processes, so the CPU-bound forecasting and pandas work of different companies
+runs on different cores instead of sharing one GIL. Each worker builds its own
+CompanyDataController (and Mongo client) and returns the same per-company
+result dict that CompanyDataController._process_single_company returns.
+"""
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+import RegionAPI
+import concurrency
+import db_connection
+import metrics
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# spawn is the safe default: the parent holds Mongo monitor and HTTP pool threads
+SCHEDULER_START_METHOD = os.getenv("SCHEDULER_START_METHOD", "spawn")
+
+_worker_controller = None
+
+
+def _init_worker(workers: int, incremental: bool, run_id: Optional[str], lease_epoch: str) -> None:
+    """Per-process initializer: fresh Mongo client, controller and a share of the CPU executor"""
+    global _worker_controller
+    from main import CompanyDataController
+
+    db_connection._connection = None
+    concurrency.configure(cpu_workers=max(1, (os.cpu_count() or 1) // workers))
+    # Workers run companies one at a time; parallelism comes from the pool itself
+    _worker_controller = CompanyDataController(workers=1, incremental=incremental, run_id=run_id,
+                                               lease_epoch=lease_epoch)
+
+
+def _process_company_in_worker(company: Dict, year: int, company_details: Optional[Dict]) -> Dict:
+    """Run one company inside a worker process"""
+    if company_details:
+        # Start month resolved by the parent (prefetch), no need to ask the API again
+        RegionAPI.prime_company_details(company['id'], company_details)
+    return _worker_controller._process_company_unit(company, year)
+
+
+class CompanyScheduler:
+    """Distribute companies across a process pool, largest expected cost first"""
+
+    def __init__(self, workers: int, progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+                 incremental: bool = False, run_id: Optional[str] = None, lease_epoch: str = ""):
+        self.workers = workers
+        self.incremental = incremental
+        self.run_id = run_id
+        # The parent's work lease epoch ("" = no leases), so the workers do not derive their own
+        self.lease_epoch = lease_epoch
+        self.progress_callback = progress_callback
+        self.progress: Dict[str, Any] = {}
+
+    @staticmethod
+    def estimate_cost(company: Dict, unaggregated_records: int) -> int:
+        """Expected cost of a company: unaggregated records x sites x frequencies"""
+        sites = len([s for s in company.get('company_sites', []) if s.get('internal_site_code')]) + 1
+        frequencies = len([f for f in (company.get('reporting_frequency') or '').split(',') if f.strip()]) or 1
+        return unaggregated_records * sites * frequencies
+
+    def plan(self, companies: List[Dict], cdata_collection) -> List[Dict]:
+        """Return work units (companies with pending records), heaviest first"""
+        units = []
+        for index, company in enumerate(companies):
+            pending = cdata_collection.count_documents({"company_code": str(company['id']), "is_aggregated": False})
+            if pending:
+                units.append({
+                    "index": index,
+                    "company": company,
+                    "records": pending,
+                    "cost": self.estimate_cost(company, pending)
+                })
+            else:
+                logger.info(f"Company {company.get('id')} has no records to process, skipping")
+        units.sort(key=lambda unit: unit["cost"], reverse=True)
+        return units
+
+    def run(self, companies: List[Dict], year: int, cdata_collection) -> List[Dict]:
+        """Process companies in the pool and return results in the input order"""
+        units = self.plan(companies, cdata_collection)
+        if not units:
+            return []
+
+        total_cost = sum(unit["cost"] for unit in units) or 1
+        self.progress = {
+            "total_units": len(units),
+            "completed_units": 0,
+            "total_cost": total_cost,
+            "completed_cost": 0,
+            "started_at": time.time(),
+        }
+        logger.info(f"Scheduling {len(units)} companies on {self.workers} processes (total cost {total_cost})")
+
+        results = {}
+        context = multiprocessing.get_context(SCHEDULER_START_METHOD)
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(self.workers, self.incremental, self.run_id, self.lease_epoch)) as executor:
+            futures = {
+                executor.submit(
+                    metrics.call_and_collect,
+                    _process_company_in_worker,
+                    unit["company"],
+                    year,
+                    RegionAPI.fetch_company_details(unit["company"]['id'])
+                ): unit
+                for unit in units
+            }
+
+            for future in as_completed(futures):
+                unit = futures[future]
+                company = unit["company"]
+                try:
+                    result, delta = future.result()
+                    metrics.merge(delta)
+                    if result is not None:  # None: leased by another replica
+                        results[unit["index"]] = result
+                except Exception as e:
+                    logger.error(f"Error processing company {company.get('id', 'unknown')} in worker: {str(e)}")
+                    results[unit["index"]] = {
+                        "company_id": company.get('id', 'unknown'),
+                        "company_name": company.get('name', 'Unknown'),
+                        "status": "error",
+                        "error": str(e),
+                        "traceback": traceback.format_exc()
+                    }
+                self._record_progress(unit)
+
+        return [results[index] for index in sorted(results)]
+
+    def _record_progress(self, unit: Dict) -> None:
+        progress = self.progress
+        progress["completed_units"] += 1
+        progress["completed_cost"] += unit["cost"]
+        elapsed = time.time() - progress["started_at"]
+        fraction = progress["completed_cost"] / progress["total_cost"]
+        progress["eta_seconds"] = elapsed / fraction - elapsed if fraction else None
+
+        eta = f"{progress['eta_seconds']:.0f}s" if progress["eta_seconds"] is not None else "unknown"
+        logger.info(f"Company {unit['company'].get('id')} done: {progress['completed_units']}/{progress['total_units']} "
+                    f"companies, {fraction:.0%} of estimated cost, ETA {eta}")
+        if self.progress_callback:
+            self.progress_callback(dict(progress))
@@ -0,0 +1,224 @@
+"""
+Typed numeric schema for type_year, qty and value.
+
+cdata arrives with type_year as a string (so year filters compare
+lexicographically) and qty / value as strings or numbers; the aggregates
+store qty as str(total). NUMERIC_SCHEMA moves this to numbers in three steps:
+
+- off:  legacy behaviour, string writes and string year filters
+- dual: aggregates store qty / value as numbers, reads accept both
+        representations (run this while the migration below is in progress,
+        and for as long as the upstream API keeps writing strings into cdata)
+- on:   numbers only; year filters are plain numeric ranges
+
+The migration converts the fields server-side in _id-ordered batches, keeps
+values that do not parse as they are, and can be re-run at any time:
+
+    python schema_migration.py --dry-run
+    python schema_migration.py --batch-size 2000 --create-indexes
+    python schema_migration.py --verify
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+from typing import Any, Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+from pymongo import ASCENDING
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_MODES = ("off", "dual", "on")
+NUMERIC_SCHEMA = os.getenv("NUMERIC_SCHEMA", "off").lower()
+if NUMERIC_SCHEMA not in SCHEMA_MODES:
+    logger.warning(f"Unknown NUMERIC_SCHEMA {NUMERIC_SCHEMA!r}, using 'off'")
+    NUMERIC_SCHEMA = "off"
+
+MIGRATION_BATCH_SIZE = int(os.getenv("SCHEMA_MIGRATION_BATCH_SIZE", "1000"))
+
+# Field -> target BSON type
+NUMERIC_FIELDS = {"type_year": "int", "qty": "double", "value": "double"}
+MIGRATED_COLLECTIONS = ["cdata", "cdata_month", "cdata_quarter", "cdata_bi_annual", "cdata_yearly"]
+
+
+def to_number(value: Any) -> Optional[float]:
+    """Number stored natively or as a plain numeric string, otherwise None"""
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return None if isinstance(value, float) and math.isnan(value) else float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.strip().replace(",", ""))
+        except ValueError:
+            return None
+    return None
+
+
+def read_number(value: Any, legacy_parse: Callable[[Any], Any]) -> Any:
+    """Use numbers stored natively as they are; strings go through the caller's legacy parser"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return legacy_parse(value)
+
+
+def stored_qty(qty: Any) -> Any:
+    """qty as written to the aggregates: str(qty) in legacy mode, a number where it parses"""
+    if NUMERIC_SCHEMA == "off":
+        return str(qty)
+    number = to_number(qty)
+    return number if number is not None else str(qty)
+
+
+def stored_value(value: Any) -> Any:
+    """value as written to the aggregates: unchanged in legacy mode, a number where it parses"""
+    if NUMERIC_SCHEMA == "off":
+        return value
+    number = to_number(value)
+    return number if number is not None else value
+
+
+def type_year_match(year: Any) -> Any:
+    """Equality filter value for cdata.type_year"""
+    if NUMERIC_SCHEMA == "off":
+        return str(year)
+    if NUMERIC_SCHEMA == "on":
+        return int(year)
+    return {"$in": [int(year), str(year)]}
+
+
+def type_year_since(min_year: Any) -> Dict[str, Any]:
+    """Filter fragment for cdata rows with type_year >= min_year"""
+    if NUMERIC_SCHEMA == "off":
+        # Lexicographic, as before; equivalent for four-digit years
+        return {"type_year": {"$gte": str(min_year)}}
+    if NUMERIC_SCHEMA == "on":
+        return {"type_year": {"$gte": int(min_year)}}
+    # Range operators only match values of the same type, so query both representations
+    return {"$or": [{"type_year": {"$gte": int(min_year)}}, {"type_year": {"$gte": str(min_year)}}]}
+
+
+def _type_year_order_filters() -> List[Dict[str, Any]]:
+    """type_year filters whose first value in index order is the earliest year, one per representation"""
+    if NUMERIC_SCHEMA == "off":
+        # The order $min used; like $min, skip rows without a year
+        return [{"type_year": {"$ne": None}}]
+    if NUMERIC_SCHEMA == "on":
+        return [{"type_year": {"$type": "number"}}]
+    # BSON orders every number before every string, so look at both; only strings starting with a digit
+    return [{"type_year": {"$type": "number"}}, {"type_year": {"$gte": "0", "$lt": ":"}}]
+
+
+def earliest_type_year(collection, query: Dict[str, Any]) -> Any:
+    """Earliest type_year of the rows matching query (None if there are none), by index-backed sort / limit"""
+    years = []
+    for year_filter in _type_year_order_filters():
+        doc = collection.find_one({**query, **year_filter}, {"type_year": 1}, sort=[("type_year", ASCENDING)])
+        if doc is not None:
+            years.append(doc["type_year"])
+    if NUMERIC_SCHEMA == "off":
+        return years[0] if years else None
+    numbers = [int(number) for number in map(to_number, years) if number is not None]
+    return min(numbers) if numbers else None
+
+
+def _string_filter(fields: List[str]) -> Dict[str, Any]:
+    return {"$or": [{field: {"$type": "string"}} for field in fields]}
+
+
+def _conversion(fields: List[str]) -> List[Dict[str, Any]]:
+    """Update pipeline converting string fields; values that do not parse are left untouched"""
+    converted = {}
+    for field in fields:
+        converted[field] = {
+            "$cond": [
+                {"$eq": [{"$type": f"${field}"}, "string"]},
+                {"$convert": {"input": {"$trim": {"input": f"${field}"}}, "to": NUMERIC_FIELDS[field],
+                              "onError": f"${field}", "onNull": f"${field}"}},
+                f"${field}",
+            ]
+        }
+    return [{"$set": converted}]
+
+
+def migrate_collection(collection, fields: Optional[List[str]] = None, batch_size: int = MIGRATION_BATCH_SIZE,
+                       dry_run: bool = False) -> Dict[str, Any]:
+    """Convert the string-typed numeric fields of one collection; returns counts"""
+    fields = fields or list(NUMERIC_FIELDS)
+    pending = collection.count_documents(_string_filter(fields))
+    result = {"collection": collection.name, "pending": pending, "modified": 0, "batches": 0}
+    if dry_run or not pending:
+        return result
+
+    last_id = None
+    while True:
+        # Walk by _id so rows whose values never parse are visited once
+        batch_filter = _string_filter(fields)
+        if last_id is not None:
+            batch_filter = {"$and": [batch_filter, {"_id": {"$gt": last_id}}]}
+        ids = [doc["_id"] for doc in collection.find(batch_filter, {"_id": 1}).sort("_id", ASCENDING).limit(batch_size)]
+        if not ids:
+            break
+        update = collection.update_many({"_id": {"$in": ids}}, _conversion(fields))
+        result["modified"] += update.modified_count
+        result["batches"] += 1
+        last_id = ids[-1]
+        logger.info(f"{collection.name}: converted {result['modified']}/{pending}")
+    return result
+
+
+def verify(db, collections: Optional[List[str]] = None, samples: int = 5) -> Dict[str, Any]:
+    """Remaining string-typed values per collection and field, with examples"""
+    report = {}
+    for name in collections or MIGRATED_COLLECTIONS:
+        report[name] = {}
+        for field in NUMERIC_FIELDS:
+            query = {field: {"$type": "string"}}
+            remaining = db[name].count_documents(query)
+            report[name][field] = {
+                "strings": remaining,
+                "examples": [doc.get(field) for doc in db[name].find(query, {field: 1}).limit(samples)] if remaining else [],
+            }
+    return report
+
+
+def ensure_indexes(db) -> List[str]:
+    """Range index for the processors' cdata reads (company, code, site, type_year >= ...)"""
+    return [db["cdata"].create_index(
+        [("company_code", ASCENDING), ("internal_code_id", ASCENDING), ("site_code", ASCENDING), ("type_year", ASCENDING)],
+        name="cdata_company_code_site_year"
+    )]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Convert type_year / qty / value to numbers')
+    parser.add_argument('--collections', default=','.join(MIGRATED_COLLECTIONS))
+    parser.add_argument('--batch-size', type=int, default=MIGRATION_BATCH_SIZE)
+    parser.add_argument('--dry-run', action='store_true', help='Only count documents that need converting')
+    parser.add_argument('--verify', action='store_true', help='Report values that are still strings')
+    parser.add_argument('--create-indexes', action='store_true', help='Create the cdata type_year range index')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    import db_connection
+    db = db_connection.connect_to_database("durable")
+    collections = args.collections.split(',')
+
+    if args.verify:
+        print(json.dumps(verify(db, collections), indent=2, default=str))
+        return 0
+
+    results = [migrate_collection(db[name], batch_size=args.batch_size, dry_run=args.dry_run) for name in collections]
+    if args.create_indexes and not args.dry_run:
+        logger.info(f"Created indexes: {ensure_indexes(db)}")
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
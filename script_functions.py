@@ -1,7 +1,6 @@
 import requests
 import logging
 import sys
-import pymongo
 import os
 from dotenv import load_dotenv
 from json.decoder import JSONDecodeError
@@ -9,6 +8,8 @@ from sarima import run_sarima
 from datetime import datetime
 from calendar import month_name
 from bson import ObjectId  # Add this import
+from code_catalog import get_code_catalog
+import db_connection
 
 
 
@@ -19,12 +20,10 @@ logger = logging.getLogger(__name__)
 # Load environment variables from .env file
 load_dotenv()
 
-# Define MongoDB URL from environment variables
-MONGODB_URL = os.getenv("MONGODB_URL", "")
-
-# Establish database connection
+# Establish database connection: a shared client, not a new one per call; this script
+# has always waited up to 30 s for server selection and connect
 def connect_to_database():
-    return pymongo.MongoClient(MONGODB_URL, connectTimeoutMS=30000, socketTimeoutMS=None, serverSelectionTimeoutMS=30000)
+    return db_connection.get_client(serverSelectionTimeoutMS=30000, connectTimeoutMS=30000)
 
 MONTHS = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
 
@@ -64,18 +63,13 @@ def get_internal_code_ids(company_code):
     return data
 
 def connect_to_databaseOne():
-    return pymongo.MongoClient(MONGODB_URL)
+    return db_connection.get_client()
 
 
 def get_code_data(internal_code_id):
-    client = connect_to_database()
-    db_name = os.getenv("MONGODB_DB_NAME")
-    db = client[db_name]
-    codes_collection = db["codes"]
-    
     try:
         internal_code_id = ObjectId(internal_code_id)  # Convert internal_code_id to ObjectId
-        code_data = codes_collection.find_one({"_id": internal_code_id})
+        code_data = get_code_catalog().get(internal_code_id)
         
         if code_data:
             return code_data.get("name", ""), code_data.get("code", "")
@@ -1,8 +1,9 @@
 from sktime.forecasting.arima import AutoARIMA
 import numpy as np
 
-y = np.random.rand(100)
-model = AutoARIMA(sp=12)
-model.fit(y)
-predictions = model.predict(fh=np.arange(1, 11))
-print(predictions)
+if __name__ == "__main__":
+    y = np.random.rand(100)
+    model = AutoARIMA(sp=12)
+    model.fit(y)
+    predictions = model.predict(fh=np.arange(1, 11))
+    print(predictions)
@@ -0,0 +1,172 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+import RegionAPI
+from RegionAPI import APIClient, CircuitBreaker, TTLCache
+
+
+@pytest.fixture(autouse=True)
+def fresh_breakers():
+    RegionAPI._circuit_breakers.clear()
+    yield
+    RegionAPI._circuit_breakers.clear()
+
+
+def _open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    assert breaker.state == "open"
+    # Let the reset timeout pass
+    breaker.opened_at -= breaker.reset_timeout
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("test", failure_threshold=3, min_requests=100)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+    assert breaker.snapshot()["rejected"] == 1
+
+
+def test_breaker_opens_on_window_error_rate():
+    breaker = CircuitBreaker("test", failure_threshold=100, error_rate=0.5, min_requests=4)
+    for _ in range(2):
+        breaker.record_success()
+        breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_half_open_trial_closes_or_reopens():
+    breaker = CircuitBreaker("test", failure_threshold=1)
+    _open_breaker(breaker)
+    assert breaker.allow_request()
+    assert breaker.state == "half_open"
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+    _open_breaker(breaker)
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+
+
+def test_unexpected_error_in_half_open_trial_reopens_breaker():
+    client = APIClient("http://upstream.test")
+    breaker = RegionAPI.get_circuit_breaker("/company/data/{id}")
+    _open_breaker(breaker)
+
+    with mock.patch.object(client.session, "get", side_effect=ValueError("bad payload")):
+        assert client.get("/company/data/7") is None
+
+    assert breaker.state == "open"
+    assert breaker.snapshot()["failures"] == breaker.failure_threshold + 1
+
+
+def _age(cache, key, seconds):
+    stored_at, value = cache._entries[key]
+    cache._entries[key] = (stored_at - seconds, value)
+
+
+def test_cache_loads_once_while_fresh():
+    cache = TTLCache("test", ttl=60, stale_ttl=60)
+    loader = mock.Mock(return_value={"id": 1})
+    assert cache.get(1, loader) == {"id": 1}
+    assert cache.get("1", loader) == {"id": 1}
+    assert loader.call_count == 1
+    assert cache.is_fresh(1)
+
+
+def test_stale_entry_is_served_while_refreshing_in_background():
+    cache = TTLCache("test", ttl=60, stale_ttl=600)
+    cache.set("k", "old")
+    _age(cache, "k", 120)
+    refreshed = threading.Event()
+
+    def loader():
+        refreshed.set()
+        return "new"
+
+    assert cache.get("k", loader) == "old"
+    assert refreshed.wait(2)
+    for _ in range(100):
+        if cache.peek("k") == "new":
+            break
+        time.sleep(0.01)
+    assert cache.peek("k") == "new"
+
+
+def test_expired_entry_is_reloaded_and_kept_when_the_loader_fails():
+    cache = TTLCache("test", ttl=60, stale_ttl=60)
+    cache.set("k", "old")
+    _age(cache, "k", 600)
+    assert cache.get("k", lambda: None) == "old"
+    assert cache.get("k", lambda: "new") == "new"
+    assert cache.get("missing", lambda: None) is None
+
+
+def test_cache_persists_to_disk(tmp_path):
+    cache = TTLCache("test", ttl=60, stale_ttl=60, persist_dir=str(tmp_path))
+    cache.set("k", {"name": "Acme"})
+    cache.flush()
+    reloaded = TTLCache("test", ttl=60, stale_ttl=60, persist_dir=str(tmp_path))
+    assert reloaded.peek("k") == {"name": "Acme"}
+    reloaded.invalidate("k")
+    reloaded.flush()
+    assert TTLCache("test", ttl=60, stale_ttl=60, persist_dir=str(tmp_path)).peek("k") is None
+
+
+def test_cache_writes_are_debounced(tmp_path):
+    cache = TTLCache("test", ttl=60, stale_ttl=60, persist_dir=str(tmp_path), persist_delay=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert not (tmp_path / "test.json").exists()
+    cache.flush()
+    assert TTLCache("test", ttl=60, stale_ttl=60, persist_dir=str(tmp_path)).peek("b") == 2
+
+
+def test_key_locks_are_dropped_after_loading():
+    cache = TTLCache("test", ttl=60, stale_ttl=60)
+    for key in range(100):
+        cache.get(key, lambda: "value")
+    assert cache._key_locks == {}
+
+
+def test_unknown_company_reloads_the_list_once(monkeypatch):
+    cache = TTLCache("company_list", ttl=600, stale_ttl=600)
+    cache.set("all", [{"id": 1}])
+    monkeypatch.setattr(RegionAPI, "_company_list_cache", cache)
+    loader = mock.Mock(return_value=[{"id": 1}, {"id": 2}])
+    monkeypatch.setattr(RegionAPI, "_load_all_company", loader)
+
+    assert RegionAPI.get_company_by_id(1) == {"id": 1}
+    assert loader.call_count == 0
+    _age(cache, "all", RegionAPI.COMPANY_MISS_RELOAD_SECONDS)
+    assert RegionAPI.get_company_by_id(2) == {"id": 2}
+    assert RegionAPI.get_company_by_id(3) is None
+    assert loader.call_count == 1
+
+
+def test_released_trial_lets_the_next_request_retry():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=60)
+    _open_breaker(breaker)
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    breaker.release_trial()
+    assert breaker.state == "open"
+    assert breaker.allow_request()
+
+
+def test_stale_entry_is_reloaded_when_stale_is_not_allowed():
+    cache = TTLCache("test", ttl=60, stale_ttl=600)
+    cache.set("k", "old")
+    _age(cache, "k", 120)
+    assert cache.get("k", lambda: "new", allow_stale=False) == "new"
+    _age(cache, "k", 120)
+    assert cache.get("k", lambda: None, allow_stale=False) == "new"
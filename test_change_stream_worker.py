@@ -0,0 +1,198 @@
+import os
+import subprocess
+import sys
+import uuid
+
+import mongomock
+import pytest
+
+import change_stream_worker
+from change_stream_worker import CHANGE_STREAM_NAME, ChangeCoalescer, ChangeStreamWorker
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+KEY_A = ("9001", "code-a", "")
+KEY_B = ("9001", "code-b", "S1")
+
+
+def test_due_waits_for_the_debounce_period():
+    coalescer = ChangeCoalescer(debounce=2, max_wait=30)
+    coalescer.add(KEY_A, "t1", now=0)
+    coalescer.add(KEY_A, "t2", now=1)
+    assert coalescer.due(now=2) == {}
+    ready = coalescer.due(now=3)
+    assert list(ready) == [KEY_A]
+    assert ready[KEY_A]["changes"] == 2
+    assert coalescer.pending == {}
+
+
+def test_due_releases_a_busy_key_after_max_wait():
+    coalescer = ChangeCoalescer(debounce=2, max_wait=5)
+    for second in range(6):
+        coalescer.add(KEY_A, f"t{second}", now=second)
+    assert list(coalescer.due(now=5)) == [KEY_A]
+
+
+def test_checkpoint_stops_before_the_oldest_pending_change():
+    coalescer = ChangeCoalescer(debounce=2, max_wait=30)
+    coalescer.add(KEY_A, "t1", now=0)
+    coalescer.add(KEY_B, "t2", now=1)
+    coalescer.add(KEY_A, "t3", now=0.5)
+    assert coalescer.checkpoint_token() is None
+
+    coalescer.due(now=2.5)  # only KEY_A is quiet
+    assert list(coalescer.pending) == [KEY_B]
+    assert coalescer.checkpoint_token() == "t1"
+    coalescer.due(now=10)
+    assert coalescer.checkpoint_token() == "t3"
+    assert coalescer.checkpoint_token() is None
+
+
+def test_retried_key_holds_the_checkpoint_until_its_next_attempt():
+    coalescer = ChangeCoalescer(debounce=0, max_wait=30, retry_delay=10)
+    coalescer.add(KEY_A, "t1", now=0)
+    coalescer.add(KEY_B, "t2", now=0)
+    ready = coalescer.due(now=1)
+    coalescer.retry(KEY_A, ready[KEY_A], now=1)
+    assert coalescer.checkpoint_token() is None
+    assert coalescer.due(now=5) == {}
+    assert coalescer.due(now=11)[KEY_A]["attempts"] == 1
+    assert coalescer.checkpoint_token() == "t2"
+
+
+def _worker(process_key):
+    db = mongomock.MongoClient().db
+    worker = ChangeStreamWorker.__new__(ChangeStreamWorker)
+    worker.checkpoints = db.change_stream_checkpoints
+    worker.failures = db.change_stream_failures
+    worker.coalescer = ChangeCoalescer(debounce=0, max_wait=30, retry_delay=10)
+    worker.process_key = process_key
+    return worker
+
+
+def test_flush_does_not_checkpoint_past_a_failed_key():
+    def process_key(key, entry):
+        if key == KEY_A:
+            raise RuntimeError("upstream down")
+
+    worker = _worker(process_key)
+    worker.coalescer.add(KEY_A, "t1", now=0)
+    worker.coalescer.add(KEY_B, "t2", now=0)
+    assert worker.flush(now=1) == 2
+    assert worker.load_resume_token() is None
+    assert KEY_A in worker.coalescer.pending
+
+
+def test_flush_holds_keys_whose_company_is_not_found_and_gives_up_eventually(monkeypatch):
+    monkeypatch.setattr(change_stream_worker, "CHANGE_STREAM_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(change_stream_worker, "get_company_by_id", lambda company_id: None)
+    worker = _worker(None)
+    worker.process_key = ChangeStreamWorker.process_key.__get__(worker)
+    worker.coalescer.add(KEY_A, "t1", now=0)
+    worker.flush(now=1)
+    assert worker.load_resume_token() is None
+
+    worker.flush(now=100)
+    assert worker.coalescer.pending == {}
+    assert worker.load_resume_token() == "t1"
+    failure = worker.failures.find_one({"_id": ":".join(KEY_A)})
+    assert failure["attempts"] == 2
+    assert failure["error"] == "company 9001 not found"
+
+
+COMPANY = {"id": 9001, "reporting_frequency": "month", "company_sites": [{"internal_site_code": "S1"}]}
+
+
+@pytest.fixture
+def aggregating_worker(monkeypatch):
+    """Worker whose controller runs the real process_company_code on mongomock"""
+    db = mongomock.MongoClient().db
+    monkeypatch.setattr(change_stream_worker.db_connection, "connect_to_database", lambda *args, **kwargs: db)
+    monkeypatch.setattr(change_stream_worker, "get_company_by_id", lambda company_id: COMPANY)
+    monkeypatch.setattr(change_stream_worker.main, "fetch_company_data", lambda company_id: ["January"])
+    monkeypatch.setattr(change_stream_worker.main, "delete_monthly_data", lambda *args, **kwargs: None)
+    worker = ChangeStreamWorker(coalescer=ChangeCoalescer(debounce=0, max_wait=30, retry_delay=10), rollup=False)
+    return worker
+
+
+def test_processor_error_keeps_the_key_and_the_token(aggregating_worker, monkeypatch):
+    def failing_processor(*args, **kwargs):
+        raise RuntimeError("processor crashed")
+
+    monkeypatch.setattr(change_stream_worker.main, "process_monthly_data", failing_processor)
+    aggregating_worker.coalescer.add(KEY_A, "t1", now=0)
+    aggregating_worker.flush(now=1)
+
+    assert aggregating_worker.load_resume_token() is None
+    assert aggregating_worker.coalescer.pending[KEY_A]["attempts"] == 1
+
+
+def test_processed_key_advances_the_token(aggregating_worker, monkeypatch):
+    calls = []
+    monkeypatch.setattr(change_stream_worker.main, "process_monthly_data", lambda *args, **kwargs: calls.append(args))
+    aggregating_worker.coalescer.add(KEY_B, "t1", now=0)
+    aggregating_worker.flush(now=1)
+
+    assert calls
+    assert aggregating_worker.load_resume_token() == "t1"
+    assert aggregating_worker.coalescer.pending == {}
+
+
+def test_unknown_site_is_not_reported_as_processed(aggregating_worker, monkeypatch):
+    monkeypatch.setattr(change_stream_worker.main, "process_monthly_data", lambda *args, **kwargs: None)
+    aggregating_worker.coalescer.add(("9001", "code-a", "S9"), "t1", now=0)
+    aggregating_worker.flush(now=1)
+
+    assert aggregating_worker.load_resume_token() is None
+    assert aggregating_worker.coalescer.pending
+
+
+def _replica_set_url():
+    url = os.getenv("CHANGE_STREAM_TEST_MONGODB_URL") or os.getenv("MONGODB_URL")
+    if not url:
+        return None
+    from pymongo import MongoClient
+    try:
+        hello = MongoClient(url, serverSelectionTimeoutMS=2000).admin.command("hello")
+    except Exception:
+        return None
+    return url if hello.get("setName") else None
+
+
+def test_worker_aggregates_changes_and_saves_the_resume_token():
+    url = _replica_set_url()
+    if url is None:
+        pytest.skip("needs a replica set (CHANGE_STREAM_TEST_MONGODB_URL)")
+    from pymongo import MongoClient
+    sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+    from stub_api import StubCompanyAPI
+    from synthetic_data import generate_dataset
+
+    client = MongoClient(url)
+    db_name = f"change_stream_test_{uuid.uuid4().hex[:8]}"
+    db = client[db_name]
+    try:
+        # Start the worker from a token taken before the rows are inserted
+        with db.cdata.watch() as stream:
+            stream.try_next()
+            start_token = stream.resume_token
+        db.change_stream_checkpoints.insert_one({"_id": CHANGE_STREAM_NAME, "resume_token": start_token})
+        manifest = generate_dataset(db, companies=1, codes=2, sites=1, years=1, seed=7)
+
+        with StubCompanyAPI(manifest) as base_url:
+            env = dict(os.environ, MONGODB_URL=url, MONGODB_DB_NAME=db_name, COMPANY_DATA_URL=base_url,
+                       SITE_DATA_URL=base_url, COMPANY_CACHE_DIR="", WORK_LEASES_ENABLED="false",
+                       CHANGE_STREAM_DEBOUNCE_SECONDS="0.5")
+            proc = subprocess.run(
+                [sys.executable, os.path.join(ROOT, "change_stream_worker.py"), "--no-rollup", "--idle-exit", "5"],
+                env=env, cwd=ROOT, capture_output=True, text=True, timeout=600
+            )
+        assert proc.returncode == 0, proc.stderr[-3000:]
+
+        aggregates = sum(db[name].count_documents({})
+                         for name in ("cdata_month", "cdata_quarter", "cdata_bi_annual", "cdata_yearly"))
+        assert aggregates > 0
+        checkpoint = db.change_stream_checkpoints.find_one({"_id": CHANGE_STREAM_NAME})
+        assert checkpoint["resume_token"] != start_token
+        assert db.change_stream_failures.count_documents({}) == 0
+    finally:
+        client.drop_database(db_name)
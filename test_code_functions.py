@@ -0,0 +1,64 @@
+import uuid
+
+import mongomock
+import pytest
+from bson import ObjectId
+
+import data_quarterly_process
+import db_connection
+import metrics
+
+CODE_ID = ObjectId()
+
+
+@pytest.fixture
+def database(monkeypatch):
+    # A fresh database name per test, so the per-database code catalog and min-year caches start empty
+    database = mongomock.MongoClient()[f"aggregation_{uuid.uuid4().hex}"]
+    monkeypatch.setattr(db_connection, "connect_to_database", lambda *args, **kwargs: database)
+    monkeypatch.setattr(data_quarterly_process, "forecast_series", lambda *args, **kwargs: [])
+    # Already aggregated, so this call reads no dirty cdata rows and only rebuilds the derived levels
+    database.cdata.insert_one({"company_code": "9001", "internal_code_id": CODE_ID, "type": "actual",
+                               "site_code": "S1", "quarter": "Q1", "type_year": "2024", "qty": "1",
+                               "is_aggregated": True})
+    for number, qty in enumerate([10, 20, 30, 40], start=1):
+        database.cdata_quarter.insert_one({
+            "company_code": "9001", "quarter": f"Q{number}", "type_year": 2024, "reporting_year": 2024,
+            "qty": str(qty), "value": qty, "site_code": "S1", "internal_code_id": CODE_ID,
+            "code_name": "Energy", "code": "E1", "currency": "", "dimension": [], "unit": "",
+            "description": "", "is_forecast": False,
+        })
+    return database
+
+
+def _derive(database, function):
+    database.codes.insert_one({"_id": CODE_ID, "code": "E1", "name": "Energy", "function": function})
+    data_quarterly_process.process_quarterly_data("9001", str(CODE_ID), 2024, "January", "S1")
+    yearly = list(database.cdata_yearly.find({"is_forecast": False}))
+    semesters = list(database.cdata_bi_annual.find({"is_forecast": False}, sort=[("quarter", 1)]))
+    return yearly, semesters
+
+
+def test_list_codes_keep_the_last_period(database):
+    yearly, semesters = _derive(database, "list")
+    assert [row["qty"] for row in yearly] == ["40"]
+    assert [row["qty"] for row in semesters] == ["20", "40"]
+
+
+def test_average_codes(database):
+    yearly, semesters = _derive(database, "average")
+    assert [row["qty"] for row in yearly] == ["100"]
+    assert [row["qty"] for row in semesters] == ["30", "70"]
+
+
+def test_derived_rows_resolve_codes_without_dirty_rows(database):
+    yearly, semesters = _derive(database, "sum")
+    assert [row["qty"] for row in yearly] == ["100"]
+    assert {(row["code"], row["code_name"]) for row in yearly + semesters} == {("E1", "Energy")}
+
+
+def test_aggregate_writes_are_timed(database):
+    before = metrics.snapshot()
+    _derive(database, "sum")
+    summaries = metrics.delta(before, metrics.snapshot())["summaries"]["aggregation_stage_duration_seconds"]
+    assert (("stage", "mongo_write"),) in summaries
@@ -0,0 +1,102 @@
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+import concurrency
+from concurrency import AdaptiveLimiter, ConcurrencyController
+
+
+def _window(limiter, latency_ms):
+    for _ in range(limiter.window):
+        limiter.record_latency(latency_ms)
+
+
+def test_initial_limit_is_clamped_to_the_bounds():
+    assert AdaptiveLimiter("test", initial=50, minimum=2, maximum=8).limit == 8
+    assert AdaptiveLimiter("test", initial=0, minimum=2, maximum=8).limit == 2
+    assert AdaptiveLimiter("test", initial=4, minimum=0, maximum=0).limit == 1
+
+
+def test_limit_backs_off_when_latency_rises():
+    limiter = AdaptiveLimiter("test", initial=8, minimum=2, maximum=16, tolerance=2.0, window=4)
+    _window(limiter, 10)
+    assert limiter.baseline_ms == 10
+    assert limiter.limit == 8
+    _window(limiter, 100)
+    assert limiter.limit == 6
+    for _ in range(10):
+        _window(limiter, 1000)
+    assert limiter.limit == 2
+
+
+def test_limit_grows_only_while_saturated():
+    limiter = AdaptiveLimiter("test", initial=2, minimum=1, maximum=3, tolerance=2.0, window=2)
+    _window(limiter, 10)
+    assert limiter.limit == 2
+    with limiter.slot(), limiter.slot():
+        _window(limiter, 10)
+        assert limiter.limit == 3
+        with limiter.slot():
+            _window(limiter, 10)
+    assert limiter.limit == 3
+
+
+def test_slot_waits_for_a_free_slot():
+    limiter = AdaptiveLimiter("test", initial=1, minimum=1, maximum=1)
+    entered = threading.Event()
+
+    def second():
+        with limiter.slot():
+            entered.set()
+
+    with limiter.slot():
+        thread = threading.Thread(target=second)
+        thread.start()
+        assert not entered.wait(0.1)
+    assert entered.wait(2)
+    thread.join()
+    assert limiter.in_flight == 0
+
+
+def test_io_limits_respect_tasks_workers_and_the_mongo_pool(monkeypatch):
+    monkeypatch.setattr(concurrency, "get_mongo_pool_size", lambda connection=None: 100)
+    controller = ConcurrencyController(cpu_executor="inline", io_workers=16)
+    limits = controller.io_limits(task_count=40)
+    assert limits["maximum"] == min(16, int(100 * concurrency.AGG_MONGO_POOL_SHARE))
+    assert limits["minimum"] <= limits["initial"] <= limits["maximum"]
+    assert controller.io_limits(task_count=1)["maximum"] == 1
+
+
+def test_inline_cpu_executor_runs_in_the_calling_thread():
+    controller = ConcurrencyController(cpu_executor="inline")
+    assert controller.get_cpu_executor() is None
+    assert controller.run_cpu(threading.get_ident) == threading.get_ident()
+
+
+def test_io_slot_is_released_while_waiting_on_the_cpu_executor():
+    limiter = AdaptiveLimiter("test", initial=1, minimum=1, maximum=1)
+    controller = ConcurrencyController(cpu_executor="inline")
+    with limiter.slot():
+        assert limiter.in_flight == 1
+        assert controller.run_cpu(lambda: limiter.in_flight) == 0
+        assert limiter.in_flight == 1
+    assert limiter.in_flight == 0
+
+
+def test_broken_process_pool_is_recreated_and_retried():
+    class BrokenPool:
+        shut_down = False
+
+        def submit(self, *args, **kwargs):
+            raise BrokenProcessPool("a worker died")
+
+        def shutdown(self, wait=True):
+            self.shut_down = True
+
+    controller = ConcurrencyController(cpu_executor="thread", cpu_workers=1)
+    broken = controller._cpu_executor = BrokenPool()
+    try:
+        assert controller.run_cpu(lambda: "forecast") == "forecast"
+        assert broken.shut_down
+        assert controller._cpu_executor is not broken
+    finally:
+        controller.shutdown()
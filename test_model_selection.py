@@ -0,0 +1,63 @@
+import pytest
+
+import model_selection
+from model_selection import (REGRESSION_MODELS, SKIP_LOW_VARIANCE, SKIP_NEVER_WINS, SKIP_NO_SEASONALITY,
+                             SKIP_TOO_SHORT, SKIP_UNAVAILABLE, TIME_SERIES_MODELS, select_candidates)
+
+SERIES_36 = [100 + (i % 12) * 5 + i for i in range(36)]
+
+
+@pytest.fixture(autouse=True)
+def pmdarima_installed(monkeypatch):
+    monkeypatch.setattr(model_selection, "_pmdarima_available", True)
+
+
+def test_full_tournament_keeps_every_model():
+    selected, skipped = select_candidates([1.0, 2.0], full_tournament=True)
+    assert selected == REGRESSION_MODELS + TIME_SERIES_MODELS
+    assert skipped == {}
+
+
+def test_long_seasonal_series_runs_every_model():
+    selected, skipped = select_candidates(SERIES_36, seasonality_period=12, full_tournament=False)
+    assert selected == REGRESSION_MODELS + TIME_SERIES_MODELS
+    assert skipped == {}
+
+
+def test_short_series_skips_models_that_need_more_points():
+    selected, skipped = select_candidates([1.0, 3.0, 2.0, 5.0], seasonality_period=12, full_tournament=False)
+    assert skipped["ARMA"] == skipped["ARIMA"] == skipped["Auto ARIMA"] == SKIP_TOO_SHORT
+    assert skipped["SARIMA"] == skipped["SARIMAX"] == SKIP_TOO_SHORT
+    assert "AR" in selected and "Polynomial Regression" in selected
+
+
+def test_sarima_needs_seasonality_and_auto_arima_needs_pmdarima(monkeypatch):
+    monkeypatch.setattr(model_selection, "_pmdarima_available", False)
+    _, skipped = select_candidates(SERIES_36, seasonality_period=None, full_tournament=False)
+    assert skipped == {"SARIMA": SKIP_NO_SEASONALITY, "Auto ARIMA": SKIP_UNAVAILABLE}
+
+
+def test_constant_series_only_runs_regressions():
+    selected, skipped = select_candidates([5.0] * 36, seasonality_period=12, full_tournament=False)
+    assert selected == REGRESSION_MODELS
+    assert set(skipped.values()) == {SKIP_LOW_VARIANCE}
+
+
+def test_models_that_never_win_are_pruned_outside_exploration(monkeypatch):
+    monkeypatch.setattr(model_selection, "FORECAST_PRUNE_MIN_HISTORY", 10)
+    monkeypatch.setattr(model_selection, "FORECAST_EXPLORE_EVERY", 10)
+    wins = {"ARIMA": 8, "Ridge Regression": 3}
+    selected, skipped = select_candidates(SERIES_36, 12, wins, full_tournament=False)
+    assert selected == ["Linear Regression", "Ridge Regression", "AR", "ARIMA"]
+    assert skipped["SARIMA"] == SKIP_NEVER_WINS
+
+    # Every 10th forecast explores all eligible models again
+    wins["ARIMA"] = 7
+    selected, skipped = select_candidates(SERIES_36, 12, wins, full_tournament=False)
+    assert selected == REGRESSION_MODELS + TIME_SERIES_MODELS
+
+
+def test_no_pruning_before_enough_history(monkeypatch):
+    monkeypatch.setattr(model_selection, "FORECAST_PRUNE_MIN_HISTORY", 10)
+    selected, _ = select_candidates(SERIES_36, 12, {"ARIMA": 5}, full_tournament=False)
+    assert selected == REGRESSION_MODELS + TIME_SERIES_MODELS
@@ -0,0 +1,29 @@
+import asyncio
+
+import RegionAPI
+import prefetch
+
+
+class HangingClient:
+    async def get(self, url):
+        await asyncio.sleep(3600)
+
+
+def test_cancelled_half_open_trial_is_released():
+    breaker = RegionAPI.CircuitBreaker("prefetch-test", failure_threshold=1, reset_timeout=60)
+    breaker.record_failure()
+    breaker.opened_at -= breaker.reset_timeout
+
+    async def cancel_trial():
+        task = asyncio.ensure_future(prefetch._get_json(HangingClient(), breaker, "http://upstream/company/data/1"))
+        await asyncio.sleep(0.01)
+        assert breaker.state == "half_open"
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(cancel_trial())
+    assert breaker.state == "open"
+    assert breaker.allow_request()
@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+
+import pytest
+
+import profiling
+
+
+@pytest.mark.parametrize("value", [None, False, "", "0", "false", "No", "off"])
+def test_parse_mode_off(value):
+    assert profiling.parse_mode(value) is None
+
+
+@pytest.mark.parametrize("value", [True, "1", "true", "YES", "on"])
+def test_parse_mode_true_uses_the_sampler(value):
+    assert profiling.parse_mode(value) == "sample"
+
+
+def test_parse_mode_names_and_invalid_values():
+    assert profiling.parse_mode(" cProfile ") == "cprofile"
+    assert profiling.parse_mode("sample") == "sample"
+    with pytest.raises(ValueError):
+        profiling.parse_mode("perf")
+
+
+def test_profile_path_rejects_unknown_names(monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", "profiles")
+    assert profiling.profile_path("agg_1_2") == os.path.join("profiles", "agg_1_2")
+    assert profiling.profile_path("agg_1_2", "summary.json") == os.path.join("profiles", "agg_1_2", "summary.json")
+    assert profiling.profile_path("../etc") is None
+    assert profiling.profile_path("") is None
+    assert profiling.profile_path("agg_1_2", "passwd") is None
+
+
+def test_sample_profile_covers_worker_threads_of_the_job_only(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    done = threading.Event()
+    job_thread = threading.get_ident()
+
+    def pool_work():
+        profiling.adopt_pool_thread(job_thread)
+        done.wait(2)
+
+    def other_job():
+        done.wait(2)
+
+    with profiling.profile_job("job_1") as summary:
+        threads = [threading.Thread(target=pool_work, name="IOStage_0"),
+                   threading.Thread(target=other_job, name="OtherJob_0")]
+        for thread in threads:
+            thread.start()
+        threading.Event().wait(0.1)
+        done.set()
+        for thread in threads:
+            thread.join()
+
+    assert summary["mode"] == "sample"
+    with open(os.path.join(str(tmp_path), "job_1", "summary.json")) as f:
+        stored = json.load(f)
+    assert stored["coverage"] == profiling.PROFILE_COVERAGE["sample"]
+    assert "stacks.collapsed" in stored["artifacts"]
+    with open(os.path.join(str(tmp_path), "job_1", "stacks.collapsed")) as f:
+        stacks = f.read()
+    assert "pool_work" in stacks
+    assert "other_job" not in stacks
+
+
+def test_old_profiles_are_pruned(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    for number in range(4):
+        directory = tmp_path / f"job_{number}"
+        directory.mkdir()
+        os.utime(str(directory), (number, number))
+    profiling._prune_profiles(keep="job_0", retention=2)
+    assert sorted(os.listdir(str(tmp_path))) == ["job_0", "job_2", "job_3"]
@@ -0,0 +1,52 @@
+import mongomock
+import pytest
+
+import db_connection
+from rollup import rollcontroller
+
+UNIT_KEY = "9001:65f0:annual:2024"
+UNIT_QUERY = {"company_id": "9001", "reporting_year": 2024, "internal_code_id": "65f0"}
+
+
+@pytest.fixture
+def rollup(monkeypatch):
+    database = mongomock.MongoClient().db
+    monkeypatch.setattr(db_connection, "connect_to_database", lambda *args, **kwargs: database)
+    return rollcontroller.SiteDataRollup(run_id="run-1")
+
+
+def _save(rollup, qtys):
+    rollup.new_rollup_table = [{**UNIT_QUERY, "site_id": i, "rollup_qty": qty} for i, qty in enumerate(qtys)]
+    rollup.save_rollup_to_db("yearly", UNIT_KEY, UNIT_QUERY)
+
+
+def test_rerun_replaces_the_unit_and_its_legacy_rows(rollup):
+    rollup.rollup_yearly.insert_one({**UNIT_QUERY, "site_id": 0, "rollup_qty": 1})
+    rollup.rollup_yearly.insert_one({**UNIT_QUERY, "reporting_year": 2023, "rollup_qty": 7})
+
+    _save(rollup, [5, 6])
+    _save(rollup, [8])
+
+    rows = list(rollup.rollup_yearly.find({}, {"_id": 0, "reporting_year": 1, "rollup_qty": 1}))
+    assert sorted(rows, key=lambda row: row["reporting_year"]) == [
+        {"reporting_year": 2023, "rollup_qty": 7},
+        {"reporting_year": 2024, "rollup_qty": 8},
+    ]
+
+
+def test_empty_rollup_removes_the_unit(rollup):
+    _save(rollup, [5])
+    _save(rollup, [])
+    assert rollup.rollup_yearly.count_documents({}) == 0
+
+
+def test_failed_insert_raises_and_keeps_the_previous_rollup(rollup, monkeypatch):
+    _save(rollup, [5])
+
+    def failing_insert(*args, **kwargs):
+        raise RuntimeError("write failed")
+
+    monkeypatch.setattr(rollup.rollup_yearly, "insert_many", failing_insert)
+    with pytest.raises(RuntimeError):
+        _save(rollup, [9])
+    assert [row["rollup_qty"] for row in rollup.rollup_yearly.find()] == [5]
@@ -0,0 +1,89 @@
+import mongomock
+import pytest
+
+import schema_migration
+from schema_migration import (earliest_type_year, read_number, stored_qty, stored_value, to_number,
+                              type_year_match, type_year_since)
+
+
+@pytest.fixture
+def schema(monkeypatch):
+    def set_mode(mode):
+        monkeypatch.setattr(schema_migration, "NUMERIC_SCHEMA", mode)
+    return set_mode
+
+
+def test_to_number():
+    assert to_number(" 1,250.5 ") == 1250.5
+    assert to_number(7) == 7.0
+    assert to_number("n/a") is None
+    assert to_number(True) is None
+    assert to_number(float("nan")) is None
+    assert to_number(None) is None
+
+
+def test_read_number_only_parses_strings():
+    assert read_number(3.5, lambda value: 0) == 3.5
+    assert read_number("3.5", lambda value: "legacy") == "legacy"
+
+
+@pytest.mark.parametrize("mode, qty, value", [
+    ("off", "12.5", "7"),
+    ("dual", 12.5, 7.0),
+    ("on", 12.5, 7.0),
+])
+def test_stored_fields(schema, mode, qty, value):
+    schema(mode)
+    assert stored_qty(12.5) == qty
+    assert stored_value("7") == value
+    # Values that do not parse are kept as they are
+    assert stored_qty("n/a") == "n/a"
+    assert stored_value("n/a") == "n/a"
+
+
+@pytest.mark.parametrize("mode, match, since", [
+    ("off", "2021", {"type_year": {"$gte": "2019"}}),
+    ("on", 2021, {"type_year": {"$gte": 2019}}),
+    ("dual", {"$in": [2021, "2021"]},
+     {"$or": [{"type_year": {"$gte": 2019}}, {"type_year": {"$gte": "2019"}}]}),
+])
+def test_type_year_filters(schema, mode, match, since):
+    schema(mode)
+    assert type_year_match("2021") == match
+    assert type_year_since(2019) == since
+
+
+def _cdata(rows):
+    collection = mongomock.MongoClient().db.cdata
+    collection.insert_many([{"company_code": "9001", "type_year": year} for year in rows])
+    return collection
+
+
+def test_earliest_type_year_legacy_strings(schema):
+    schema("off")
+    collection = _cdata(["2021", "2019", None, "2020"])
+    assert earliest_type_year(collection, {"company_code": "9001"}) == "2019"
+    assert earliest_type_year(collection, {"company_code": "other"}) is None
+
+
+def test_earliest_type_year_dual_reads_both_representations(schema):
+    schema("dual")
+    collection = _cdata(["2018", 2020, "2021", "unknown"])
+    assert earliest_type_year(collection, {"company_code": "9001"}) == 2018
+    collection = _cdata([2017, "2018"])
+    assert earliest_type_year(collection, {"company_code": "9001"}) == 2017
+
+
+def test_earliest_type_year_numeric_only(schema):
+    schema("on")
+    collection = _cdata([2021, 2019, "2010"])
+    assert earliest_type_year(collection, {"company_code": "9001"}) == 2019
+
+
+def test_migrate_dry_run_counts_string_values():
+    collection = mongomock.MongoClient().db.cdata
+    collection.insert_many([{"type_year": "2021", "qty": 1}, {"type_year": 2021, "qty": "2"},
+                            {"type_year": 2021, "qty": 3.0}])
+    result = schema_migration.migrate_collection(collection, dry_run=True)
+    assert result["pending"] == 2
+    assert result["modified"] == 0
@@ -0,0 +1,77 @@
+import mongomock
+
+import sarima
+from forecast_telemetry import ForecastRunReport, OUTCOME_FAILED, collect_report
+from incremental import history_series
+from warm_start import _tournament_reason, model_state
+
+SERIES = [100 + (i % 4) * 5 for i in range(12)]
+
+
+def test_grown_history_can_be_warm_started():
+    report = {"selected_model": "ARIMA", "method": "tournament", "params": [0.5]}
+    stored = model_state(report, SERIES, [100, 105, 110])
+    assert _tournament_reason(stored, SERIES + [100, 105]) is None
+    assert _tournament_reason(stored, SERIES) == "series did not grow"
+    assert _tournament_reason(stored, [1] + SERIES[1:] + [100]) == "history changed"
+
+
+def test_history_series_includes_aggregated_rows():
+    collection = mongomock.MongoClient().db.cdata
+    query = {"company_code": "9001", "type": "actual", "is_aggregated": False}
+    for year, qty, aggregated in [(2021, "12", True), (2023, 30, False), (2022, "", True), (2020, "7", True)]:
+        collection.insert_one({"company_code": "9001", "type": "actual", "type_year": year,
+                               "qty": qty, "is_aggregated": aggregated})
+    collection.insert_one({"company_code": "9001", "type": "forecast", "type_year": 2024, "qty": 50,
+                           "is_aggregated": False})
+
+    series, last = history_series(collection, query, lambda doc: doc["type_year"],
+                                  lambda doc: int(doc["qty"]) if doc["qty"] != "" else None,
+                                  row_filter=lambda doc: doc["type_year"] > 2020)
+    assert series == [12, 30]
+    assert last["type_year"] == 2023
+
+
+def test_failed_refit_is_recorded_in_the_fallback_report(monkeypatch):
+    def failing_fit(*args, **kwargs):
+        raise ValueError("did not converge")
+
+    def tournament(pred_array, predictedValue, m=None, model_wins=None):
+        report = ForecastRunReport(len(pred_array), predictedValue)
+        report.add_candidate("AR", 0.01, score=1.0)
+        report.finish("AR", "tournament")
+        return [101, 102, 103]
+
+    monkeypatch.setattr(sarima, "fit_time_series_model", failing_fit)
+    monkeypatch.setattr(sarima, "run_sarima", tournament)
+
+    predictions, report = collect_report(sarima.refit_sarima, SERIES, {"name": "ARIMA", "params": [0.5]}, 3)
+    assert predictions == [101, 102, 103]
+    assert report["method"] == "tournament"
+    assert report["selected_model"] == "AR"
+    assert report["candidates"][0]["model"] == "ARIMA"
+    assert report["candidates"][0]["outcome"] == OUTCOME_FAILED
+    assert report["warm_start"] == {"model": "ARIMA", "outcome": OUTCOME_FAILED,
+                                    "error": "warm refit: did not converge"}
+
+
+def test_forecast_cache_is_keyed_on_the_full_history(monkeypatch):
+    import incremental
+
+    calls = []
+
+    def run_forecast(collect, forecast_fn, series, *args, **kwargs):
+        calls.append(list(series))
+        return [1, 2, 3], None
+
+    monkeypatch.setattr(incremental, "run_forecast", run_forecast)
+    connection = mongomock.MongoClient().db
+    key = incremental.forecast_state_key("9001", "65f000000000000000000001", "S1", "annual")
+
+    def forecast(series):
+        return incremental.forecast_series(connection, key, series, True, None, predictedValue=3)
+
+    assert forecast(SERIES) == [1, 2, 3]
+    assert forecast(list(SERIES)) == []
+    assert forecast([1] + SERIES[1:]) == [1, 2, 3]
+    assert calls == [SERIES, [1] + SERIES[1:]]
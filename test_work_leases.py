@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+
+import mongomock
+import pytest
+
+import work_leases
+from work_leases import LeaseManager, lease_manager, shared_lease_epoch
+
+
+class ClockLeaseManager(LeaseManager):
+    """mongomock cannot evaluate $$NOW; use a test clock instead"""
+    clock = datetime(2026, 1, 1)
+
+    def _now(self):
+        return ClockLeaseManager.clock
+
+    def _expiry(self):
+        return ClockLeaseManager.clock + timedelta(seconds=self.ttl)
+
+
+def _managers(epoch="run-1"):
+    ClockLeaseManager.clock = datetime(2026, 1, 1)
+    db = mongomock.MongoClient().db
+    return (db, ClockLeaseManager(db, "aggregation", owner="a", epoch=epoch),
+            ClockLeaseManager(db, "aggregation", owner="b", epoch=epoch))
+
+
+def test_held_unit_cannot_be_claimed_by_another_owner():
+    _, first, second = _managers()
+    assert first.acquire("42")
+    assert not second.acquire("42")
+    first.release("42")
+    assert second.acquire("42")
+
+
+def test_completed_unit_is_skipped_for_the_rest_of_the_epoch():
+    db, first, second = _managers()
+    with first.lease("42") as acquired:
+        assert acquired
+        first.complete("42")
+    assert not first.is_held("42")
+    assert db.work_leases.find_one({"_id": "aggregation:42"})["status"] == "done"
+    assert not second.acquire("42")
+    assert not first.acquire("42")
+
+
+def test_unit_is_claimable_again_in_a_new_epoch():
+    db, first, _ = _managers()
+    assert first.acquire("42")
+    first.complete("42")
+    later = ClockLeaseManager(db, "aggregation", owner="c", epoch="run-2")
+    assert later.acquire("42")
+
+
+def test_expired_lease_can_be_taken_over():
+    db, first, second = _managers()
+    assert first.acquire("42")
+    ClockLeaseManager.clock += timedelta(seconds=first.ttl - 1)
+    assert not second.acquire("42")
+    ClockLeaseManager.clock += timedelta(seconds=2)
+    assert second.acquire("42")
+    assert db.work_leases.find_one({"_id": "aggregation:42"})["owner"] == "b"
+
+
+def test_failed_unit_is_released_for_other_replicas():
+    _, first, second = _managers()
+    with first.lease("42") as acquired:
+        assert acquired
+    assert second.acquire("42")
+
+
+def test_lease_manager_needs_an_epoch(monkeypatch):
+    monkeypatch.setattr(work_leases, "WORK_LEASE_EPOCH", "")
+    with pytest.raises(ValueError):
+        LeaseManager(mongomock.MongoClient().db, "aggregation")
+
+
+def test_shared_epoch_precedence(monkeypatch):
+    db = mongomock.MongoClient().db
+    monkeypatch.setattr(work_leases, "WORK_LEASE_EPOCH", "")
+    monkeypatch.setattr(work_leases, "WORK_LEASE_EPOCH_WINDOW_SECONDS", 0)
+    assert shared_lease_epoch(db) is None
+    assert shared_lease_epoch(db, "aggregation_20260101_ab12") == "aggregation_20260101_ab12"
+
+    monkeypatch.setattr(work_leases, "_server_time", lambda connection: datetime(2026, 10, 19, 7, 30))
+    monkeypatch.setattr(work_leases, "WORK_LEASE_EPOCH_WINDOW_SECONDS", 86400)
+    morning = shared_lease_epoch(db)
+    monkeypatch.setattr(work_leases, "_server_time", lambda connection: datetime(2026, 10, 19, 23, 0))
+    assert shared_lease_epoch(db) == morning
+    monkeypatch.setattr(work_leases, "_server_time", lambda connection: datetime(2026, 10, 20, 0, 30))
+    assert shared_lease_epoch(db) != morning
+
+    monkeypatch.setattr(work_leases, "WORK_LEASE_EPOCH", "nightly-42")
+    assert shared_lease_epoch(db) == "nightly-42"
+
+
+def test_leases_are_not_enabled_without_a_shared_epoch(monkeypatch):
+    db = mongomock.MongoClient().db
+    monkeypatch.setattr(work_leases, "WORK_LEASES_ENABLED", True)
+    assert lease_manager(db, "aggregation", None) is None
+    assert lease_manager(db, "aggregation", "run-1").epoch == "run-1"
+    monkeypatch.setattr(work_leases, "WORK_LEASES_ENABLED", False)
+    assert lease_manager(db, "aggregation", "run-1") is None
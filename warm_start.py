@@ -0,0 +1,105 @@
+"""
+Warm-started forecasting.
+
+After a tournament, the winning model of each (company, code, site, frequency)
+series is stored in its forecast_state document (name, fitted params,
+seasonality period, the length and hash of the series it was fitted on, and
+the head of its forecast). When the series only grew by new observations, the
+next forecast refits just that model starting from the stored params
+(sarima.refit_sarima) instead of fitting every candidate from scratch. The
+series is the full actual history of the code/site (incremental.history_series),
+so each run sees the previous one's series plus the newly arrived observations.
+
+A full tournament still runs when
+- there is no stored model, or the stored winner cannot be warm-started,
+- the already-fitted part of the series changed (backfilled or corrected data),
+- the last tournament is older than FORECAST_RETOURNAMENT_DAYS,
+- the stored forecast missed the newly arrived observations by more than
+  FORECAST_DRIFT_TOLERANCE (mean absolute error relative to the series level).
+
+Disable with FORECAST_WARM_START=false; FORECAST_FULL_TOURNAMENT=true also
+turns it off.
+"""
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+import metrics
+from model_selection import FORECAST_FULL_TOURNAMENT, REGRESSION_MODELS
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+FORECAST_WARM_START = os.getenv("FORECAST_WARM_START", "true").lower() in ("1", "true", "yes")
+FORECAST_RETOURNAMENT_DAYS = float(os.getenv("FORECAST_RETOURNAMENT_DAYS", "30"))
+FORECAST_DRIFT_TOLERANCE = float(os.getenv("FORECAST_DRIFT_TOLERANCE", "0.25"))
+# Forecast points kept to check the next observations against
+FORECAST_HEAD_POINTS = 12
+
+# AutoARIMA re-searches its order on every fit, so it always goes through the tournament
+WARM_START_MODELS = set(REGRESSION_MODELS) | {'AR', 'ARMA', 'ARIMA', 'SARIMA', 'SARIMAX'}
+
+
+def _series_hash(series: List[Any]) -> str:
+    return hashlib.sha1(json.dumps([float(v) for v in series]).encode("utf-8")).hexdigest()
+
+
+def _tournament_reason(stored: Optional[Dict[str, Any]], series: List[Any]) -> Optional[str]:
+    """Why the series needs a full tournament, or None if the stored model can be refitted"""
+    if not stored or stored.get("name") not in WARM_START_MODELS:
+        return "no stored model"
+    fitted_length = stored.get("fitted_length", 0)
+    if len(series) <= fitted_length:
+        return "series did not grow"
+    if _series_hash(series[:fitted_length]) != stored.get("prefix_hash"):
+        return "history changed"
+    tournament_at = stored.get("tournament_at")
+    if tournament_at is None or datetime.now() - tournament_at > timedelta(days=FORECAST_RETOURNAMENT_DAYS):
+        return "scheduled re-tournament"
+
+    new_points = [float(v) for v in series[fitted_length:]]
+    head = (stored.get("forecast_head") or [])[:len(new_points)]
+    if head:
+        level = max(sum(abs(float(v)) for v in series) / len(series), 1e-9)
+        error = sum(abs(actual - predicted) for actual, predicted in zip(new_points, head)) / len(head)
+        if error / level > FORECAST_DRIFT_TOLERANCE:
+            return f"drift ({error / level:.2f} relative error)"
+    return None
+
+
+def warm_start_model(state: Optional[Dict[str, Any]], series: List[Any]) -> Optional[Dict[str, Any]]:
+    """The stored model to refit for series, or None when a full tournament is due"""
+    if not FORECAST_WARM_START or FORECAST_FULL_TOURNAMENT:
+        return None
+    stored = (state or {}).get("model")
+    reason = _tournament_reason(stored, series)
+    if reason:
+        if stored:
+            logger.info(f"Full forecast tournament for {stored.get('name')}: {reason}")
+        metrics.inc("forecast_tournaments_total", reason=reason.split(" (")[0])
+        return None
+    return stored
+
+
+def model_state(report: Dict[str, Any], series: List[Any], predictions: List[Any],
+                previous: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Stored-model document for the forecast that just ran"""
+    if report.get("method") == "warm_start" and previous:
+        tournament_at = previous.get("tournament_at")
+    else:
+        tournament_at = datetime.now()
+    return {
+        "name": report.get("selected_model"),
+        "params": report.get("params"),
+        "seasonality_period": report.get("seasonality_period"),
+        "fitted_length": len(series),
+        "prefix_hash": _series_hash(series),
+        "forecast_head": [float(v) for v in predictions[:FORECAST_HEAD_POINTS]],
+        "tournament_at": tournament_at,
+    }
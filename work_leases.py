@@ -0,0 +1,215 @@
+"""
+Lease-based work distribution across service replicas.
+
+A unit of work (a company, or a company:code key) is claimed by writing a
+lease document to the work_leases collection with an expiry time. Only one
+owner can hold an unexpired lease on a unit, so when several replicas run the
+same all-companies job each unit is processed by at most one of them at a
+time. Held leases are renewed by a heartbeat thread; if a worker dies its
+leases simply expire and another replica can claim the unit. Expiry times
+are set and compared on the server ($$NOW), so clock skew between replicas
+cannot make a live lease look expired.
+
+A unit that was processed successfully is not released but marked done for
+the lease epoch, so replicas that reach it later skip it instead of
+processing it again. The epoch must be the same on every replica of a run;
+it is, in order:
+
+- the resume run id the job was started with (--resume / resume_run_id)
+- WORK_LEASE_EPOCH
+- the schedule window the server's current time falls in, when
+  WORK_LEASE_EPOCH_WINDOW_SECONDS is set (e.g. 86400 for a daily job)
+
+Without one of these the leases are not enabled. A new epoch makes every
+unit claimable again.
+
+Enable with WORK_LEASES_ENABLED=true (all replicas must share the database).
+"""
+import logging
+import os
+import socket
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+WORK_LEASES_ENABLED = os.getenv("WORK_LEASES_ENABLED", "false").lower() in ("1", "true", "yes")
+WORK_LEASE_TTL_SECONDS = float(os.getenv("WORK_LEASE_TTL_SECONDS", "60"))
+WORK_LEASES_COLLECTION = "work_leases"
+# Shared id of the run the replicas are splitting
+WORK_LEASE_EPOCH = os.getenv("WORK_LEASE_EPOCH", "")
+# Alternatively: length of the schedule window whose start identifies the run (0 = off)
+WORK_LEASE_EPOCH_WINDOW_SECONDS = int(os.getenv("WORK_LEASE_EPOCH_WINDOW_SECONDS", "0"))
+
+STATUS_HELD = "held"
+STATUS_DONE = "done"
+
+
+def default_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def _server_time(connection) -> datetime:
+    try:
+        return connection.command("hello")["localTime"]
+    except Exception as e:
+        logger.warning(f"Could not read the server time, using the local clock: {str(e)}")
+        return datetime.utcnow()
+
+
+def shared_lease_epoch(connection, resume_run_id: Optional[str] = None) -> Optional[str]:
+    """Epoch all replicas of a run agree on, None if there is none (see the module docstring)"""
+    if resume_run_id:
+        return resume_run_id
+    if WORK_LEASE_EPOCH:
+        return WORK_LEASE_EPOCH
+    if WORK_LEASE_EPOCH_WINDOW_SECONDS > 0:
+        window_start = int(_server_time(connection).timestamp()) // WORK_LEASE_EPOCH_WINDOW_SECONDS
+        return f"window:{WORK_LEASE_EPOCH_WINDOW_SECONDS}:{window_start}"
+    return None
+
+
+def lease_manager(connection, namespace: str, epoch: Optional[str]) -> Optional["LeaseManager"]:
+    """LeaseManager for a controller, or None when leases are disabled or there is no shared epoch"""
+    if not WORK_LEASES_ENABLED:
+        return None
+    if not epoch:
+        logger.error("WORK_LEASES_ENABLED is set but there is no shared lease epoch; running without leases. "
+                     "Set WORK_LEASE_EPOCH or WORK_LEASE_EPOCH_WINDOW_SECONDS, or pass a resume run id")
+        return None
+    logger.info(f"Work leases enabled for {namespace} (epoch {epoch})")
+    return LeaseManager(connection, namespace, epoch=epoch)
+
+
+class LeaseManager:
+    def __init__(self, connection, namespace: str, owner: Optional[str] = None, ttl: float = WORK_LEASE_TTL_SECONDS,
+                 epoch: Optional[str] = None):
+        self.collection = connection[WORK_LEASES_COLLECTION]
+        # Job type (aggregation / rollup), so different jobs on the same company do not block each other
+        self.namespace = namespace
+        self.owner = owner or default_owner()
+        self.epoch = epoch or WORK_LEASE_EPOCH
+        if not self.epoch:
+            raise ValueError("LeaseManager needs an epoch shared by all replicas")
+        self.ttl = ttl
+        self._held: Dict[str, datetime] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+        self.collection.create_index("expires_at")
+
+    def acquire(self, unit_key: str) -> bool:
+        """Claim the unit if it is free, expired or already ours, and not done in this epoch"""
+        unit_key = self._lease_id(unit_key)
+        try:
+            lease = self.collection.find_one_and_update(
+                {"_id": unit_key,
+                 "$or": [{"$expr": {"$lt": ["$expires_at", self._now()]}}, {"owner": self.owner}, {"status": STATUS_DONE}],
+                 "done_epoch": {"$ne": self.epoch}},
+                [{"$set": {"owner": {"$literal": self.owner}, "status": STATUS_HELD, "epoch": {"$literal": self.epoch},
+                           "acquired_at": self._now(), "expires_at": self._expiry()}}],
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Lease exists and is held by another owner, or the unit is done for this epoch
+            return False
+
+        if lease is None or lease.get("owner") != self.owner:
+            return False
+        with self._lock:
+            self._held[unit_key] = datetime.utcnow()
+        self._ensure_heartbeat()
+        return True
+
+    def release(self, unit_key: str) -> None:
+        unit_key = self._lease_id(unit_key)
+        with self._lock:
+            self._held.pop(unit_key, None)
+        self.collection.delete_one({"_id": unit_key, "owner": self.owner, "status": STATUS_HELD})
+
+    def complete(self, unit_key: str) -> None:
+        """Mark a held unit done for this epoch; it stays claimed until a later epoch"""
+        unit_key = self._lease_id(unit_key)
+        with self._lock:
+            self._held.pop(unit_key, None)
+        self.collection.update_one(
+            {"_id": unit_key, "owner": self.owner},
+            [{"$set": {"status": STATUS_DONE, "done_epoch": {"$literal": self.epoch}, "completed_at": self._now()}}]
+        )
+
+    def renew(self) -> None:
+        """Extend all held leases; drop the ones that were lost (expired and taken over)"""
+        with self._lock:
+            keys = list(self._held)
+        for key in keys:
+            result = self.collection.update_one({"_id": key, "owner": self.owner, "status": STATUS_HELD},
+                                                [{"$set": {"expires_at": self._expiry()}}])
+            with self._lock:
+                # Completed or released while renewing
+                if key not in self._held:
+                    continue
+                if result.matched_count == 0:
+                    logger.warning(f"Lease on {key} was lost (owner {self.owner})")
+                    self._held.pop(key, None)
+
+    def _now(self):
+        """The current time, evaluated by the server"""
+        return "$$NOW"
+
+    def _expiry(self) -> dict:
+        return {"$add": [self._now(), int(self.ttl * 1000)]}
+
+    def is_held(self, unit_key: str) -> bool:
+        with self._lock:
+            return self._lease_id(unit_key) in self._held
+
+    def _lease_id(self, unit_key: str) -> str:
+        if unit_key.startswith(f"{self.namespace}:"):
+            return unit_key
+        return f"{self.namespace}:{unit_key}"
+
+    @contextmanager
+    def lease(self, unit_key: str):
+        """
+        Hold the lease for the duration of the block; yields False if the unit is
+        taken. Call complete() inside the block to keep the unit from being claimed
+        again in this epoch, otherwise it is released at the end.
+        """
+        acquired = self.acquire(unit_key)
+        try:
+            yield acquired
+        finally:
+            if acquired and self.is_held(unit_key):
+                self.release(unit_key)
+
+    def _ensure_heartbeat(self) -> None:
+        if self._heartbeat is not None and self._heartbeat.is_alive():
+            return
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._heartbeat_loop, name="LeaseHeartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def _heartbeat_loop(self) -> None:
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                self.renew()
+            except Exception as e:
+                logger.error(f"Lease heartbeat failed: {str(e)}")
+
+    def close(self) -> None:
+        """Stop renewing and release everything still held"""
+        self._stop.set()
+        with self._lock:
+            keys = list(self._held)
+        for key in keys:
+            self.release(key)